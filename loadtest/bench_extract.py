@@ -0,0 +1,115 @@
+"""
+قياس معالجة نتائج الاستخراج بدون شبكة، من ملفات fixtures المسجلة بـ YTDLP_RECORD_DIR
+أو بـ python main.py record-fixtures urls.txt.
+
+    python loadtest/bench_extract.py --fixtures fixtures/extract --repeat 200
+    python loadtest/bench_extract.py --snapshot expected.json     # حفظ النواتج الحالية
+    python loadtest/bench_extract.py --compare expected.json      # فشل (exit 1) لو تغيرت
+
+لكل منصة: p50/p99 بالميكروثانية لـ summarize_info، و get_video_info كاملة عبر FixtureYoutubeDL،
+واختيار الصيغة لكل جودة (find_format_id).
+"""
+
+import os
+import sys
+import json
+import glob
+import time
+import argparse
+import collections
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+
+from run import percentile  # noqa: E402
+
+
+def load_main(fixtures: str):
+    os.environ["YTDLP_REPLAY_DIR"] = fixtures
+    os.environ.pop("YTDLP_RECORD_DIR", None)
+    os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+    import main
+
+    return main
+
+
+def timed(func, repeat: int) -> list[float]:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1e6)
+    return samples
+
+
+def run(args) -> int:
+    main = load_main(args.fixtures)
+    paths = sorted(glob.glob(os.path.join(args.fixtures, "*.json")))
+    if not paths:
+        print(f"no fixtures in {args.fixtures}")
+        return 1
+
+    stats: dict[tuple[str, str], list[float]] = collections.defaultdict(list)
+    counts: collections.Counter = collections.Counter()
+    outputs = {}
+
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            payload = json.load(f)
+        url, info = payload["url"], payload["info"]
+        platform = main.canonical_domain(url) or "unknown"
+        counts[platform] += 1
+
+        summary = main.get_video_info(url)
+        if not summary.get("success"):
+            print(f"replay failed for {url}: {summary.get('error')}")
+            return 1
+        outputs[url] = summary
+        heights = [q["height"] for q in summary["qualities"]] or [None]
+
+        stats[(platform, "summarize_info")] += timed(lambda: main.summarize_info(info, url), args.repeat)
+        stats[(platform, "get_video_info")] += timed(lambda: main.get_video_info(url), args.repeat)
+        stats[(platform, "find_format_id")] += timed(
+            lambda: [main.find_format_id(summary, h) for h in heights], args.repeat
+        )
+
+    print(f"{len(paths)} fixtures, {args.repeat} runs each\n")
+    print(f"{'platform':<22}{'n':>5}  {'operation':<18}{'p50 us':>10}{'p99 us':>10}")
+    for (platform, op), samples in sorted(stats.items()):
+        print(
+            f"{platform:<22}{counts[platform]:>5}  {op:<18}"
+            f"{percentile(samples, 50):>10.1f}{percentile(samples, 99):>10.1f}"
+        )
+
+    if args.snapshot:
+        with open(args.snapshot, "w", encoding="utf-8") as f:
+            json.dump(outputs, f, ensure_ascii=False, indent=1, sort_keys=True)
+        print(f"\nsnapshot written: {args.snapshot}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            expected = json.load(f)
+        # نفس التحويل عبر JSON حتى تتطابق الأنواع (tuple/list...)
+        actual = json.loads(json.dumps(outputs, ensure_ascii=False))
+        changed = sorted(u for u in expected.keys() | actual.keys() if expected.get(u) != actual.get(u))
+        if changed:
+            print(f"\n{len(changed)} outputs differ from {args.compare}:")
+            for u in changed[:20]:
+                print(f"  {u}")
+            return 1
+        print(f"\noutputs match {args.compare}")
+    return 0
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Offline benchmark of extraction post-processing")
+    p.add_argument("--fixtures", default="fixtures/extract", help="directory of recorded fixtures")
+    p.add_argument("--repeat", type=int, default=100, help="runs per fixture and operation")
+    p.add_argument("--snapshot", help="write current outputs to this file")
+    p.add_argument("--compare", help="fail if outputs differ from this snapshot")
+    return p.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(run(parse_args()))
@@ -0,0 +1,367 @@
+"""
+اختبار حمل كامل للبوت بدون تيليجرام وبدون مواقع حقيقية.
+
+يشغّل: خادم Bot API وهمي + خادم وسائط محلي + البوت نفسه (main.py) كعملية منفصلة
+مع yt-dlp وهمي (loadtest/stubs عبر PYTHONPATH)، ثم مستخدمين وهميين يرسلون روابط
+ويضغطون الأزرار، مع رفع التزامن تدريجيًا.
+
+    python loadtest/run.py --levels 1,5,10,25 --iterations 3 --media-kb 512
+
+التقرير لكل مستوى تزامن: p50/p99 لكل مرحلة (من جهة المستخدم ومن سجلات البوت spans_ms)،
+عدد الطلبات في الثانية، وأعلى ذاكرة (RSS) للبوت وعمّاله.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import collections
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+from servers import MockBotAPI, MediaOrigin, start_site  # noqa: E402
+
+MAIN_PY = os.path.join(os.path.dirname(HERE), "main.py")
+STUBS = os.path.join(HERE, "stubs")
+BOT_TOKEN = "123456:LOADTEST"
+FIRST_CHAT_ID = 10_000
+
+# مراحل من سجلات البوت (log_trace_summary) تُضم للتقرير
+BOT_EVENTS = ("link_analyzed", "request_done")
+
+
+class FlowFailed(Exception):
+    pass
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    k = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[k]
+
+
+class LevelStats:
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self.stages: dict[str, list[float]] = collections.defaultdict(list)
+        self.ok = 0
+        self.errors: collections.Counter = collections.Counter()
+        self.upload_bytes = 0
+        self.peak_rss = 0
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    def add(self, stage: str, ms: float):
+        self.stages[stage].append(ms)
+
+    def as_dict(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "flows_ok": self.ok,
+            "errors": dict(self.errors),
+            "elapsed_s": round(self.elapsed, 2),
+            "throughput_per_s": round(self.ok / self.elapsed, 2) if self.elapsed else 0,
+            "upload_mb": round(self.upload_bytes / 1024**2, 1),
+            "peak_rss_mb": round(self.peak_rss / 1024**2, 1),
+            "stages": {
+                name: {
+                    "n": len(v),
+                    "p50_ms": round(percentile(v, 50), 1),
+                    "p99_ms": round(percentile(v, 99), 1),
+                }
+                for name, v in sorted(self.stages.items())
+            },
+        }
+
+
+# ---------- الذاكرة ----------
+
+
+def _proc_children(pid: int) -> list[int]:
+    children = []
+    try:
+        for tid in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{tid}/children") as f:
+                children += [int(c) for c in f.read().split()]
+    except OSError:
+        pass
+    return children
+
+
+def tree_rss(pid: int) -> int:
+    """
+    مجموع VmRSS للعملية وكل أبنائها (العمّال وعمليات yt-dlp)؛ على Linux فقط
+    """
+    total = 0
+    stack = [pid]
+    while stack:
+        p = stack.pop()
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+        stack += _proc_children(p)
+    return total
+
+
+async def sample_memory(pid: int, holder: dict, stop: asyncio.Event):
+    while not stop.is_set():
+        stats = holder.get("level")
+        if stats is not None:
+            stats.peak_rss = max(stats.peak_rss, tree_rss(pid))
+        try:
+            await asyncio.wait_for(stop.wait(), 0.2)
+        except asyncio.TimeoutError:
+            pass
+
+
+# ---------- البوت ----------
+
+
+async def start_bot(api_url: str, origin_url: str, args, workdir: str) -> asyncio.subprocess.Process:
+    env = {
+        **os.environ,
+        "BOT_TOKEN": BOT_TOKEN,
+        "TELEGRAM_API_URL": api_url,
+        "PYTHONPATH": STUBS + os.pathsep + os.environ.get("PYTHONPATH", ""),
+        "LOADTEST_ORIGIN": origin_url,
+        "LOADTEST_MEDIA_KB": str(args.media_kb),
+        "LOADTEST_EXTRACT_MS": str(args.extract_ms),
+        "LOADTEST_EXTRACT_FAIL": str(args.extract_fail),
+        "WORKER_COUNT": str(args.workers),
+        "JOB_CONCURRENCY": str(args.job_concurrency),
+        "LOG_LEVEL": "INFO",
+    }
+    return await asyncio.create_subprocess_exec(
+        sys.executable,
+        MAIN_PY,
+        cwd=workdir,
+        env=env,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        limit=1024 * 1024,
+    )
+
+
+async def read_bot_logs(proc: asyncio.subprocess.Process, holder: dict, log_file):
+    """
+    سجلات البوت JSON سطرًا سطرًا؛ spans_ms لكل طلب تُنسب لمستوى التزامن الجاري
+    """
+    while True:
+        line = await proc.stdout.readline()
+        if not line:
+            return
+        log_file.write(line.decode("utf-8", "replace"))
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        stats = holder.get("level")
+        if stats is None or record.get("msg") not in BOT_EVENTS:
+            continue
+        for stage, ms in (record.get("spans_ms") or {}).items():
+            stats.add(f"bot.{stage}", ms)
+
+
+# ---------- المستخدم الوهمي ----------
+
+
+def buttons(message: dict) -> list[str]:
+    markup = message.get("reply_markup") or {}
+    return [b.get("callback_data") for row in markup.get("inline_keyboard", []) for b in row]
+
+
+async def wait_for(q: asyncio.Queue, predicate, timeout: float):
+    deadline = time.perf_counter() + timeout
+    while True:
+        left = deadline - time.perf_counter()
+        if left <= 0:
+            raise FlowFailed("timeout")
+        try:
+            at, method, message, upload_bytes = await asyncio.wait_for(q.get(), left)
+        except asyncio.TimeoutError:
+            raise FlowFailed("timeout")
+        text = message.get("text") or ""
+        if text.startswith(("❌", "🚫", "⚠️")):
+            raise FlowFailed(text.splitlines()[0][:60])
+        if predicate(method, message):
+            return at, message, upload_bytes
+
+
+async def run_flow(api: MockBotAPI, chat_id: int, link: str, action: str, stats: LevelStats, timeout: float):
+    q = api.subscribe(chat_id)
+    try:
+        t0 = time.perf_counter()
+        await api.push_message(chat_id, link)
+        t_menu, menu, _ = await wait_for(
+            q, lambda m, msg: any(b and b.startswith("t:") for b in buttons(msg)), timeout
+        )
+        kinds = {b.split(":")[1]: b for b in buttons(menu) if b and b.startswith("t:")}
+        stats.add("user.analyze", (t_menu - t0) * 1000)
+
+        t_choice = time.perf_counter()
+        if action == "audio":
+            await api.push_callback(chat_id, menu, kinds["a"])
+            expected = "sendAudio"
+        else:
+            await api.push_callback(chat_id, menu, kinds["v"])
+            t_q, qmenu, _ = await wait_for(
+                q, lambda m, msg: any(b and b.startswith("q:") for b in buttons(msg)), timeout
+            )
+            stats.add("user.quality_menu", (t_q - t_choice) * 1000)
+            choice = random.choice([b for b in buttons(qmenu) if b and b.startswith("q:")])
+            t_choice = time.perf_counter()
+            await api.push_callback(chat_id, qmenu, choice)
+            expected = "sendVideo"
+
+        t_done, _, upload_bytes = await wait_for(q, lambda m, msg: m == expected, timeout)
+        stats.add(f"user.deliver_{action}", (t_done - t_choice) * 1000)
+        stats.add("user.total", (t_done - t0) * 1000)
+        stats.upload_bytes += upload_bytes
+        stats.ok += 1
+    finally:
+        api.unsubscribe(chat_id)
+
+
+async def virtual_user(api: MockBotAPI, index: int, args, stats: LevelStats, origin_url: str, level: int):
+    chat_id = FIRST_CHAT_ID + index
+    for i in range(args.iterations):
+        if args.hot_links:
+            video_id = f"hot{random.randrange(args.hot_links)}"
+        else:
+            video_id = f"c{level}-u{index}-i{i}"
+        link = f"{origin_url}/watch/{video_id}"
+        action = "audio" if random.random() < args.audio_share else "video"
+        try:
+            await run_flow(api, chat_id, link, action, stats, args.timeout)
+        except FlowFailed as e:
+            stats.errors[str(e)] += 1
+        if args.think_ms:
+            await asyncio.sleep(random.uniform(0, 2 * args.think_ms) / 1000)
+
+
+# ---------- التقرير ----------
+
+
+def print_report(results: list[dict]):
+    print()
+    print(f"{'conc':>5} {'ok':>6} {'err':>5} {'flows/s':>8} {'up MB':>8} {'peak RSS MB':>12}")
+    for r in results:
+        print(
+            f"{r['concurrency']:>5} {r['flows_ok']:>6} {sum(r['errors'].values()):>5} "
+            f"{r['throughput_per_s']:>8} {r['upload_mb']:>8} {r['peak_rss_mb']:>12}"
+        )
+
+    stages = sorted({s for r in results for s in r["stages"]})
+    print()
+    header = f"{'stage':<24}" + "".join(f"{'c=' + str(r['concurrency']):>18}" for r in results)
+    print(header + "\n" + " " * 24 + "".join(f"{'p50 / p99 ms':>18}" for _ in results))
+    for stage in stages:
+        row = f"{stage:<24}"
+        for r in results:
+            s = r["stages"].get(stage)
+            row += f"{s['p50_ms']:>9.0f} /{s['p99_ms']:>7.0f}" if s else f"{'-':>18}"
+        print(row)
+
+    errors = collections.Counter()
+    for r in results:
+        errors.update(r["errors"])
+    if errors:
+        print("\nerrors:")
+        for err, n in errors.most_common():
+            print(f"  {n:>5}  {err}")
+
+
+async def main(args):
+    api = MockBotAPI(flood_rate=args.flood_rate)
+    origin = MediaOrigin(kbps=args.origin_kbps)
+    api_runner, api_url = await start_site(api.app())
+    origin_runner, origin_url = await start_site(origin.app())
+
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    log_path = os.path.join(workdir, "bot.log")
+    print(f"workdir: {workdir}")
+
+    holder: dict = {}
+    stop = asyncio.Event()
+    proc = await start_bot(api_url, origin_url, args, workdir)
+    with open(log_path, "w", encoding="utf-8") as log_file:
+        reader = asyncio.create_task(read_bot_logs(proc, holder, log_file))
+        sampler = asyncio.create_task(sample_memory(proc.pid, holder, stop))
+        results = []
+        try:
+            try:
+                await asyncio.wait_for(api.polled.wait(), 60)
+            except asyncio.TimeoutError:
+                raise SystemExit(f"البوت لم يبدأ الاستقبال، راجع {log_path}")
+
+            for level in args.levels:
+                stats = LevelStats(level)
+                holder["level"] = stats
+                await asyncio.gather(
+                    *(virtual_user(api, i, args, stats, origin_url, level) for i in range(level))
+                )
+                stats.elapsed = time.perf_counter() - stats.started
+                # سجلات آخر الطلبات قد تصل بعد رد البوت بقليل
+                await asyncio.sleep(0.5)
+                holder.pop("level")
+                results.append(stats.as_dict())
+                r = results[-1]
+                print(
+                    f"c={level}: ok={r['flows_ok']} err={sum(r['errors'].values())} "
+                    f"{r['throughput_per_s']}/s peak={r['peak_rss_mb']}MB"
+                )
+        finally:
+            stop.set()
+            if proc.returncode is None:
+                proc.terminate()
+                try:
+                    await asyncio.wait_for(proc.wait(), 15)
+                except asyncio.TimeoutError:
+                    proc.kill()
+            await reader
+            await sampler
+            await api_runner.cleanup()
+            await origin_runner.cleanup()
+
+    print_report(results)
+    print(f"\nAPI calls: {dict(api.calls)}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "levels": results}, f, indent=2)
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Load test the bot against a mock Bot API")
+    p.add_argument("--levels", type=lambda s: [int(x) for x in s.split(",")], default=[1, 5, 10, 25],
+                   help="concurrency levels (virtual users), run in order")
+    p.add_argument("--iterations", type=int, default=3, help="links sent by each virtual user per level")
+    p.add_argument("--audio-share", type=float, default=0.3, help="fraction of flows that pick audio")
+    p.add_argument("--hot-links", type=int, default=0,
+                   help="draw links from N shared videos (exercises cache/prefetch); 0 = all unique")
+    p.add_argument("--think-ms", type=int, default=0, help="mean pause between a user's flows")
+    p.add_argument("--media-kb", type=int, default=512, help="size of the best video format")
+    p.add_argument("--extract-ms", type=int, default=200, help="mean stub extractor latency")
+    p.add_argument("--extract-fail", type=float, default=0.0, help="stub extractor failure rate")
+    p.add_argument("--origin-kbps", type=int, default=0, help="per-connection origin bandwidth, 0 = unlimited")
+    p.add_argument("--flood-rate", type=float, default=0, help="mock API global limit (calls/s) before 429")
+    p.add_argument("--workers", type=int, default=0, help="WORKER_COUNT for the bot (0 = inline)")
+    p.add_argument("--job-concurrency", type=int, default=4, help="JOB_CONCURRENCY for the bot")
+    p.add_argument("--timeout", type=float, default=120, help="per-step timeout for a virtual user")
+    p.add_argument("--json", help="also write the results to this file")
+    return p.parse_args(argv)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
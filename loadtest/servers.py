@@ -0,0 +1,245 @@
+"""
+خوادم اختبار الحمل: خادم Bot API وهمي يحل محل api.telegram.org، وخادم وسائط محلي
+يخدم ملفات بأحجام محددة بدل مواقع الفيديو الحقيقية.
+"""
+
+import json
+import time
+import asyncio
+import itertools
+import collections
+
+from aiohttp import web
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "LoadTestBot", "username": "loadtest_bot"}
+
+MEDIA_METHODS = {"sendVideo": "video", "sendAudio": "audio", "sendDocument": "document"}
+
+
+class MockBotAPI:
+    """
+    يخدم /bot<token>/<method> بنفس شكل ردود تيليجرام.
+    التحديثات تُضاف بـ push_message / push_callback وتُسلَّم عبر getUpdates (long polling)،
+    وكل ما يرسله البوت يُمرَّر لطابور المحادثة الخاص به (subscribe) كـ
+    (الوقت, method, الرسالة, حجم الملف المرفوع).
+    flood_rate > 0 يحاكي حد تيليجرام العام ويرد بـ 429 و retry_after عند تجاوزه.
+    """
+
+    def __init__(self, flood_rate: float = 0):
+        self.updates: list[dict] = []
+        self.new_update = asyncio.Condition()
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1000)
+        self.callback_ids = itertools.count(1)
+        self.subscribers: dict[int, asyncio.Queue] = {}
+        self.calls: collections.Counter = collections.Counter()
+        self.upload_bytes = 0
+        self.polled = asyncio.Event()
+        self.flood_rate = flood_rate
+        self._flood_window: collections.deque = collections.deque()
+
+    # ---------- جانب المستخدمين الوهميين ----------
+
+    def subscribe(self, chat_id: int) -> asyncio.Queue:
+        q = self.subscribers[chat_id] = asyncio.Queue()
+        return q
+
+    def unsubscribe(self, chat_id: int):
+        self.subscribers.pop(chat_id, None)
+
+    @staticmethod
+    def user(chat_id: int) -> dict:
+        return {"id": chat_id, "is_bot": False, "first_name": f"vu{chat_id}", "username": f"vu{chat_id}"}
+
+    async def _push(self, update: dict):
+        async with self.new_update:
+            update["update_id"] = next(self.update_ids)
+            self.updates.append(update)
+            self.new_update.notify_all()
+
+    async def push_message(self, chat_id: int, text: str):
+        await self._push(
+            {
+                "message": {
+                    "message_id": next(self.message_ids),
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"},
+                    "from": self.user(chat_id),
+                    "text": text,
+                }
+            }
+        )
+
+    async def push_callback(self, chat_id: int, message: dict, data: str):
+        await self._push(
+            {
+                "callback_query": {
+                    "id": str(next(self.callback_ids)),
+                    "from": self.user(chat_id),
+                    "message": message,
+                    "chat_instance": str(chat_id),
+                    "data": data,
+                }
+            }
+        )
+
+    # ---------- جانب البوت ----------
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=1024**3)
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        return app
+
+    async def _read_params(self, request: web.Request) -> tuple[dict, int]:
+        """
+        يرجع المعاملات وحجم الملفات المرفوعة (aiogram يرفعها كأجزاء attach://)
+        """
+        params = dict(request.query)
+        uploaded = 0
+        if request.content_type.startswith("multipart/"):
+            reader = await request.multipart()
+            async for part in reader:
+                if part.filename:
+                    # الملفات تُستهلك وتُعد فقط
+                    size = 0
+                    while chunk := await part.read_chunk(256 * 1024):
+                        size += len(chunk)
+                    uploaded += size
+                else:
+                    params[part.name] = await part.text()
+        elif request.can_read_body:
+            params.update(await request.post())
+        self.upload_bytes += uploaded
+        return params, uploaded
+
+    def _flooded(self) -> bool:
+        if self.flood_rate <= 0:
+            return False
+        now = time.monotonic()
+        while self._flood_window and now - self._flood_window[0] > 1:
+            self._flood_window.popleft()
+        if len(self._flood_window) >= self.flood_rate:
+            return True
+        self._flood_window.append(now)
+        return False
+
+    def _message(self, chat_id: int, message_id: int | None = None, **fields) -> dict:
+        msg = {
+            "message_id": message_id or next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+        }
+        for key, value in fields.items():
+            if value is not None:
+                msg[key] = value
+        return msg
+
+    async def get_updates(self, params: dict) -> list[dict]:
+        self.polled.set()
+        offset = int(params.get("offset") or 0)
+        timeout = min(float(params.get("timeout") or 0), 10)
+        async with self.new_update:
+            # ما قبل offset أكده البوت
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+            if not self.updates and timeout:
+                try:
+                    await asyncio.wait_for(self.new_update.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return list(self.updates)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params, upload_bytes = await self._read_params(request)
+        self.calls[method] += 1
+
+        if method == "getUpdates":
+            return web.json_response({"ok": True, "result": await self.get_updates(params)})
+        if method == "getMe":
+            return web.json_response({"ok": True, "result": BOT_USER})
+
+        if self._flooded():
+            self.calls["429"] += 1
+            return web.json_response(
+                {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": "Too Many Requests: retry after 1",
+                    "parameters": {"retry_after": 1},
+                },
+                status=429,
+            )
+
+        chat_id = int(params.get("chat_id") or 0)
+        markup = params.get("reply_markup")
+        markup = json.loads(markup) if isinstance(markup, str) else markup
+
+        if method in ("sendMessage", "editMessageText", "copyMessage"):
+            message_id = int(params["message_id"]) if method == "editMessageText" else None
+            result = self._message(chat_id, message_id, text=params.get("text"), reply_markup=markup)
+        elif method in MEDIA_METHODS:
+            kind = MEDIA_METHODS[method]
+            file_id = f"{kind}-{next(self.message_ids)}"
+            media = {"file_id": file_id, "file_unique_id": file_id, "duration": 42}
+            if kind == "video":
+                media.update(width=1280, height=720)
+            elif kind == "document":
+                media = {"file_id": file_id, "file_unique_id": file_id}
+            result = self._message(chat_id, caption=params.get("caption"), **{kind: media})
+        else:
+            # sendChatAction, answerCallbackQuery, deleteMessage...
+            return web.json_response({"ok": True, "result": True})
+
+        q = self.subscribers.get(chat_id)
+        if q is not None:
+            q.put_nowait((time.perf_counter(), method, result, upload_bytes))
+        return web.json_response({"ok": True, "result": result})
+
+
+class MediaOrigin:
+    """
+    /media/<kb>/<name> يرجع kb كيلوبايت، مع Content-Length (و HEAD) حتى يعمل مسار
+    الرفع المتدفق. kbps > 0 يحد سرعة كل اتصال لمحاكاة موقع بطيء.
+    """
+
+    CHUNK = 64 * 1024
+
+    def __init__(self, kbps: int = 0):
+        self.kbps = kbps
+        self.block = bytes(range(256)) * (self.CHUNK // 256)
+        self.bytes_served = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/media/{kb}/{name}", self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        size = int(request.match_info["kb"]) * 1024
+        resp = web.StreamResponse(headers={"Content-Type": "video/mp4"})
+        resp.content_length = size
+        await resp.prepare(request)
+        if request.method == "HEAD":
+            await resp.write_eof()
+            return resp
+
+        left = size
+        while left > 0:
+            chunk = self.block[: min(self.CHUNK, left)]
+            await resp.write(chunk)
+            left -= len(chunk)
+            self.bytes_served += len(chunk)
+            if self.kbps:
+                await asyncio.sleep(len(chunk) / (self.kbps * 1024))
+        await resp.write_eof()
+        return resp
+
+
+async def start_site(app: web.Application, host: str = "127.0.0.1", port: int = 0) -> tuple[web.AppRunner, str]:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://{host}:{port}"
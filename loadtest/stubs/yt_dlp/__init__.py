@@ -0,0 +1,126 @@
+"""
+بديل وهمي لـ yt-dlp يستخدمه اختبار الحمل (loadtest/run.py) عبر PYTHONPATH.
+لا يتصل بأي موقع حقيقي: كل الصيغ تشير إلى خادم الوسائط المحلي (LOADTEST_ORIGIN)،
+وزمن الاستخراج ونسبة الفشل قابلان للضبط من متغيرات البيئة.
+"""
+
+import os
+import time
+import random
+import urllib.request
+from urllib.parse import urlparse
+
+from . import utils
+from . import extractor
+
+__version__ = "loadtest-stub"
+
+CHUNK = 64 * 1024
+
+
+def _env_int(name: str, default: int) -> int:
+    return int(os.getenv(name, str(default)))
+
+
+def build_info(url: str) -> dict:
+    origin = os.environ["LOADTEST_ORIGIN"].rstrip("/")
+    video_id = urlparse(url).path.rstrip("/").rsplit("/", 1)[-1] or "video"
+    media_kb = _env_int("LOADTEST_MEDIA_KB", 512)
+    heights = [int(h) for h in os.getenv("LOADTEST_HEIGHTS", "720,360").split(",") if h]
+
+    formats = [
+        {
+            "format_id": "audio",
+            "ext": "m4a",
+            "url": f"{origin}/media/{max(1, media_kb // 4)}/{video_id}.m4a",
+            "filesize": max(1, media_kb // 4) * 1024,
+            "vcodec": "none",
+            "acodec": "mp4a.40.2",
+            "protocol": "http",
+        }
+    ]
+    for h in sorted(heights):
+        kb = max(1, media_kb * h // max(heights))
+        formats.append(
+            {
+                "format_id": f"h{h}",
+                "ext": "mp4",
+                "height": h,
+                "url": f"{origin}/media/{kb}/{video_id}-{h}.mp4",
+                "filesize": kb * 1024,
+                "vcodec": "avc1",
+                "acodec": "mp4a.40.2",
+                "protocol": "http",
+            }
+        )
+
+    best = formats[-1]
+    return {
+        "id": video_id,
+        "title": f"Load test video {video_id}",
+        "duration": 42,
+        "uploader": "loadtest",
+        "view_count": 0,
+        "thumbnail": "",
+        "webpage_url": url,
+        "formats": formats,
+        **{k: best[k] for k in ("url", "ext", "filesize", "format_id", "vcodec", "acodec", "protocol")},
+    }
+
+
+def select_format(info: dict, spec: str | None) -> dict:
+    formats = info["formats"]
+    if spec:
+        if spec.startswith("bestaudio"):
+            return formats[0]
+        for f in formats:
+            if f["format_id"] == spec:
+                return f
+    return formats[-1]
+
+
+def fetch(url: str, write, hooks=()):
+    downloaded = 0
+    with urllib.request.urlopen(url, timeout=60) as r:
+        total = int(r.headers.get("Content-Length") or 0)
+        while True:
+            chunk = r.read(CHUNK)
+            if not chunk:
+                break
+            write(chunk)
+            downloaded += len(chunk)
+            for hook in hooks:
+                hook({"status": "downloading", "downloaded_bytes": downloaded, "total_bytes": total})
+    for hook in hooks:
+        hook({"status": "finished", "downloaded_bytes": downloaded, "total_bytes": total})
+
+
+class YoutubeDL:
+    def __init__(self, params: dict | None = None):
+        self.params = params or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def extract_info(self, url: str, download: bool = True) -> dict:
+        delay_ms = _env_int("LOADTEST_EXTRACT_MS", 200)
+        time.sleep(random.uniform(0.5, 1.5) * delay_ms / 1000)
+        if random.random() < float(os.getenv("LOADTEST_EXTRACT_FAIL", "0")):
+            raise utils.DownloadError("ERROR: [loadtest] simulated extractor failure")
+        info = build_info(url)
+        if download:
+            self.download([url])
+        return info
+
+    def download(self, urls: list[str]) -> int:
+        for url in urls:
+            info = build_info(url)
+            fmt = select_format(info, self.params.get("format"))
+            outtmpl = self.params.get("outtmpl") or "%(id)s.%(ext)s"
+            path = outtmpl.replace("%(ext)s", fmt["ext"]).replace("%(id)s", info["id"])
+            with open(path, "wb") as f:
+                fetch(fmt["url"], f.write, self.params.get("progress_hooks") or ())
+        return 0
@@ -0,0 +1,39 @@
+"""
+python -m yt_dlp -f <format> -o - <url>: نفس ما يستخدمه البوت للرفع المتدفق
+"""
+
+import sys
+
+from . import build_info, select_format, fetch
+
+
+def main(argv: list[str]) -> int:
+    fmt = None
+    out = None
+    args = iter(argv)
+    url = None
+    for arg in args:
+        if arg == "-f":
+            fmt = next(args)
+        elif arg == "-o":
+            out = next(args)
+        elif arg == "--socket-timeout":
+            next(args)
+        elif not arg.startswith("-"):
+            url = arg
+    if not url:
+        print("ERROR: no url", file=sys.stderr)
+        return 2
+
+    f = select_format(build_info(url), fmt)
+    if out == "-":
+        fetch(f["url"], sys.stdout.buffer.write)
+        sys.stdout.buffer.flush()
+    else:
+        with open(out or f"{f['format_id']}.{f['ext']}", "wb") as fh:
+            fetch(f["url"], fh.write)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
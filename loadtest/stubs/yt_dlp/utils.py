@@ -0,0 +1,6 @@
+class DownloadError(Exception):
+    pass
+
+
+class DownloadCancelled(Exception):
+    pass
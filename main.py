@@ -1,21 +1,64 @@
+import time
+
+# بداية الإقلاع، لقياس زمن الاستيراد ضمن تفصيل زمن التشغيل
+_BOOT_STARTED = time.perf_counter()
+
 import os
+import re
+import sys
+import io
+import csv
+import gzip
+import json
+import importlib
+import uuid
+import queue
+import atexit
 import asyncio
-import requests
-import yt_dlp
+import logging
+import logging.handlers
+import contextvars
+import shutil
+import tempfile
+import signal
+import socket
+import hashlib
+import hmac
+import base64
+import random
+import functools
+import threading
+import multiprocessing
+import subprocess
+import concurrent.futures
+import collections
 import sqlite3
-from datetime import datetime
-from urllib.parse import urlparse
+from contextlib import closing, contextmanager
+from datetime import datetime, timedelta
+from urllib.parse import urlparse, urlunparse, parse_qs, urlencode
 
 from aiogram import Bot, Dispatcher, Router, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import Command
 from aiogram.types import (
+    InputFile,
     Message,
     FSInputFile,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     CallbackQuery,
+    BufferedInputFile,
 )
 from aiogram.enums import ChatAction
+from aiogram.exceptions import (
+    TelegramRetryAfter,
+    TelegramForbiddenError,
+    TelegramBadRequest,
+    TelegramNetworkError,
+    TelegramServerError,
+)
+from aiogram.methods import Response
 
 # ============ إعدادات البوت ============
 
@@ -23,7 +66,74 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     raise ValueError("❌ BOT_TOKEN غير موجود في متغيرات البيئة! تأكد من إضافته في Replit أو السيرفر.")
 
-bot = Bot(token=BOT_TOKEN)
+# ============ الإقلاع السريع: تفصيل الزمن + استيراد كسول ============
+
+# مراحل التشغيل بالميلي ثانية (تظهر في السجل وفي أمر /startup)
+STARTUP_TIMINGS: dict[str, float] = {"imports": round((time.perf_counter() - _BOOT_STARTED) * 1000, 1)}
+
+
+def mark_startup(stage: str, started: float):
+    STARTUP_TIMINGS[stage] = round((time.perf_counter() - started) * 1000, 1)
+
+
+class LazyModule:
+    """
+    وحدة تُستورد عند أول استخدام (أو مسبقًا في خيط الإحماء)، آمنة بين الخيوط.
+    yt-dlp وحده يستغرق مئات الميلي ثانية لتحميل المستخرجات، فلا نؤخر بدء الاستقبال بسببه.
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    started = time.perf_counter()
+                    self._module = importlib.import_module(self._name)
+                    mark_startup(f"import_{self._name}", started)
+        return self._module
+
+    def __getattr__(self, attr: str):
+        return getattr(self.load(), attr)
+
+
+yt_dlp = LazyModule("yt_dlp")
+requests = LazyModule("requests")
+
+
+def warm_up_heavy_modules():
+    """
+    يُشغَّل في خيط خلفي بعد بدء الاستقبال: يستورد yt-dlp ويحمّل كل المستخرجات مسبقًا
+    حتى لا يدفع أول مستخدم بعد إعادة التشغيل هذا الثمن
+    """
+    try:
+        requests.load()
+        yt_dlp.load()
+        started = time.perf_counter()
+        importlib.import_module("yt_dlp.extractor").gen_extractor_classes()
+        with yt_dlp.YoutubeDL(ydl_opts):
+            pass
+        mark_startup("warm_extractors", started)
+        log.info("startup_warm_done", extra={"fields": {"timings_ms": STARTUP_TIMINGS}})
+    except Exception as e:
+        log.warning("warm up error: %s", e)
+
+
+def start_warm_up():
+    threading.Thread(target=warm_up_heavy_modules, name="warm-up", daemon=True).start()
+
+
+_bot_init_started = time.perf_counter()
+# خادم Bot API بديل (خادم محلي، أو الخادم الوهمي في loadtest/)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+if TELEGRAM_API_URL:
+    bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+else:
+    bot = Bot(token=BOT_TOKEN)
+mark_startup("bot_init", _bot_init_started)
 dp = Dispatcher()
 router = Router()
 dp.include_router(router)
@@ -48,9 +158,6 @@ BANNED_USERS: set[int] = set()
 # عدّل هذا لِـ User ID تبعك في تيليجرام
 ADMIN_IDS = {1601160612}
 
-# حالات المستخدمين (لاختيار النوع والجودة)
-USER_STATE: dict[int, dict] = {}
-
 # إعدادات yt-dlp
 ydl_opts = {
     "format": "best[height<=720][filesize<50M]/best[height<=480]/best[height<=360]",
@@ -63,160 +170,1059 @@ ydl_opts = {
     "noplaylist": True,
 }
 
+# ============ السجلات (logging) ============
+
+log = logging.getLogger("bot")
+
+# معرّف التتبّع للطلب الحالي، ومجموع أزمنة المراحل (extract / download / upload / db)
+TRACE_ID: contextvars.ContextVar[str] = contextvars.ContextVar("trace_id", default="-")
+TRACE_SPANS: contextvars.ContextVar[dict | None] = contextvars.ContextVar("trace_spans", default=None)
+
+_log_listener: logging.handlers.QueueListener | None = None
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    يحوّل كل سجل إلى سطر JSON واحد مع trace_id والحقول الإضافية (extra={"fields": {...}})
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": datetime.utcfromtimestamp(record.created).isoformat(timespec="milliseconds") + "Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.processName,
+            "trace_id": TRACE_ID.get(),
+            "msg": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            payload.update(fields)
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+def setup_logging():
+    """
+    السجلات تُنسَّق في نفس سياق الطلب (لقراءة trace_id) ثم تُرمى في طابور،
+    والكتابة الفعلية على stdout تتم في خيط منفصل حتى لا تُعطّل حلقة الأحداث.
+    """
+    global _log_listener
+    if _log_listener is not None:
+        return
+
+    q: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(q)
+    queue_handler.setFormatter(JsonFormatter())
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter("%(message)s"))
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+
+    _log_listener = logging.handlers.QueueListener(q, stream_handler, respect_handler_level=False)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex[:12]
+
+
+def bind_trace(trace_id: str | None = None) -> str:
+    """
+    يربط trace_id بالمهمة الحالية (كل handler في aiogram يعمل في مهمة مستقلة)
+    """
+    trace_id = trace_id or new_trace_id()
+    TRACE_ID.set(trace_id)
+    TRACE_SPANS.set({})
+    return trace_id
+
+
+@contextmanager
+def span(name: str, **fields):
+    """
+    يقيس زمن مرحلة ويسجّله، ويجمعه في TRACE_SPANS للطلب الحالي
+    """
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        ms = (time.perf_counter() - start) * 1000
+        spans = TRACE_SPANS.get()
+        if spans is not None:
+            spans[name] = spans.get(name, 0.0) + ms
+        log.debug(
+            "span",
+            extra={"fields": {"span": name, "ms": round(ms, 1), "status": status, **fields}},
+        )
+
+
+def traced(name: str):
+    """
+    decorator لقياس دالة متزامنة كاملة كمرحلة واحدة
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, func=func.__name__):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def log_trace_summary(event: str, **fields):
+    spans = TRACE_SPANS.get() or {}
+    log.info(
+        event,
+        extra={"fields": {**fields, "spans_ms": {k: round(v, 1) for k, v in spans.items()}}},
+    )
+
+
+# ============ المُحلِّل بأخذ العيّنات (profiler) ============
+
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.01"))
+PROFILE_MAX_SECONDS = 300
+PROFILE_TOP_N = 40
+
+
+class SamplingProfiler:
+    """
+    خيط خلفي يأخذ لقطة من مكدّس كل الخيوط (حلقة الأحداث + خيوط العمل) كل interval ثانية.
+    لا يحتاج أي مكتبة خارجية، والكلفة تقريبًا ثابتة لكل عيّنة.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks: collections.Counter = collections.Counter()
+        self.samples = 0
+        self.started_at = 0.0
+        self.stopped_at = 0.0
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    @staticmethod
+    def _frame_label(code) -> str:
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        names: dict[int, str] = {}
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            if any(tid not in names for tid in frames):
+                names = {t.ident: t.name for t in threading.enumerate()}
+            for tid, frame in frames.items():
+                if tid == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._frame_label(frame.f_code))
+                    frame = frame.f_back
+                stack.reverse()
+                self.stacks[(names.get(tid, str(tid)), tuple(stack))] += 1
+            self.samples += 1
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.stopped_at = time.perf_counter()
+
+    def collapsed(self) -> str:
+        """
+        صيغة collapsed stacks (thread;frame;frame count) الجاهزة لـ flamegraph.pl أو speedscope
+        """
+        lines = []
+        for (thread_name, stack), count in self.stacks.most_common():
+            frames = ";".join(f.replace(";", ":") for f in stack)
+            lines.append(f"{thread_name};{frames} {count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self, top_n: int = PROFILE_TOP_N) -> str:
+        self_counts: collections.Counter = collections.Counter()
+        total_counts: collections.Counter = collections.Counter()
+        for (_thread_name, stack), count in self.stacks.items():
+            if not stack:
+                continue
+            self_counts[stack[-1]] += count
+            for label in set(stack):
+                total_counts[label] += count
+
+        total = sum(self.stacks.values()) or 1
+        duration = self.stopped_at - self.started_at
+        lines = [
+            f"duration: {duration:.1f}s | ticks: {self.samples} | stack samples: {total}",
+            "",
+            f"top {top_n} by self time:",
+        ]
+        for label, count in self_counts.most_common(top_n):
+            lines.append(f"{count * 100 / total:6.2f}%  {count:7d}  {label}")
+        lines += ["", f"top {top_n} by total time:"]
+        for label, count in total_counts.most_common(top_n):
+            lines.append(f"{count * 100 / total:6.2f}%  {count:7d}  {label}")
+        return "\n".join(lines) + "\n"
+
+
+PROFILE_LOCK = asyncio.Lock()
+
+# العمّال عمليات منفصلة: /profile يصلهم عبر جدول profile_requests الذي يراقبه كل عامل
+# (المُشغَّل من البوت أو المستقل بـ python main.py worker)
+PROFILE_POLL_INTERVAL = 1.0
+# طلب أقدم من هذا (العامل كان متوقفًا أو مشغولًا بتحليل آخر) لا يُنفَّذ
+PROFILE_REQUEST_TTL = 30
+PROFILE_TARGETS = ("all", "bot", "workers")
+
+
+async def run_profile(chat_id: int, seconds: int, label: str):
+    """
+    يحلل العملية الحالية seconds ثانية ويرسل الملفين إلى chat_id
+    """
+    async with PROFILE_LOCK:
+        profiler = SamplingProfiler()
+        profiler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.stop()
+
+        stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+        log.info(
+            "profile_done",
+            extra={"fields": {"seconds": seconds, "ticks": profiler.samples, "process": label}},
+        )
+        await bot.send_document(
+            chat_id,
+            BufferedInputFile(profiler.collapsed().encode("utf-8"), filename=f"profile-{label}-{stamp}.collapsed"),
+            caption=f"🔥 {label}: collapsed stacks (flamegraph.pl / speedscope)",
+        )
+        await bot.send_document(
+            chat_id,
+            BufferedInputFile(profiler.summary().encode("utf-8"), filename=f"profile-{label}-{stamp}-top.txt"),
+            caption=f"📈 {label}: أكثر الدوال استهلاكًا خلال {seconds} ثانية",
+        )
+
+
+def request_worker_profile(chat_id: int, seconds: int) -> int:
+    now = time.time()
+    with closing(get_conn()) as conn:
+        c = conn.cursor()
+        c.execute(
+            "INSERT INTO profile_requests (chat_id, seconds, created_at) VALUES (?, ?, ?);",
+            (chat_id, seconds, now),
+        )
+        request_id = c.lastrowid
+        c.execute("DELETE FROM profile_requests WHERE created_at < ?;", (now - 24 * 3600,))
+        conn.commit()
+    return request_id
+
+
+def fetch_profile_requests(after_id: int) -> list[tuple]:
+    with closing(get_conn()) as conn:
+        rows = conn.execute(
+            "SELECT id, chat_id, seconds, created_at FROM profile_requests WHERE id > ? ORDER BY id;",
+            (after_id,),
+        ).fetchall()
+    return rows
+
+
+async def profile_request_loop(label: str, stop: asyncio.Event):
+    """
+    يعمل داخل كل عامل: يبدأ من آخر طلب موجود حتى لا ينفّذ طلبات قديمة بعد إعادة التشغيل
+    """
+    rows = await asyncio.to_thread(fetch_profile_requests, 0)
+    last_id = rows[-1][0] if rows else 0
+    tasks: set[asyncio.Task] = set()
+    while not stop.is_set():
+        await _wait_or_stop(stop, PROFILE_POLL_INTERVAL)
+        try:
+            rows = await asyncio.to_thread(fetch_profile_requests, last_id)
+        except Exception as e:
+            log.warning("profile requests poll error: %s", e)
+            continue
+        for request_id, chat_id, seconds, created_at in rows:
+            last_id = request_id
+            if time.time() - created_at > PROFILE_REQUEST_TTL or PROFILE_LOCK.locked():
+                log.info("profile_request_skipped", extra={"fields": {"request_id": request_id}})
+                continue
+            task = asyncio.create_task(run_profile(chat_id, seconds, label))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    for task in tasks:
+        task.cancel()
+
+
+# ============ محدّد المعدل (token bucket) ============
+
+
+class TokenBucket:
+    """
+    دلو رموز بالحجز: كل طالب يخصم حصته فورًا (قد يصبح الرصيد سالبًا) وينتظر
+    الزمن اللازم لتعويضه، فيُخدم الطالبون بترتيب وصولهم.
+    rate <= 0 يعني بدون حد. يعمل من حلقة الأحداث (acquire) ومن الخيوط (acquire_blocking).
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self._lock = threading.Lock()
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def set_rate(self, rate: float, capacity: float | None = None):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = rate
+            self.capacity = capacity if capacity is not None else max(rate, 1)
+            self.tokens = min(self.tokens, self.capacity)
+
+    def _refill(self, now: float):
+        if self.rate > 0:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float = 1) -> float:
+        """
+        يحجز amount ويرجع عدد الثواني الواجب انتظارها
+        """
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self.paused_until - now)
+            if self.rate <= 0:
+                return wait
+            self._refill(now)
+            self.tokens -= amount
+            if self.tokens < 0:
+                wait = max(wait, -self.tokens / self.rate)
+            return wait
+
+    def pause(self, seconds: float):
+        """
+        إيقاف كل الطالبين مؤقتًا (مثلًا بعد 429 مع retry_after)
+        """
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, amount: float = 1):
+        wait = self.reserve(amount)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def acquire_blocking(self, amount: float = 1):
+        wait = self.reserve(amount)
+        if wait > 0:
+            time.sleep(wait)
+
+
+# ============ جدولة الطلبات الصادرة إلى تيليجرام ============
+
+# حدود تيليجرام: ~30 رسالة/ثانية للبوت كله، وحوالي رسالة/ثانية لكل محادثة مع سماح بدفعات قصيرة
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_CHAT_BURST = 10
+# الحد العام يُقسم بين الواجهة والعمّال بالأوزان: الواجهة ترسل كل الرسائل التفاعلية، والعامل يرفع غالبًا
+OUTBOUND_FRONTEND_WEIGHT = float(os.getenv("OUTBOUND_FRONTEND_WEIGHT", "3"))
+# الرفع ثقيل وطويل؛ له مسار خاص بعدد محدود حتى لا يزاحم الرسائل التفاعلية
+OUTBOUND_UPLOAD_CONCURRENCY = int(os.getenv("OUTBOUND_UPLOAD_CONCURRENCY", "4"))
+OUTBOUND_MAX_RETRIES = 3
+# انتظار أطول من هذا لا يفيد المستخدم؛ نرمي الخطأ بدلًا منه
+OUTBOUND_MAX_RETRY_AFTER = 60
+# مؤشر الكتابة/الرفع يبقى ظاهرًا ~5 ثوانٍ، فلا داعي لتكراره أسرع من ذلك
+CHAT_ACTION_TTL = 4
+OUTBOUND_MAX_CHATS = 10000
+# عدد المحادثات المختلفة التي تأخذ 429 خلال ثانية قبل اعتبار الحد عامًا
+OUTBOUND_GLOBAL_FLOOD_CHATS = 3
+
+# True داخل مسار يتعامل مع 429 بنفسه (البث): تُرمى له بدل إعادة الطلب هنا
+OUTBOUND_SELF_PACED: contextvars.ContextVar[bool] = contextvars.ContextVar("outbound_self_paced", default=False)
+
+# طلبات لا تخضع لحدود الرسائل
+OUTBOUND_EXEMPT = {"getUpdates", "getMe", "deleteWebhook", "getFile", "answerCallbackQuery", "sendChatAction"}
+# طلبات يمكن إعادتها بأمان بعد خطأ شبكة (تكرارها لا يرسل شيئًا مرتين)
+OUTBOUND_IDEMPOTENT = {
+    "getMe",
+    "getFile",
+    "getChat",
+    "deleteWebhook",
+    "answerCallbackQuery",
+    "sendChatAction",
+    "editMessageText",
+    "editMessageCaption",
+    "editMessageReplyMarkup",
+    "deleteMessage",
+}
+OUTBOUND_EDITS = {"editMessageText", "editMessageCaption", "editMessageReplyMarkup"}
+OUTBOUND_UPLOADS = {"sendVideo", "sendAudio", "sendDocument", "sendPhoto"}
+
+
+class OutboundScheduler:
+    """
+    middleware على جلسة البوت: كل طلب صادر (answer, edit_text, answer_video...) يمر من هنا.
+    - دلو عام ودلو لكل محادثة قبل الإرسال
+    - 429: إيقاف الدلو المعني retry_after ثم إعادة الطلب (الطلب المرفوض لم يُنفذ أصلًا)
+    - أخطاء الشبكة/الخادم: إعادة الطلبات الآمنة فقط
+    - تعديلات نفس الرسالة المنتظرة تُدمج في آخرها، والتعديل المطابق لما أُرسل يُتخطى
+    - الرفع في مسار منفصل بعدد متزامن محدود
+    """
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(OUTBOUND_GLOBAL_RATE)
+        self.chat_buckets: collections.OrderedDict = collections.OrderedDict()
+        self.upload_slots = asyncio.Semaphore(OUTBOUND_UPLOAD_CONCURRENCY)
+        # (method, chat, message) -> {"method", "future", "followers"}
+        self.pending_edits: dict[tuple, dict] = {}
+        # آخر محتوى أُرسل لكل رسالة، ووقت آخر مؤشر لكل محادثة
+        self.last_edits: collections.OrderedDict = collections.OrderedDict()
+        self.last_actions: dict[tuple, float] = {}
+        self.recent_floods: collections.deque = collections.deque()
+
+    def set_share(self, workers: int, frontend: bool):
+        """
+        العمّال عمليات منفصلة لكل منها جدولها؛ الحد العام يُقسم بينها بالأوزان
+        (الواجهة OUTBOUND_FRONTEND_WEIGHT وكل عامل 1)
+        """
+        weight = OUTBOUND_FRONTEND_WEIGHT if frontend else 1
+        self.global_bucket.set_rate(OUTBOUND_GLOBAL_RATE * weight / (OUTBOUND_FRONTEND_WEIGHT + workers))
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST)
+            if len(self.chat_buckets) > OUTBOUND_MAX_CHATS:
+                self.chat_buckets.popitem(last=False)
+        else:
+            self.chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    def _on_flood(self, chat_id, retry_after: float):
+        now = time.monotonic()
+        if chat_id is not None:
+            self._chat_bucket(chat_id).pause(retry_after)
+        while self.recent_floods and now - self.recent_floods[0][0] > 1:
+            self.recent_floods.popleft()
+        self.recent_floods.append((now, chat_id))
+        chats = {c for _t, c in self.recent_floods}
+        if chat_id is None or len(chats) >= OUTBOUND_GLOBAL_FLOOD_CHATS:
+            self.global_bucket.pause(retry_after)
+
+    async def _send(self, make_request, bot, method, name: str, chat_id, admitted: bool = False):
+        retryable = name in OUTBOUND_IDEMPOTENT
+        # الملف المتدفق يُقرأ مرة واحدة فقط
+        replayable = not any(isinstance(v, StreamingInputFile) for v in vars(method).values())
+        self_paced = OUTBOUND_SELF_PACED.get()
+        attempt = 0
+        while True:
+            if name not in OUTBOUND_EXEMPT and not admitted:
+                if chat_id is not None:
+                    await self._chat_bucket(chat_id).acquire()
+                await self.global_bucket.acquire()
+            admitted = False
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self._on_flood(chat_id, e.retry_after)
+                log.warning(
+                    "outbound_flood_wait",
+                    extra={"fields": {"method": name, "chat_id": chat_id, "retry_after": e.retry_after}},
+                )
+                if (
+                    self_paced
+                    or attempt >= OUTBOUND_MAX_RETRIES
+                    or e.retry_after > OUTBOUND_MAX_RETRY_AFTER
+                    or not replayable
+                ):
+                    if name == "sendChatAction":
+                        # المؤشر شكلي فقط؛ لا يُفشل الطلب بسببه
+                        return Response(ok=True, result=True)
+                    raise
+                await asyncio.sleep(e.retry_after)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                if not retryable or attempt >= OUTBOUND_MAX_RETRIES:
+                    raise
+                log.debug("outbound retry %s: %s", name, e)
+                await asyncio.sleep(2**attempt)
+            attempt += 1
+
+    async def _send_edit(self, make_request, bot, method, name: str, chat_id):
+        key = (name, chat_id, getattr(method, "message_id", None), getattr(method, "inline_message_id", None))
+        # repr وليس JSON: الحقول قد تحمل قيم Default الخاصة بـ aiogram
+        signature = repr(method)
+        last = self.last_edits.get(key)
+        if last is not None and last[0] == signature:
+            # نفس المحتوى المعروض حاليًا؛ تيليجرام كان سيرد بـ "message is not modified"
+            return last[1]
+
+        entry = self.pending_edits.get(key)
+        if entry is not None:
+            # تعديل أحدث لنفس الرسالة وهو ما زال ينتظر دوره: يحل محله ويأخذ نفس النتيجة
+            entry["method"] = method
+            entry["followers"] += 1
+            try:
+                return await asyncio.shield(entry["future"])
+            except asyncio.CancelledError:
+                if not entry["future"].cancelled() or asyncio.current_task().cancelling():
+                    raise
+            # صاحب الدور أُلغي قبل أن يكمل: يُعاد الطلب بأحدث محتوى
+            return await self._send_edit(make_request, bot, entry["method"], name, chat_id)
+
+        entry = {"method": method, "future": asyncio.get_running_loop().create_future(), "followers": 0}
+        self.pending_edits[key] = entry
+        try:
+            try:
+                if chat_id is not None:
+                    await self._chat_bucket(chat_id).acquire()
+                await self.global_bucket.acquire()
+            finally:
+                # بعد الحصول على الدور لا يُدمج أي تعديل جديد في هذا
+                self.pending_edits.pop(key, None)
+
+            method = entry["method"]
+            response = await self._send(make_request, bot, method, name, chat_id, admitted=True)
+        except asyncio.CancelledError:
+            # لا يبقى المنتظرون معلّقين على مستقبل لن يُحل أبدًا
+            entry["future"].cancel()
+            raise
+        except BaseException as e:
+            if entry["followers"] and not entry["future"].done():
+                entry["future"].set_exception(e)
+            raise
+        entry["future"].set_result(response)
+        self.last_edits[key] = (repr(method), response)
+        if len(self.last_edits) > OUTBOUND_MAX_CHATS:
+            self.last_edits.popitem(last=False)
+        return response
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        chat_id = getattr(method, "chat_id", None)
+
+        if name == "sendChatAction":
+            key = (chat_id, method.action)
+            now = time.monotonic()
+            if now - self.last_actions.get(key, 0) < CHAT_ACTION_TTL:
+                return Response(ok=True, result=True)
+            self.last_actions[key] = now
+            if len(self.last_actions) > OUTBOUND_MAX_CHATS:
+                self.last_actions.clear()
+
+        if name in OUTBOUND_EDITS:
+            return await self._send_edit(make_request, bot, method, name, chat_id)
+        if name in OUTBOUND_UPLOADS:
+            async with self.upload_slots:
+                return await self._send(make_request, bot, method, name, chat_id)
+        return await self._send(make_request, bot, method, name, chat_id)
+
+
+OUTBOUND = OutboundScheduler()
+bot.session.middleware(OUTBOUND)
+
+
 # ============ إعدادات قاعدة البيانات ============
 
 DB_FILE = "bot.db"
 
+# ارفع الرقم عند أي تعديل على الجداول حتى يُعاد تنفيذ init_db
+SCHEMA_VERSION = 11
+
 
 def get_conn():
-    return sqlite3.connect(DB_FILE)
+    # timeout أطول لأن عدة عمليات (الواجهة + العمّال) تكتب على نفس الملف
+    return sqlite3.connect(DB_FILE, timeout=30)
 
 
-def init_db():
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("PRAGMA foreign_keys = ON;")
-
-    # جدول المستخدمين
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            telegram_id INTEGER UNIQUE,
-            username TEXT,
-            first_name TEXT,
-            last_name TEXT,
-            created_at TEXT,
-            last_seen_at TEXT,
-            total_requests INTEGER DEFAULT 0
-        );
-    """)
-
-    # جدول الطلبات
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS requests (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            url TEXT,
-            domain TEXT,
-            action_type TEXT,
-            quality TEXT,
-            status TEXT,
-            error TEXT,
-            created_at TEXT,
-            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE SET NULL
-        );
-    """)
-    c.execute("CREATE INDEX IF NOT EXISTS idx_requests_domain ON requests(domain);")
-    c.execute("CREATE INDEX IF NOT EXISTS idx_requests_status ON requests(status);")
-    c.execute("CREATE INDEX IF NOT EXISTS idx_requests_user ON requests(user_id);")
-
-    # جدول المستخدمين المحظورين
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS banned_users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            telegram_id INTEGER UNIQUE,
-            reason TEXT,
-            banned_at TEXT
-        );
-    """)
-
-    # جدول الفيديوهات
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS videos (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            title TEXT,
-            url TEXT UNIQUE,
-            domain TEXT,
-            first_seen_at TEXT,
-            last_used_at TEXT,
-            times_used INTEGER DEFAULT 0
-        );
-    """)
-
-    # جدول المواقع المحظورة الإضافية
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS blocked_domains (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            domain TEXT UNIQUE,
-            reason TEXT,
-            added_at TEXT
-        );
-    """)
-
-    conn.commit()
-    conn.close()
+def _add_column(c: sqlite3.Cursor, table: str, column: str, decl: str):
+    c.execute(f"PRAGMA table_info({table});")
+    if column not in {row[1] for row in c.fetchall()}:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl};")
+
+
+def init_db() -> bool:
+    """
+    ينشئ الجداول فقط عندما يختلف PRAGMA user_version عن SCHEMA_VERSION
+    (إعادة التشغيل العادية لا تنفّذ أي DDL). يرجع True لو نُفّذ الإنشاء.
+    """
+    with closing(get_conn()) as conn:
+        c = conn.cursor()
+        c.execute("PRAGMA user_version;")
+        old_version = c.fetchone()[0]
+        if old_version == SCHEMA_VERSION:
+            return False
+
+        c.execute("PRAGMA foreign_keys = ON;")
+        # WAL يسمح بالقراءة أثناء الكتابة بين العمليات
+        c.execute("PRAGMA journal_mode = WAL;")
+
+        # جدول المستخدمين
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                telegram_id INTEGER UNIQUE,
+                username TEXT,
+                first_name TEXT,
+                last_name TEXT,
+                created_at TEXT,
+                last_seen_at TEXT,
+                total_requests INTEGER DEFAULT 0
+            );
+        """)
+
+        # جدول الطلبات
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS requests (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                url TEXT,
+                domain TEXT,
+                action_type TEXT,
+                quality TEXT,
+                status TEXT,
+                error TEXT,
+                created_at TEXT,
+                FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE SET NULL
+            );
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_requests_domain ON requests(domain);")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_requests_status ON requests(status);")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_requests_user ON requests(user_id);")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_requests_created ON requests(created_at);")
+        # تاريخ دومين واحد في نافذة زمنية (توقع التحميل المسبق، /perf لدومين محدد)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_requests_domain_created ON requests(domain, created_at);")
+
+        # جدول المستخدمين المحظورين
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS banned_users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                telegram_id INTEGER UNIQUE,
+                reason TEXT,
+                banned_at TEXT
+            );
+        """)
+
+        # جدول الفيديوهات
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS videos (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                title TEXT,
+                url TEXT UNIQUE,
+                domain TEXT,
+                first_seen_at TEXT,
+                last_used_at TEXT,
+                times_used INTEGER DEFAULT 0
+            );
+        """)
+
+        # جدول المواقع المحظورة الإضافية
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS blocked_domains (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                domain TEXT UNIQUE,
+                reason TEXT,
+                added_at TEXT
+            );
+        """)
+
+        # سجل تعديلات الحظر: كل عملية تطبّق الصفوف الأحدث من آخر id رأته
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS moderation_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                value TEXT NOT NULL,
+                op TEXT NOT NULL,
+                created_at REAL
+            );
+        """)
+
+        # طلبات /profile للعمّال: كل عامل يحلل نفسه ويرسل النتيجة للأدمن
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS profile_requests (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER,
+                seconds INTEGER,
+                created_at REAL
+            );
+        """)
+
+        # طابور المهام الدائم بين الواجهة والعمّال
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                attempts INTEGER DEFAULT 0,
+                max_attempts INTEGER DEFAULT 3,
+                available_at REAL NOT NULL,
+                lease_owner TEXT,
+                lease_until REAL,
+                last_error TEXT,
+                created_at TEXT,
+                updated_at TEXT
+            );
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_claim ON jobs(status, available_at);")
+
+        # نتائج كل طريقة إرسال لكل دومين (عدّادات متناقصة + متوسط زمن متحرك)
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS strategy_stats (
+                domain TEXT NOT NULL,
+                strategy TEXT NOT NULL,
+                attempts REAL DEFAULT 0,
+                successes REAL DEFAULT 0,
+                ewma_ms REAL,
+                updated_at TEXT,
+                PRIMARY KEY (domain, strategy)
+            );
+        """)
+
+        # جلسات الروابط: أزرار النوع/الجودة تشير إليها، فتعمل من أي عملية وبعد إعادة التشغيل
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS link_sessions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                telegram_id INTEGER,
+                user_db_id INTEGER,
+                url TEXT,
+                platform_name TEXT,
+                video_info TEXT,
+                trace_id TEXT,
+                created_at REAL
+            );
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_link_sessions_created ON link_sessions(created_at);")
+
+        # حدود التحميل المعدلة من الأدمن (فوق القيم الافتراضية في الكود)
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS origin_limits (
+                domain TEXT PRIMARY KEY,
+                concurrency INTEGER,
+                kbps INTEGER,
+                updated_at TEXT
+            );
+        """)
+
+        # البث الجماعي: التقدم محفوظ (last_user_id) حتى يُستأنف بعد أي انقطاع
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                admin_id INTEGER,
+                from_chat_id INTEGER,
+                message_id INTEGER,
+                text TEXT,
+                status TEXT DEFAULT 'running',
+                last_user_id INTEGER DEFAULT 0,
+                sent INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                blocked INTEGER DEFAULT 0,
+                created_at TEXT,
+                updated_at TEXT
+            );
+        """)
+        # المستخدمون الذين حظروا البوت (يُتخطون في البث حتى يراسلوا البوت من جديد)
+        _add_column(c, "users", "blocked_at", "TEXT")
+
+        # أزمنة المراحل والحجم والطريقة لكل طلب (لتقرير /perf)
+        for column, decl in (
+            ("extract_ms", "REAL"),
+            ("download_ms", "REAL"),
+            ("upload_ms", "REAL"),
+            ("bytes", "INTEGER"),
+            ("strategy", "TEXT"),
+        ):
+            _add_column(c, "requests", column, decl)
+
+        if old_version < 2:
+            # توحيد الدومينات القديمة حتى لا تنقسم الإحصائيات بين www. و m.
+            # (قواعد البيانات من قبل user_version كلها 0؛ على قاعدة جديدة لا يغيّر شيئًا)
+            for table in ("requests", "videos"):
+                c.execute(f"SELECT DISTINCT domain FROM {table} WHERE domain IS NOT NULL AND domain <> '';")
+                for (domain,) in c.fetchall():
+                    target = canonical_domain(f"https://{domain}/")
+                    if target and target != domain:
+                        c.execute(f"UPDATE {table} SET domain = ? WHERE domain = ?;", (target, domain))
+
+        c.execute(f"PRAGMA user_version = {SCHEMA_VERSION};")
+        conn.commit()
+    return True
 
 
 def load_banned_users():
     global BANNED_USERS
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT telegram_id FROM banned_users;")
-    rows = c.fetchall()
-    conn.close()
+    with closing(get_conn()) as conn:
+        c = conn.cursor()
+        c.execute("SELECT telegram_id FROM banned_users;")
+        rows = c.fetchall()
     BANNED_USERS = {r[0] for r in rows if r[0] is not None}
 
 
 def load_blocked_domains():
     global EXTRA_BLOCKED_DOMAINS
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT domain FROM blocked_domains;")
-    rows = c.fetchall()
-    conn.close()
+    with closing(get_conn()) as conn:
+        c = conn.cursor()
+        c.execute("SELECT domain FROM blocked_domains;")
+        rows = c.fetchall()
     EXTRA_BLOCKED_DOMAINS = {r[0].lower() for r in rows if r[0]}
 
 
+# ============ مزامنة الحظر بين العمليات ============
+
+MODERATION_POLL_INTERVAL = float(os.getenv("MODERATION_POLL_INTERVAL", "0.5"))
+# أي عملية أقدم من هذا تكون قد حمّلت الحالة كاملة عند تشغيلها، فلا حاجة للسجل الأقدم
+MODERATION_LOG_TTL = 7 * 24 * 3600
+
+
+def record_moderation(c: sqlite3.Cursor, kind: str, value, op: str):
+    """
+    kind: "user" / "domain"، op: "add" / "remove".
+    يُستدعى قبل commit التعديل نفسه حتى لا يظهر تعديل بدون سجله.
+    """
+    now = time.time()
+    c.execute(
+        "INSERT INTO moderation_log (kind, value, op, created_at) VALUES (?, ?, ?, ?);",
+        (kind, str(value), op, now),
+    )
+    c.execute("DELETE FROM moderation_log WHERE created_at < ?;", (now - MODERATION_LOG_TTL,))
+
+
+class ModerationWatcher:
+    """
+    يبقي BANNED_USERS و EXTRA_BLOCKED_DOMAINS متزامنة مع تعديلات العمليات الأخرى.
+    PRAGMA data_version على اتصال ثابت لا يتغير إلا عندما يكتب اتصال آخر في القاعدة،
+    فالفحص الدوري لا يقرأ أي جدول في الحالة العادية؛ وعند التغيير تُقرأ صفوف
+    moderation_log الأحدث من last_id فقط وتُطبّق كفروقات بالترتيب.
+    """
+
+    def __init__(self):
+        self.conn: sqlite3.Connection | None = None
+        self.data_version: int | None = None
+        self.last_id = 0
+
+    def load(self):
+        """
+        التحميل الكامل عند التشغيل؛ last_id يُقرأ أولًا حتى لا يضيع تعديل يحدث أثناء التحميل
+        """
+        with closing(get_conn()) as conn:
+            self.last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM moderation_log;").fetchone()[0]
+        load_banned_users()
+        load_blocked_domains()
+
+    def poll(self) -> list[tuple]:
+        if self.conn is None:
+            # الاستدعاءات متتالية لكن من خيوط to_thread مختلفة
+            self.conn = sqlite3.connect(DB_FILE, timeout=30, check_same_thread=False)
+        version = self.conn.execute("PRAGMA data_version;").fetchone()[0]
+        if version == self.data_version:
+            return []
+        self.data_version = version
+        rows = self.conn.execute(
+            "SELECT id, kind, value, op FROM moderation_log WHERE id > ? ORDER BY id;",
+            (self.last_id,),
+        ).fetchall()
+        if rows:
+            self.last_id = rows[-1][0]
+        return rows
+
+    @staticmethod
+    def apply(rows: list[tuple]):
+        """
+        تُطبّق في خيط حلقة الأحداث، حيث تُقرأ المجموعات
+        """
+        for _id, kind, value, op in rows:
+            if kind == "user":
+                target, item = BANNED_USERS, int(value)
+            elif kind == "domain":
+                target, item = EXTRA_BLOCKED_DOMAINS, value
+            else:
+                continue
+            if op == "add":
+                target.add(item)
+            else:
+                target.discard(item)
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+MODERATION = ModerationWatcher()
+
+
+async def moderation_watch_loop(stop: asyncio.Event):
+    try:
+        while not stop.is_set():
+            try:
+                rows = await asyncio.to_thread(MODERATION.poll)
+                if rows:
+                    MODERATION.apply(rows)
+                    log.info("moderation_synced", extra={"fields": {"changes": len(rows)}})
+            except Exception as e:
+                log.warning("moderation sync error: %s", e)
+            await _wait_or_stop(stop, MODERATION_POLL_INTERVAL)
+    finally:
+        MODERATION.close()
+
+
 def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_IDS
 
 
-def get_or_create_user(tg_user) -> int:
+# ============ سجل المستخدمين في الذاكرة (write-behind) ============
+
+# كل كم ثانية تُكتب التغييرات المتراكمة دفعة واحدة
+USER_FLUSH_INTERVAL = int(os.getenv("USER_FLUSH_INTERVAL", "5"))
+# أقصى عدد مستخدمين في الذاكرة (يُحذف الأقدم غير المتسخ)
+USER_REGISTRY_MAX = 100_000
+
+_USER_UPSERT_SQL = """
+    INSERT INTO users (telegram_id, username, first_name, last_name, created_at, last_seen_at, total_requests)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(telegram_id) DO UPDATE SET
+        username = excluded.username,
+        first_name = excluded.first_name,
+        last_name = excluded.last_name,
+        last_seen_at = excluded.last_seen_at,
+        total_requests = COALESCE(users.total_requests, 0) + excluded.total_requests,
+        blocked_at = NULL;
+"""
+
+
+class UserRegistry:
     """
-    يرجع id الداخلي من جدول users
+    telegram_id -> id الداخلي مع تتبّع التغييرات.
+    الرسالة العادية لا تلمس قاعدة البيانات: نحدّث الذاكرة فقط، وflush() يكتب
+    last_seen_at وعدد الطلبات المتراكم بـ upsert جماعي.
     """
-    conn = get_conn()
-    c = conn.cursor()
 
-    c.execute("SELECT id, total_requests FROM users WHERE telegram_id = ?;", (tg_user.id,))
-    row = c.fetchone()
-    now = datetime.utcnow().isoformat()
+    def __init__(self, max_size: int = USER_REGISTRY_MAX):
+        self.max_size = max_size
+        self._users: collections.OrderedDict[int, dict] = collections.OrderedDict()
+        self._dirty: set[int] = set()
+        self._lock = threading.Lock()
 
-    if row:
-        user_id, total_requests = row
-        c.execute(
-            "UPDATE users SET username=?, first_name=?, last_name=?, last_seen_at=?, total_requests=? WHERE id=?;",
-            (
-                tg_user.username,
-                tg_user.first_name,
-                tg_user.last_name,
-                now,
-                (total_requests or 0) + 1,
-                user_id,
-            ),
-        )
-    else:
-        c.execute(
-            """
-            INSERT INTO users (telegram_id, username, first_name, last_name, created_at, last_seen_at, total_requests)
-            VALUES (?, ?, ?, ?, ?, ?, 1);
-            """,
-            (
-                tg_user.id,
-                tg_user.username,
-                tg_user.first_name,
-                tg_user.last_name,
-                now,
-                now,
-            ),
-        )
-        user_id = c.lastrowid
+    def touch(self, tg_user) -> int:
+        """
+        يرجع id الداخلي من جدول users (يُحمَّل من القاعدة فقط عند أول رسالة من المستخدم)
+        """
+        now = datetime.utcnow().isoformat()
+        with self._lock:
+            entry = self._users.get(tg_user.id)
+            if entry is not None:
+                entry["username"] = tg_user.username
+                entry["first_name"] = tg_user.first_name
+                entry["last_name"] = tg_user.last_name
+                entry["last_seen_at"] = now
+                entry["pending"] += 1
+                self._dirty.add(tg_user.id)
+                self._users.move_to_end(tg_user.id)
+                return entry["id"]
+
+        user_id = self._load(tg_user, now)
+        with self._lock:
+            self._users[tg_user.id] = {
+                "id": user_id,
+                "username": tg_user.username,
+                "first_name": tg_user.first_name,
+                "last_name": tg_user.last_name,
+                "last_seen_at": now,
+                "pending": 0,
+            }
+            self._trim_locked()
+        return user_id
+
+    @traced("db")
+    def _load(self, tg_user, now: str) -> int:
+        with closing(get_conn()) as conn:
+            c = conn.cursor()
+            c.execute(
+                _USER_UPSERT_SQL,
+                (tg_user.id, tg_user.username, tg_user.first_name, tg_user.last_name, now, now, 1),
+            )
+            c.execute("SELECT id FROM users WHERE telegram_id = ?;", (tg_user.id,))
+            user_id = c.fetchone()[0]
+            conn.commit()
+        return user_id
+
+    def _trim_locked(self):
+        if len(self._users) <= self.max_size:
+            return
+        for telegram_id in list(self._users):
+            if len(self._users) <= self.max_size:
+                break
+            if telegram_id not in self._dirty:
+                del self._users[telegram_id]
+
+    @traced("db")
+    def flush(self) -> int:
+        with self._lock:
+            if not self._dirty:
+                return 0
+            batch = []
+            for telegram_id in self._dirty:
+                e = self._users[telegram_id]
+                batch.append(
+                    (
+                        telegram_id,
+                        e["username"],
+                        e["first_name"],
+                        e["last_name"],
+                        e["last_seen_at"],
+                        e["last_seen_at"],
+                        e["pending"],
+                    )
+                )
+                e["pending"] = 0
+            self._dirty.clear()
+
+        try:
+            with closing(get_conn()) as conn:
+                conn.executemany(_USER_UPSERT_SQL, batch)
+                conn.commit()
+        except Exception:
+            # نعيد العدّادات حتى لا تضيع عند الفشل
+            with self._lock:
+                for row in batch:
+                    e = self._users.get(row[0])
+                    if e is not None:
+                        e["pending"] += row[6]
+                        self._dirty.add(row[0])
+            raise
+        return len(batch)
+
+
+USER_REGISTRY = UserRegistry()
+
+
+async def user_flush_loop(stop: asyncio.Event):
+    while not stop.is_set():
+        await _wait_or_stop(stop, USER_FLUSH_INTERVAL)
+        try:
+            flushed = await asyncio.to_thread(USER_REGISTRY.flush)
+            if flushed:
+                log.debug("users_flushed", extra={"fields": {"count": flushed}})
+        except Exception as e:
+            log.warning("users flush error: %s", e)
 
-    conn.commit()
-    conn.close()
-    return user_id
 
+def _round_ms(ms: float | None) -> float | None:
+    return None if ms is None else round(ms, 1)
 
+
+@traced("db")
 def log_request_db(
     user_id: int | None,
     url: str,
@@ -225,172 +1231,560 @@ def log_request_db(
     quality: str,
     status: str,
     error: str | None = None,
+    extract_ms: float | None = None,
+    download_ms: float | None = None,
+    upload_ms: float | None = None,
+    nbytes: int | None = None,
+    strategy: str | None = None,
 ):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute(
-        """
-        INSERT INTO requests (user_id, url, domain, action_type, quality, status, error, created_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?);
-        """,
-        (
-            user_id,
-            url,
-            domain,
-            action_type,
-            quality,
-            status,
-            error or "",
-            datetime.utcnow().isoformat(),
-        ),
-    )
-    conn.commit()
-    conn.close()
-
-
-def log_video_usage(title: str, url: str, domain: str):
-    conn = get_conn()
-    c = conn.cursor()
-    now = datetime.utcnow().isoformat()
-    c.execute("SELECT id, times_used FROM videos WHERE url = ?;", (url,))
-    row = c.fetchone()
-    if row:
-        vid_id, times_used = row
+    """
+    الأزمنة بالميلي ثانية؛ None = المرحلة لم تحدث (رابط مرفوض، إرسال مباشر بدون تحميل...)
+    """
+    with closing(get_conn()) as conn:
+        c = conn.cursor()
         c.execute(
-            "UPDATE videos SET title=?, domain=?, last_used_at=?, times_used=? WHERE id=?;",
+            """
+            INSERT INTO requests (
+                user_id, url, domain, action_type, quality, status, error, created_at,
+                extract_ms, download_ms, upload_ms, bytes, strategy
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+            """,
             (
-                title,
+                user_id,
+                url,
                 domain,
-                now,
-                (times_used or 0) + 1,
-                vid_id,
+                action_type,
+                quality,
+                status,
+                error or "",
+                datetime.utcnow().isoformat(),
+                _round_ms(extract_ms),
+                _round_ms(download_ms),
+                _round_ms(upload_ms),
+                nbytes,
+                strategy,
             ),
         )
-    else:
-        c.execute(
+        conn.commit()
+
+
+@traced("db")
+def log_video_usage(title: str, url: str, domain: str):
+    """
+    upsert واحد: عدة عمّال قد يسلّمون نفس الرابط في نفس اللحظة
+    """
+    now = datetime.utcnow().isoformat()
+    with closing(get_conn()) as conn:
+        conn.execute(
             """
             INSERT INTO videos (title, url, domain, first_seen_at, last_used_at, times_used)
-            VALUES (?, ?, ?, ?, ?, 1);
+            VALUES (?, ?, ?, ?, ?, 1)
+            ON CONFLICT(url) DO UPDATE SET
+                title = excluded.title,
+                domain = excluded.domain,
+                last_used_at = excluded.last_used_at,
+                times_used = COALESCE(videos.times_used, 0) + 1;
             """,
             (title, url, domain, now, now),
         )
-    conn.commit()
-    conn.close()
+        conn.commit()
 
 
 def ban_user_in_db(telegram_id: int, reason: str | None = None):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute(
-        """
-        INSERT OR REPLACE INTO banned_users (telegram_id, reason, banned_at)
-        VALUES (?, ?, ?);
-        """,
-        (telegram_id, reason or "", datetime.utcnow().isoformat()),
-    )
-    conn.commit()
-    conn.close()
+    with closing(get_conn()) as conn:
+        c = conn.cursor()
+        c.execute(
+            """
+            INSERT OR REPLACE INTO banned_users (telegram_id, reason, banned_at)
+            VALUES (?, ?, ?);
+            """,
+            (telegram_id, reason or "", datetime.utcnow().isoformat()),
+        )
+        record_moderation(c, "user", telegram_id, "add")
+        conn.commit()
     BANNED_USERS.add(telegram_id)
 
 
 def unban_user_in_db(telegram_id: int):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("DELETE FROM banned_users WHERE telegram_id = ?;", (telegram_id,))
-    conn.commit()
-    conn.close()
+    with closing(get_conn()) as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM banned_users WHERE telegram_id = ?;", (telegram_id,))
+        record_moderation(c, "user", telegram_id, "remove")
+        conn.commit()
     BANNED_USERS.discard(telegram_id)
 
 
 def add_blocked_domain_in_db(domain: str, reason: str | None = None):
     domain = domain.lower()
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute(
-        """
-        INSERT OR REPLACE INTO blocked_domains (domain, reason, added_at)
-        VALUES (?, ?, ?);
-        """,
-        (domain, reason or "", datetime.utcnow().isoformat()),
-    )
-    conn.commit()
-    conn.close()
+    with closing(get_conn()) as conn:
+        c = conn.cursor()
+        c.execute(
+            """
+            INSERT OR REPLACE INTO blocked_domains (domain, reason, added_at)
+            VALUES (?, ?, ?);
+            """,
+            (domain, reason or "", datetime.utcnow().isoformat()),
+        )
+        record_moderation(c, "domain", domain, "add")
+        conn.commit()
     EXTRA_BLOCKED_DOMAINS.add(domain)
 
 
 def remove_blocked_domain_in_db(domain: str):
     domain = domain.lower()
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("DELETE FROM blocked_domains WHERE domain = ?;", (domain,))
-    conn.commit()
-    conn.close()
+    with closing(get_conn()) as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM blocked_domains WHERE domain = ?;", (domain,))
+        record_moderation(c, "domain", domain, "remove")
+        conn.commit()
     EXTRA_BLOCKED_DOMAINS.discard(domain)
 
 
-# ================== HELPERs للفيديو ==================
-
+# ============ طابور المهام (jobs) ============
 
-def looks_like_direct_video(url: str) -> bool:
-    base = url.split("?", 1)[0].lower()
-    return base.endswith(VIDEO_EXTS)
+JOB_LEASE_SECONDS = 60
+JOB_HEARTBEAT_SECONDS = 15
+JOB_RETRY_BACKOFF = 10
+# المهام المنتهية (done / failed) تُحذف بعد هذه المدة؛ كل صف يحمل الرسالة و video_info كاملين
+JOB_RETENTION_HOURS = int(os.getenv("JOB_RETENTION_HOURS", "48"))
+JOB_PURGE_BATCH = 5000
 
 
-def is_blocked_domain(url: str) -> bool:
-    try:
-        hostname = (urlparse(url).hostname or "").lower()
-        all_blocked = list(BLOCKED_DOMAINS_BASE) + list(EXTRA_BLOCKED_DOMAINS)
-        return any(b in hostname for b in all_blocked)
-    except Exception:
-        return False
+def enqueue_job(kind: str, payload: dict, max_attempts: int = 3) -> int:
+    now = time.time()
+    with closing(get_conn()) as conn:
+        c = conn.cursor()
+        c.execute(
+            """
+            INSERT INTO jobs (kind, payload, status, attempts, max_attempts, available_at, created_at, updated_at)
+            VALUES (?, ?, 'queued', 0, ?, ?, ?, ?);
+            """,
+            (
+                kind,
+                json.dumps(payload, ensure_ascii=False),
+                max_attempts,
+                now,
+                datetime.utcnow().isoformat(),
+                datetime.utcnow().isoformat(),
+            ),
+        )
+        job_id = c.lastrowid
+        conn.commit()
+    return job_id
 
 
-def get_video_info(url: str) -> dict:
-    try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
+def claim_job(owner: str) -> dict | None:
+    """
+    يحجز أقدم مهمة جاهزة (أو مهمة انتهى عقدها بسبب توقف عامل آخر) بعقد مؤقت
+    """
+    now = time.time()
+    with closing(get_conn()) as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE;")
+        c.execute(
+            """
+            UPDATE jobs
+            SET status = 'running', lease_owner = ?, lease_until = ?, attempts = attempts + 1, updated_at = ?
+            WHERE id = (
+                SELECT id FROM jobs
+                WHERE (status = 'queued' AND available_at <= ?)
+                   OR (status = 'running' AND lease_until < ? AND attempts < max_attempts)
+                ORDER BY id
+                LIMIT 1
+            )
+            RETURNING id, kind, payload, attempts, max_attempts;
+            """,
+            (owner, now + JOB_LEASE_SECONDS, datetime.utcnow().isoformat(), now, now),
+        )
+        row = c.fetchone()
+        conn.commit()
+    if not row:
+        return None
+    return {
+        "id": row[0],
+        "kind": row[1],
+        "payload": json.loads(row[2]),
+        "attempts": row[3],
+        "max_attempts": row[4],
+    }
+
+
+def heartbeat_job(job_id: int, owner: str) -> bool:
+    """
+    يمدد العقد، ويرجع False لو فقد العامل ملكية المهمة
+    """
+    with closing(get_conn()) as conn:
+        c = conn.cursor()
+        c.execute(
+            "UPDATE jobs SET lease_until = ? WHERE id = ? AND lease_owner = ? AND status = 'running';",
+            (time.time() + JOB_LEASE_SECONDS, job_id, owner),
+        )
+        ok = c.rowcount == 1
+        conn.commit()
+    return ok
+
+
+def complete_job(job_id: int, owner: str):
+    with closing(get_conn()) as conn:
+        c = conn.cursor()
+        c.execute(
+            """
+            UPDATE jobs SET status = 'done', lease_owner = NULL, lease_until = NULL, updated_at = ?
+            WHERE id = ? AND lease_owner = ?;
+            """,
+            (datetime.utcnow().isoformat(), job_id, owner),
+        )
+        conn.commit()
+
+
+def fail_job(job_id: int, owner: str, error: str):
+    """
+    يعيد المهمة للطابور مع تأخير متزايد، أو يعلّمها failed بعد استنفاد المحاولات
+    """
+    with closing(get_conn()) as conn:
+        c = conn.cursor()
+        c.execute(
+            """
+            UPDATE jobs
+            SET status = CASE WHEN attempts < max_attempts THEN 'queued' ELSE 'failed' END,
+                available_at = ? + attempts * ?,
+                lease_owner = NULL,
+                lease_until = NULL,
+                last_error = ?,
+                updated_at = ?
+            WHERE id = ? AND lease_owner = ?;
+            """,
+            (time.time(), JOB_RETRY_BACKOFF, error[:500], datetime.utcnow().isoformat(), job_id, owner),
+        )
+        conn.commit()
+
+
+def purge_finished_jobs() -> int:
+    """
+    الحذف على دفعات حتى لا يحجز قفل الكتابة طويلًا عن العمّال
+    """
+    cutoff = (datetime.utcnow() - timedelta(hours=JOB_RETENTION_HOURS)).isoformat()
+    deleted = 0
+    with closing(get_conn()) as conn:
+        c = conn.cursor()
+        while True:
+            c.execute(
+                """
+                DELETE FROM jobs WHERE id IN (
+                    SELECT id FROM jobs
+                    WHERE status IN ('done', 'failed') AND updated_at < ?
+                    LIMIT ?
+                );
+                """,
+                (cutoff, JOB_PURGE_BATCH),
+            )
+            conn.commit()
+            deleted += c.rowcount
+            if c.rowcount < JOB_PURGE_BATCH:
+                break
+    return deleted
+
+
+def recover_orphaned_jobs() -> int:
+    """
+    المهام التي بقيت running بعقد منتهٍ (عامل انهار): تعود للطابور أو تفشل نهائيًا
+    """
+    now = time.time()
+    with closing(get_conn()) as conn:
+        c = conn.cursor()
+        c.execute(
+            """
+            UPDATE jobs
+            SET status = CASE WHEN attempts < max_attempts THEN 'queued' ELSE 'failed' END,
+                available_at = ?,
+                lease_owner = NULL,
+                lease_until = NULL,
+                last_error = COALESCE(last_error, 'lease_expired'),
+                updated_at = ?
+            WHERE status = 'running' AND lease_until < ?;
+            """,
+            (now, datetime.utcnow().isoformat(), now),
+        )
+        count = c.rowcount
+        conn.commit()
+    return count
+
+
+# ================== HELPERs للفيديو ==================
+
+
+# ================== توحيد الروابط (canonicalization) ==================
+
+# باراميترات تتبّع تُحذف من أي رابط
+TRACKING_PARAMS = {
+    "fbclid",
+    "gclid",
+    "dclid",
+    "msclkid",
+    "yclid",
+    "igshid",
+    "igsh",
+    "mc_cid",
+    "mc_eid",
+    "_hsenc",
+    "_hsmi",
+}
+TRACKING_PREFIXES = ("utm_",)
+
+# بادئات لا تغيّر المحتوى في اسم المضيف
+HOST_PREFIXES = ("www.", "m.", "mobile.")
+
+# أسماء بديلة لنفس المنصة
+HOST_ALIASES = {
+    "youtu.be": "youtube.com",
+    "youtube-nocookie.com": "youtube.com",
+    "twitter.com": "x.com",
+    "fb.com": "facebook.com",
+}
+
+# منصات نعرف أن الـ query فيها لا يحدد المحتوى (ما عدا المفاتيح المذكورة)
+PLATFORM_KEEP_PARAMS = {
+    "youtube.com": {"v"},
+    "x.com": set(),
+    "instagram.com": set(),
+    "tiktok.com": set(),
+    "facebook.com": {"v", "story_fbid", "id"},
+    "vimeo.com": set(),
+}
+
+
+def _strip_host_prefix(hostname: str) -> str:
+    host = (hostname or "").lower().rstrip(".")
+    for prefix in HOST_PREFIXES:
+        if host.startswith(prefix) and host.count(".") >= 2:
+            return host[len(prefix):]
+    return host
+
+
+def canonical_host(hostname: str) -> str:
+    host = _strip_host_prefix(hostname)
+    return HOST_ALIASES.get(host, host)
+
+
+# روابط مختصرة تحتاج شبكة لفكّها؛ نوحّد الدومين فقط للإحصائيات
+DOMAIN_ALIASES = {
+    "vm.tiktok.com": "tiktok.com",
+    "vt.tiktok.com": "tiktok.com",
+    "fb.watch": "facebook.com",
+}
 
-            formats_raw = info.get("formats", []) or []
-            qualities = []
-            seen_heights = set()
-            for f in formats_raw:
-                h = f.get("height")
-                fid = f.get("format_id")
-                if not h or not fid:
-                    continue
-                if h in seen_heights:
-                    continue
-                seen_heights.add(h)
-                qualities.append(
-                    {
-                        "format_id": fid,
-                        "height": h,
-                        "ext": f.get("ext", "mp4"),
-                        "filesize": f.get("filesize"),
-                    }
-                )
 
-            qualities.sort(key=lambda x: x["height"], reverse=True)
-
-            return {
-                "success": True,
-                "title": info.get("title", "فيديو"),
-                "duration": info.get("duration", 0),
-                "uploader": info.get("uploader", "غير معروف"),
-                "view_count": info.get("view_count", 0),
-                "thumbnail": info.get("thumbnail", ""),
-                "url": info.get("url"),
-                "ext": info.get("ext", "mp4"),
-                "filesize": info.get("filesize"),
-                "webpage_url": info.get("webpage_url", url),
-                "qualities": qualities,
+def canonical_domain(url: str) -> str:
+    """
+    الدومين الموحّد للإحصائيات والسجلات (بدون www. / m. وبأسماء المنصات الموحدة)
+    """
+    try:
+        host = canonical_host(urlparse(url).hostname or "")
+    except ValueError:
+        return ""
+    return DOMAIN_ALIASES.get(host, host)
+
+
+def _youtube_video_id(host: str, path: str, query: dict[str, list[str]]) -> str | None:
+    if host == "youtu.be":
+        return path.strip("/").split("/", 1)[0] or None
+    parts = [p for p in path.split("/") if p]
+    if len(parts) >= 2 and parts[0] in ("shorts", "live", "embed", "v"):
+        return parts[1]
+    if query.get("v"):
+        return query["v"][0]
+    return None
+
+
+def canonicalize_url(url: str) -> str:
+    """
+    يحوّل الرابط لشكل موحّد يصلح مفتاحًا للكاش والإحصائيات، بدون أي طلب شبكة:
+    - youtu.be / shorts / embed -> youtube.com/watch?v=ID
+    - حذف باراميترات التتبّع، وكل الـ query في المنصات التي لا تحتاجه
+    - مضيف بأحرف صغيرة بدون www. / m. وبدون المنفذ الافتراضي والـ fragment
+    """
+    try:
+        parsed = urlparse(url.strip())
+        raw_host = (parsed.hostname or "").lower()
+        if not raw_host:
+            return url
+        scheme = parsed.scheme.lower() or "https"
+        query = parse_qs(parsed.query, keep_blank_values=True)
+        port = parsed.port
+    except ValueError:
+        return url
+
+    bare_host = _strip_host_prefix(raw_host)
+    host = HOST_ALIASES.get(bare_host, bare_host)
+    path = parsed.path or "/"
+
+    if host == "youtube.com":
+        video_id = _youtube_video_id(bare_host, path, query)
+        if video_id:
+            return f"https://youtube.com/watch?v={video_id}"
+
+    if host in PLATFORM_KEEP_PARAMS:
+        keep = PLATFORM_KEEP_PARAMS[host]
+        items = [(k, v) for k, vs in query.items() if k in keep for v in vs]
+        scheme = "https"
+        if path != "/":
+            path = path.rstrip("/")
+        items.sort()
+        query_str = urlencode(items)
+    else:
+        # روابط عامة (قد تكون موقّعة): لا نغيّر ترتيب أو ترميز الـ query إلا لحذف التتبّع
+        items = [
+            (k, v)
+            for k, vs in query.items()
+            if k.lower() not in TRACKING_PARAMS and not k.lower().startswith(TRACKING_PREFIXES)
+            for v in vs
+        ]
+        removed = len(items) != sum(len(vs) for vs in query.values())
+        query_str = urlencode(items) if removed else parsed.query
+
+    netloc = host
+    if port and not ((scheme == "http" and port == 80) or (scheme == "https" and port == 443)):
+        netloc = f"{host}:{port}"
+
+    return urlunparse((scheme, netloc, path, "", query_str, ""))
+
+
+def looks_like_direct_video(url: str) -> bool:
+    base = url.split("?", 1)[0].lower()
+    return base.endswith(VIDEO_EXTS)
+
+
+def is_blocked_domain(url: str) -> bool:
+    try:
+        hostname = (urlparse(url).hostname or "").lower()
+        all_blocked = list(BLOCKED_DOMAINS_BASE) + list(EXTRA_BLOCKED_DOMAINS)
+        return any(b in hostname for b in all_blocked)
+    except Exception:
+        return False
+
+
+def summarize_info(info: dict, url: str) -> dict:
+    """
+    تحويل ناتج extract_info إلى ما يحتاجه البوت (الجودات مرتبة تنازليًا، جودة واحدة لكل ارتفاع)
+    """
+    formats_raw = info.get("formats", []) or []
+    qualities = []
+    seen_heights = set()
+    for f in formats_raw:
+        h = f.get("height")
+        fid = f.get("format_id")
+        if not h or not fid:
+            continue
+        if h in seen_heights:
+            continue
+        seen_heights.add(h)
+        qualities.append(
+            {
+                "format_id": fid,
+                "height": h,
+                "ext": f.get("ext", "mp4"),
+                "filesize": f.get("filesize"),
+                "vcodec": f.get("vcodec"),
+                "acodec": f.get("acodec"),
+                "protocol": f.get("protocol"),
             }
+        )
+
+    qualities.sort(key=lambda x: x["height"], reverse=True)
+
+    return {
+        "success": True,
+        "title": info.get("title", "فيديو"),
+        "duration": info.get("duration", 0),
+        "uploader": info.get("uploader", "غير معروف"),
+        "view_count": info.get("view_count", 0),
+        "thumbnail": info.get("thumbnail", ""),
+        "url": info.get("url"),
+        "ext": info.get("ext", "mp4"),
+        "filesize": info.get("filesize"),
+        "format_id": info.get("format_id"),
+        "vcodec": info.get("vcodec"),
+        "acodec": info.get("acodec"),
+        "protocol": info.get("protocol"),
+        "webpage_url": canonicalize_url(info.get("webpage_url") or url),
+        "qualities": qualities,
+    }
+
+
+# أخطاء من جهة الموقع (شبكة، مهلة، 5xx/429/403، حظر IP) هي فقط ما يُحسب على قاطع الدومين؛
+# أخطاء الرابط نفسه (فيديو خاص أو محذوف، صفحة قناة...) لا تعني أن الموقع معطّل
+ORIGIN_ERROR_RE = re.compile(
+    r"(http error|server error|client error|status code)\W*(5\d\d|429|403)"
+    r"|\b(5\d\d|429|403) (server|client) error"
+    r"|timed out|timeout|connection (reset|refused|aborted)|remote end closed"
+    r"|temporary failure|name resolution|network is unreachable|too many requests|not a bot",
+    re.IGNORECASE,
+)
+
+
+def is_origin_error(e: BaseException) -> bool:
+    if isinstance(e, (TimeoutError, ConnectionError, socket.timeout)):
+        return True
+    return bool(ORIGIN_ERROR_RE.search(str(e)))
+
+
+def failure_result(e: BaseException) -> dict:
+    return {"success": False, "error": str(e), "origin_error": is_origin_error(e)}
+
+
+def breaker_outcome(result: dict) -> bool | None:
+    """
+    نتيجة القاطع: True نجاح، False فشل من الموقع، None لا تُحسب (كاش، خطأ في الرابط)
+    """
+    if result.get("cached"):
+        return None
+    if result.get("success"):
+        return True
+    if result.get("timeout") or result.get("origin_error"):
+        return False
+    return None
+
+
+class ExtractCancelled(Exception):
+    pass
+
+
+def cancellable_urlopen(ydl, cancel_event: threading.Event):
+    """
+    extract_info لا يملك progress hooks، فنفحص cancel_event قبل كل طلب HTTP للمستخرج:
+    بعد انتهاء المهلة يتوقف الخيط خلال socket_timeout واحد بدل socket_timeout × retries
+    """
+    urlopen = getattr(ydl, "urlopen", None)
+    if urlopen is None:
+        return
+
+    def guarded(*args, **kwargs):
+        if cancel_event.is_set():
+            raise ExtractCancelled("cancelled")
+        return urlopen(*args, **kwargs)
+
+    ydl.urlopen = guarded
+
+
+def get_video_info(url: str, cancel_event: threading.Event | None = None) -> dict:
+    try:
+        # حتى لا يتجاوز الاستخراج مهلته كثيرًا في الخيط الخلفي
+        opts = ydl_opts.copy()
+        opts["socket_timeout"] = min(ydl_opts["socket_timeout"], max(5, STAGE_DEADLINES["extract"] // 3))
+        with span("extract"), extractor_backend(opts) as ydl:
+            if cancel_event is not None:
+                cancellable_urlopen(ydl, cancel_event)
+            info = ydl.extract_info(url, download=False)
+        if YTDLP_RECORD_DIR:
+            record_fixture(YTDLP_RECORD_DIR, url, info)
+        return summarize_info(info, url)
     except Exception as e:
-        print(f"Video extract error: {e}")
-        return {"success": False, "error": str(e)}
+        log.warning("Video extract error: %s", e, extra={"fields": {"url": url}})
+        return failure_result(e)
 
 
-def get_direct_video_url(url: str) -> dict:
+def get_direct_video_url(url: str, cancel_event: threading.Event | None = None) -> dict:
     if looks_like_direct_video(url):
         return {
             "success": True,
@@ -404,7 +1798,7 @@ def get_direct_video_url(url: str) -> dict:
             "webpage_url": url,
         }
 
-    info = get_video_info(url)
+    info = get_video_info(url, cancel_event)
     if info.get("success") and info.get("url"):
         try:
             hostname = (urlparse(info.get("webpage_url", url)).hostname or "").lower()
@@ -421,26 +1815,51 @@ def get_direct_video_url(url: str) -> dict:
     return {
         "success": False,
         "error": "تعذر استخراج رابط الفيديو من هذا الرابط.",
+        "origin_error": bool(info.get("origin_error")),
     }
 
 
-def download_with_ytdlp(url: str, save_path: str, format_id: str | None = None) -> dict:
+def cancel_hook(cancel_event: threading.Event):
+    """
+    progress hook لـ yt-dlp يوقف التحميل فور ضبط cancel_event (يُستخدم لإلغاء التحميل المسبق)
+    """
+
+    def hook(_status: dict):
+        if cancel_event.is_set():
+            raise yt_dlp.utils.DownloadCancelled("cancelled")
+
+    return hook
+
+
+def download_with_ytdlp(
+    url: str,
+    save_path: str,
+    format_id: str | None = None,
+    cancel_event: threading.Event | None = None,
+) -> dict:
     try:
         opts = ydl_opts.copy()
         if format_id:
             opts["format"] = format_id
         opts["outtmpl"] = save_path.replace(".mp4", ".%(ext)s")
+        hooks = [cancel_hook(cancel_event)] if cancel_event is not None else []
 
-        print(f"[yt-dlp] بدء التحميل من: {url} | format={opts.get('format')}")
-        with yt_dlp.YoutubeDL(opts) as ydl:
-            ydl.download([url])
+        log.info(
+            "[yt-dlp] بدء التحميل",
+            extra={"fields": {"url": url, "format": opts.get("format")}},
+        )
+        with ORIGIN_LIMITER.slot(url, cancel_event) as throttle:
+            opts["progress_hooks"] = hooks + [throttle_hook(throttle)]
+            with span("download", backend="yt-dlp"):
+                with yt_dlp.YoutubeDL(opts) as ydl:
+                    ydl.download([url])
 
         base = save_path.replace(".mp4", "")
         for ext in ["mp4", "webm", "mkv", "mov"]:
             possible = f"{base}.{ext}"
             if os.path.exists(possible):
                 size = os.path.getsize(possible)
-                print(f"[yt-dlp] تم العثور على الملف: {possible} (الحجم: {size} bytes)")
+                log.info("[yt-dlp] تم العثور على الملف", extra={"fields": {"path": possible, "bytes": size}})
                 if size > 0:
                     if possible != save_path:
                         os.rename(possible, save_path)
@@ -448,26 +1867,34 @@ def download_with_ytdlp(url: str, save_path: str, format_id: str | None = None)
 
         return {"success": False, "error": "لم يتم إنشاء الملف بعد التحميل"}
     except Exception as e:
-        print(f"download_with_ytdlp error: {e}")
-        return {"success": False, "error": str(e)}
+        log.warning("download_with_ytdlp error: %s", e, extra={"fields": {"url": url}})
+        return failure_result(e)
 
 
-def download_audio_with_ytdlp(url: str, save_path: str) -> dict:
+def download_audio_with_ytdlp(
+    url: str,
+    save_path: str,
+    cancel_event: threading.Event | None = None,
+) -> dict:
     try:
         opts = ydl_opts.copy()
         opts["format"] = "bestaudio[filesize<50M]/bestaudio"
         opts["outtmpl"] = save_path.replace(".mp3", ".%(ext)s")
+        hooks = [cancel_hook(cancel_event)] if cancel_event is not None else []
 
-        print(f"[yt-dlp] بدء تحميل الصوت فقط من: {url}")
-        with yt_dlp.YoutubeDL(opts) as ydl:
-            ydl.download([url])
+        log.info("[yt-dlp] بدء تحميل الصوت فقط", extra={"fields": {"url": url}})
+        with ORIGIN_LIMITER.slot(url, cancel_event) as throttle:
+            opts["progress_hooks"] = hooks + [throttle_hook(throttle)]
+            with span("download", backend="yt-dlp", kind="audio"):
+                with yt_dlp.YoutubeDL(opts) as ydl:
+                    ydl.download([url])
 
         base = save_path.replace(".mp3", "")
         for ext in ["mp3", "m4a", "webm", "opus"]:
             possible = f"{base}.{ext}"
             if os.path.exists(possible):
                 size = os.path.getsize(possible)
-                print(f"[yt-dlp] تم العثور على ملف الصوت: {possible} (الحجم: {size} bytes)")
+                log.info("[yt-dlp] تم العثور على ملف الصوت", extra={"fields": {"path": possible, "bytes": size}})
                 if size > 0:
                     if possible != save_path:
                         os.rename(possible, save_path)
@@ -475,49 +1902,218 @@ def download_audio_with_ytdlp(url: str, save_path: str) -> dict:
 
         return {"success": False, "error": "لم يتم إنشاء ملف الصوت بعد التحميل"}
     except Exception as e:
-        print(f"download_audio_with_ytdlp error: {e}")
-        return {"success": False, "error": str(e)}
+        log.warning("download_audio_with_ytdlp error: %s", e, extra={"fields": {"url": url}})
+        return failure_result(e)
 
 
-def download_video_fallback(direct_url: str, save_path: str) -> dict:
+def download_video_fallback(
+    direct_url: str,
+    save_path: str,
+    cancel_event: threading.Event | None = None,
+) -> dict:
     try:
         headers = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
         }
-        print(f"[fallback] محاولة التحميل المباشر من: {direct_url}")
-
-        with requests.get(direct_url, headers=headers, stream=True, timeout=60) as r:
-            r.raise_for_status()
-            with open(save_path, "wb") as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
+        log.info("[fallback] محاولة التحميل المباشر", extra={"fields": {"url": direct_url}})
+
+        with ORIGIN_LIMITER.slot(direct_url, cancel_event) as throttle, span("download", backend="fallback"):
+            with requests.get(direct_url, headers=headers, stream=True, timeout=60) as r:
+                r.raise_for_status()
+                with open(save_path, "wb") as f:
+                    for chunk in r.iter_content(chunk_size=8192):
+                        if cancel_event is not None and cancel_event.is_set():
+                            return {"success": False, "error": "cancelled"}
+                        if chunk:
+                            throttle(len(chunk))
+                            f.write(chunk)
 
         size = os.path.getsize(save_path)
-        print(f"[fallback] تم التحميل: {size} bytes")
+        log.info("[fallback] تم التحميل", extra={"fields": {"bytes": size}})
         if size > 0:
             return {"success": True, "file_path": save_path, "file_size": size}
         return {"success": False, "error": "الملف الملتقط فارغ"}
     except Exception as e:
-        print(f"download_video_fallback error: {e}")
-        return {"success": False, "error": str(e)}
+        log.warning("download_video_fallback error: %s", e, extra={"fields": {"url": direct_url}})
+        return failure_result(e)
 
 
 async def send_video_direct(message: Message, direct_url: str, caption: str, duration: int | None):
     try:
         await bot.send_chat_action(message.chat.id, ChatAction.UPLOAD_VIDEO)
-        await message.answer_video(
-            video=direct_url,
-            caption=caption,
-            duration=duration or None,
-            supports_streaming=True,
-        )
+        with span("upload", mode="direct_url"):
+            await message.answer_video(
+                video=direct_url,
+                caption=caption,
+                duration=duration or None,
+                supports_streaming=True,
+            )
         return {"success": True}
     except Exception as e:
-        print(f"send_video_direct error: {e}")
+        log.warning("send_video_direct error: %s", e)
         return {"success": False, "error": str(e)}
 
 
+# ================== تسجيل وإعادة تشغيل نتائج الاستخراج (fixtures) ==================
+
+# YTDLP_RECORD_DIR: كل extract_info ناجح يُحفظ (بعد التنقيح) كملف JSON في هذا المجلد.
+# YTDLP_REPLAY_DIR: يحل FixtureYoutubeDL محل yt_dlp.YoutubeDL ويقرأ من الملفات فقط (بدون شبكة).
+YTDLP_RECORD_DIR = os.getenv("YTDLP_RECORD_DIR")
+YTDLP_REPLAY_DIR = os.getenv("YTDLP_REPLAY_DIR")
+
+# ما يُحفظ فقط؛ الباقي (headers، كوكيز، ترجمات، وصف...) إما خاص أو لا يؤثر على المعالجة
+FIXTURE_INFO_KEYS = (
+    "id",
+    "title",
+    "duration",
+    "uploader",
+    "view_count",
+    "thumbnail",
+    "webpage_url",
+    "extractor_key",
+    "url",
+    "ext",
+    "filesize",
+    "filesize_approx",
+    "format_id",
+    "vcodec",
+    "acodec",
+    "protocol",
+    "height",
+    "width",
+    "fps",
+    "tbr",
+)
+FIXTURE_FORMAT_KEYS = (
+    "format_id",
+    "format_note",
+    "ext",
+    "url",
+    "height",
+    "width",
+    "fps",
+    "tbr",
+    "abr",
+    "vbr",
+    "filesize",
+    "filesize_approx",
+    "vcodec",
+    "acodec",
+    "protocol",
+)
+
+
+class FixtureMissing(Exception):
+    pass
+
+
+def _strip_signed_url(value):
+    """
+    روابط الوسائط تحمل توقيعات وعناوين IP في الاستعلام؛ يبقى المسار فقط
+    """
+    if not isinstance(value, str) or not value.startswith("http"):
+        return value
+    p = urlparse(value)
+    return urlunparse((p.scheme, p.netloc, p.path, "", "", ""))
+
+
+def sanitize_info(info: dict) -> dict:
+    clean = {k: info[k] for k in FIXTURE_INFO_KEYS if info.get(k) is not None}
+    clean["formats"] = [
+        {k: f[k] for k in FIXTURE_FORMAT_KEYS if f.get(k) is not None}
+        for f in info.get("formats") or []
+    ]
+    for item in [clean, *clean["formats"]]:
+        if "url" in item:
+            item["url"] = _strip_signed_url(item["url"])
+    return clean
+
+
+def fixture_path(directory: str, url: str) -> str:
+    canonical = canonicalize_url(url)
+    key = hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:20]
+    return os.path.join(directory, f"{canonical_domain(canonical) or 'unknown'}__{key}.json")
+
+
+def _yt_dlp_version() -> str | None:
+    try:
+        return importlib.import_module("yt_dlp.version").__version__
+    except Exception:
+        return None
+
+
+def record_fixture(directory: str, url: str, info: dict):
+    try:
+        os.makedirs(directory, exist_ok=True)
+        path = fixture_path(directory, url)
+        payload = {
+            "url": canonicalize_url(url),
+            "recorded_at": datetime.utcnow().isoformat(),
+            "yt_dlp_version": _yt_dlp_version(),
+            "info": sanitize_info(info),
+        }
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(payload, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, path)
+    except Exception as e:
+        log.warning("fixture record error: %s", e, extra={"fields": {"url": url}})
+
+
+class FixtureYoutubeDL:
+    """
+    بديل yt_dlp.YoutubeDL للاستخراج فقط، من ملفات record_fixture
+    """
+
+    def __init__(self, params: dict | None = None, directory: str | None = None):
+        self.params = params or {}
+        self.directory = directory or YTDLP_REPLAY_DIR
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def extract_info(self, url: str, download: bool = True) -> dict:
+        if download:
+            raise FixtureMissing("replay backend cannot download")
+        path = fixture_path(self.directory, url)
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)["info"]
+        except FileNotFoundError:
+            raise FixtureMissing(f"no fixture for {url}")
+
+    def download(self, urls: list[str]) -> int:
+        raise FixtureMissing("replay backend cannot download")
+
+
+def extractor_backend(opts: dict):
+    if YTDLP_REPLAY_DIR:
+        return FixtureYoutubeDL(opts)
+    return yt_dlp.YoutubeDL(opts)
+
+
+def record_fixtures_cli(urls_file: str, directory: str):
+    """
+    python main.py record-fixtures urls.txt [dir]: تسجيل قائمة روابط دفعة واحدة (على جهاز فيه شبكة)
+    """
+    with open(urls_file, encoding="utf-8") as f:
+        urls = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    ok = 0
+    for url in urls:
+        try:
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                info = ydl.extract_info(url, download=False)
+            record_fixture(directory, url, info)
+            ok += 1
+            log.info("fixture_recorded", extra={"fields": {"url": url}})
+        except Exception as e:
+            log.warning("fixture record failed: %s", e, extra={"fields": {"url": url}})
+    log.info("fixtures_done", extra={"fields": {"recorded": ok, "total": len(urls), "dir": directory}})
+
+
 # ================== أوامر الإدارة (حظر / مواقع / تقارير) ==================
 
 
@@ -591,41 +2187,153 @@ async def cmd_unban_domain(message: Message):
     await message.answer(f"✅ تم إزالة الدومين من القائمة المحظورة (إن وجد):\n{domain}")
 
 
+# عدد العناصر في كل صفحة من /banlist (يبقى النص بعيدًا عن حد 4096 حرفًا)
+BANLIST_PAGE = 20
+BANLIST_REASON_CHARS = 60
+# حد callback_data في تيليجرام
+CALLBACK_DATA_MAX = 64
+
+BANLIST_KINDS = {
+    "u": {
+        "title": "👥 المستخدمون المحظورون",
+        "empty": "لا يوجد مستخدمون محظورون.",
+        "columns": "telegram_id, reason, banned_at",
+        "table": "banned_users",
+        "icon": "👤",
+    },
+    "d": {
+        "title": "🌐 الدومينات الإضافية المحظورة",
+        "empty": "لا توجد دومينات محظورة إضافيًا.",
+        "columns": "domain, reason, added_at",
+        "table": "blocked_domains",
+        "icon": "🌐",
+    },
+}
+
+
+def _like_escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _banlist_filter(kind: str, needle: str) -> tuple[str, list]:
+    if not needle:
+        return "", []
+    pattern = f"%{_like_escape(needle)}%"
+    if kind == "u":
+        if needle.isdigit():
+            return " AND CAST(telegram_id AS TEXT) LIKE ? ESCAPE '\\'", [f"{needle}%"]
+        return " AND reason LIKE ? ESCAPE '\\'", [pattern]
+    return " AND (domain LIKE ? ESCAPE '\\' OR reason LIKE ? ESCAPE '\\')", [pattern, pattern]
+
+
+def fetch_banlist_page(kind: str, cursor: int, direction: str, needle: str) -> tuple[list, bool, bool]:
+    """
+    صفحة واحدة بالـ keyset على id (المفتاح الأساسي):
+    n = ما بعد cursor، p = ما قبله. يرجع (الصفوف, يوجد سابق, يوجد تالٍ)
+    """
+    spec = BANLIST_KINDS[kind]
+    filter_sql, filter_params = _banlist_filter(kind, needle)
+    base = f"SELECT id, {spec['columns']} FROM {spec['table']} WHERE 1 = 1{filter_sql}"
+
+    with closing(get_conn()) as conn:
+        c = conn.cursor()
+        if direction == "p":
+            c.execute(f"{base} AND id < ? ORDER BY id DESC LIMIT ?;", (*filter_params, cursor, BANLIST_PAGE + 1))
+            rows = c.fetchall()
+            has_prev = len(rows) > BANLIST_PAGE
+            rows = rows[:BANLIST_PAGE][::-1]
+            has_next = True
+        else:
+            c.execute(f"{base} AND id > ? ORDER BY id LIMIT ?;", (*filter_params, cursor, BANLIST_PAGE + 1))
+            rows = c.fetchall()
+            has_next = len(rows) > BANLIST_PAGE
+            rows = rows[:BANLIST_PAGE]
+            has_prev = cursor > 0 and bool(rows)
+            if has_prev:
+                c.execute(f"SELECT 1 FROM {spec['table']} WHERE id < ?{filter_sql} LIMIT 1;", (rows[0][0], *filter_params))
+                has_prev = c.fetchone() is not None
+    return rows, has_prev, has_next
+
+
+def banlist_callback(kind: str, direction: str, cursor: int, needle: str) -> str:
+    return f"bl:{kind}:{direction}:{cursor}:{needle}"
+
+
+def render_banlist(kind: str, cursor: int, direction: str, needle: str) -> tuple[str, InlineKeyboardMarkup]:
+    spec = BANLIST_KINDS[kind]
+    rows, has_prev, has_next = fetch_banlist_page(kind, cursor, direction, needle)
+
+    header = spec["title"] + (f" (بحث: {needle})" if needle else "") + ":"
+    if rows:
+        lines = []
+        for _id, key, reason, at in rows:
+            reason = reason or "-"
+            if len(reason) > BANLIST_REASON_CHARS:
+                reason = reason[:BANLIST_REASON_CHARS] + "…"
+            lines.append(f"{spec['icon']} {key} | سبب: {reason} | وقت: {at or '-'}")
+        text = header + "\n\n" + "\n".join(lines)
+    else:
+        text = header + "\n\n" + spec["empty"]
+
+    nav = []
+    if has_prev and rows:
+        nav.append(InlineKeyboardButton(text="⬅️ السابق", callback_data=banlist_callback(kind, "p", rows[0][0], needle)))
+    if has_next and rows:
+        nav.append(InlineKeyboardButton(text="التالي ➡️", callback_data=banlist_callback(kind, "n", rows[-1][0], needle)))
+    other = "d" if kind == "u" else "u"
+    switch = InlineKeyboardButton(
+        text=BANLIST_KINDS[other]["title"], callback_data=banlist_callback(other, "n", 0, needle)
+    )
+    rows_kb = [nav, [switch]] if nav else [[switch]]
+    return text, InlineKeyboardMarkup(inline_keyboard=rows_kb)
+
+
 @router.message(Command("banlist"))
 async def cmd_ban_list(message: Message):
+    """
+    /banlist [users|domains] [بحث]: قائمة الحظر مقسّمة على صفحات
+    """
     if not is_admin(message.from_user.id):
         await message.answer("❌ هذا الأمر للأدمن فقط.")
         return
 
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT telegram_id, reason, banned_at FROM banned_users;")
-    users_rows = c.fetchall()
-    c.execute("SELECT domain, reason, added_at FROM blocked_domains;")
-    dom_rows = c.fetchall()
-    conn.close()
-
-    if users_rows:
-        users_text = "\n".join(
-            f"👤 {r[0]} | سبب: {r[1] or '-'} | وقت: {r[2] or '-'}"
-            for r in users_rows
-        )
-    else:
-        users_text = "لا يوجد مستخدمون محظورون."
+    args = message.text.split(maxsplit=2)[1:]
+    kind = "u"
+    if args and args[0] in ("users", "domains"):
+        kind = "u" if args.pop(0) == "users" else "d"
+    needle = " ".join(args).strip()
 
-    if dom_rows:
-        dom_text = "\n".join(
-            f"🌐 {r[0]} | سبب: {r[1] or '-'} | وقت: {r[2] or '-'}"
-            for r in dom_rows
-        )
-    else:
-        dom_text = "لا توجد دومينات محظورة إضافيًا."
+    # أطول callback ممكن يجب أن يبقى ضمن حد تيليجرام
+    if len(banlist_callback(kind, "n", 2**63 - 1, needle).encode("utf-8")) > CALLBACK_DATA_MAX:
+        await message.answer("❌ نص البحث طويل جدًا.")
+        return
 
-    await message.answer(
-        "📋 قائمة الحظر:\n\n"
-        f"👥 المستخدمون المحظورون:\n{users_text}\n\n"
-        f"🌐 الدومينات الإضافية المحظورة:\n{dom_text}"
-    )
+    text, kb = await asyncio.to_thread(render_banlist, kind, 0, "n", needle)
+    await message.answer(text, reply_markup=kb)
+
+
+@router.callback_query(F.data.startswith("bl:"))
+async def cb_ban_list(call: CallbackQuery):
+    if not is_admin(call.from_user.id):
+        await call.answer("❌ هذا الأمر للأدمن فقط.", show_alert=True)
+        return
+
+    try:
+        _prefix, kind, direction, cursor, needle = call.data.split(":", 4)
+        cursor = int(cursor)
+        if kind not in BANLIST_KINDS or direction not in ("n", "p"):
+            raise ValueError(call.data)
+    except ValueError:
+        await call.answer()
+        return
+
+    text, kb = await asyncio.to_thread(render_banlist, kind, cursor, direction, needle)
+    await call.answer()
+    try:
+        await call.message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest:
+        # نفس المحتوى (message is not modified)
+        pass
 
 
 @router.message(Command("statsdb"))
@@ -635,36 +2343,35 @@ async def cmd_stats_db(message: Message):
         await message.answer("❌ هذا الأمر للأدمن فقط.")
         return
 
-    conn = get_conn()
-    c = conn.cursor()
-
-    # إجمالي الطلبات
-    c.execute("SELECT COUNT(*) FROM requests;")
-    total = c.fetchone()[0] or 0
-
-    # حسب نوع الطلب
-    c.execute("""
-        SELECT action_type, COUNT(*)
-        FROM requests
-        GROUP BY action_type;
-    """)
-    rows_type = c.fetchall()
-    by_type = {r[0] or "unknown": r[1] for r in rows_type}
-
-    # حسب الحالة (نجاح / فشل)
-    c.execute("""
-        SELECT status, COUNT(*)
-        FROM requests
-        GROUP BY status;
-    """)
-    rows_status = c.fetchall()
-    by_status = {r[0] or "unknown": r[1] for r in rows_status}
-
-    # عدد المستخدمين
-    c.execute("SELECT COUNT(*) FROM users;")
-    users_count = c.fetchone()[0] or 0
-
-    conn.close()
+    with closing(get_conn()) as conn:
+        c = conn.cursor()
+
+        # إجمالي الطلبات
+        c.execute("SELECT COUNT(*) FROM requests;")
+        total = c.fetchone()[0] or 0
+
+        # حسب نوع الطلب
+        c.execute("""
+            SELECT action_type, COUNT(*)
+            FROM requests
+            GROUP BY action_type;
+        """)
+        rows_type = c.fetchall()
+        by_type = {r[0] or "unknown": r[1] for r in rows_type}
+
+        # حسب الحالة (نجاح / فشل)
+        c.execute("""
+            SELECT status, COUNT(*)
+            FROM requests
+            GROUP BY status;
+        """)
+        rows_status = c.fetchall()
+        by_status = {r[0] or "unknown": r[1] for r in rows_status}
+
+        # عدد المستخدمين
+        c.execute("SELECT COUNT(*) FROM users;")
+        users_count = c.fetchone()[0] or 0
+
 
     text = (
         "📊 إحصائيات عامة من قاعدة البيانات:\n\n"
@@ -683,25 +2390,24 @@ async def cmd_stats_db(message: Message):
     await message.answer(text)
 
 
-@router.message(Command("topdomains")))
+@router.message(Command("topdomains"))
 async def cmd_top_domains(message: Message):
     """أكثر الدومينات استخدامًا"""
     if not is_admin(message.from_user.id):
         await message.answer("❌ هذا الأمر للأدمن فقط.")
         return
 
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("""
-        SELECT domain, COUNT(*) AS cnt
-        FROM requests
-        WHERE domain IS NOT NULL AND domain <> ''
-        GROUP BY domain
-        ORDER BY cnt DESC
-        LIMIT 10;
-    """)
-    rows = c.fetchall()
-    conn.close()
+    with closing(get_conn()) as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT domain, COUNT(*) AS cnt
+            FROM requests
+            WHERE domain IS NOT NULL AND domain <> ''
+            GROUP BY domain
+            ORDER BY cnt DESC
+            LIMIT 10;
+        """)
+        rows = c.fetchall()
 
     if not rows:
         await message.answer("ℹ️ لا توجد بيانات كافية عن الدومينات حتى الآن.")
@@ -721,16 +2427,15 @@ async def cmd_top_videos(message: Message):
         await message.answer("❌ هذا الأمر للأدمن فقط.")
         return
 
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("""
-        SELECT title, url, domain, times_used
-        FROM videos
-        ORDER BY times_used DESC
-        LIMIT 10;
-    """)
-    rows = c.fetchall()
-    conn.close()
+    with closing(get_conn()) as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT title, url, domain, times_used
+            FROM videos
+            ORDER BY times_used DESC
+            LIMIT 10;
+        """)
+        rows = c.fetchall()
 
     if not rows:
         await message.answer("ℹ️ لا توجد فيديوهات مسجلة حتى الآن.")
@@ -748,36 +2453,833 @@ async def cmd_top_videos(message: Message):
     await message.answer(text)
 
 
-# ================== أوامر البوت الأساسية ==================
-
-
-@router.message(Command("start"))
-async def cmd_start(message: Message):
-    await message.answer(
-        "👋 أهلاً بك في بوت الفيديو.\n\n"
-        "أرسل رابط من أي موقع يدعم الفيديو (YouTube, TikTok, Facebook, X, Vimeo, ...)\n"
-        "أو رابط فيديو مباشر (.mp4 / .webm / .mov / .mkv).\n\n"
-        "سيتم تحليل الرابط، ثم سيُطلب منك:\n"
-        "1️⃣ اختيار الإرسال كـ 🎬 فيديو أو 🎧 صوت.\n"
-        "2️⃣ لو اخترت فيديو سيتم إظهار جودات مختلفة (إن وُجدت) لتختار منها.\n\n"
-        "📌 بعض المنصات المحمية (مثل Netflix, Shahid...) محظورة.\n"
-    )
+# ================== تقرير الأداء (/perf) ==================
 
+# تعبير الزمن لكل مقياس؛ total = التحليل + التحميل + الرفع (upload_ms موجود لكل إرسال ناجح)
+PERF_METRICS = {
+    "total": "COALESCE(extract_ms, 0) + COALESCE(download_ms, 0) + upload_ms",
+    "extract": "extract_ms",
+    "download": "download_ms",
+    "upload": "upload_ms",
+}
+PERF_PERCENTILES = (50, 95, 99)
+PERF_DEFAULT_HOURS = 24
+PERF_MAX_HOURS = 24 * 90
+PERF_MAX_ROWS = 30
+
+PERF_USAGE = (
+    "استخدم الأمر بهذا الشكل:\n"
+    "/perf [hours] [domain] [total|extract|download|upload]"
+)
 
-@router.message(F.text)
-async def handle_link(message: Message):
-    # حظر المستخدم
-    if message.from_user.id in BANNED_USERS:
-        await message.answer("🚫 تم حظرك من استخدام هذا البوت.")
-        return
 
-    url = (message.text or "").strip()
+def parse_perf_args(text: str) -> dict:
+    """
+    الترتيب حر: رقم = عدد الساعات، اسم مقياس = المقياس، وغير ذلك = الدومين
+    """
+    opts = {"hours": PERF_DEFAULT_HOURS, "domain": None, "metric": "total"}
+    for arg in text.split()[1:]:
+        if arg.isdigit():
+            opts["hours"] = max(1, min(int(arg), PERF_MAX_HOURS))
+        elif arg.lower() in PERF_METRICS:
+            opts["metric"] = arg.lower()
+        elif "." in arg:
+            opts["domain"] = canonical_domain(arg if arg.startswith("http") else f"https://{arg}")
+        else:
+            raise ValueError(arg)
+    return opts
 
-    # تجهيز user في قاعدة البيانات
-    user_db_id = get_or_create_user(message.from_user)
-    domain = (urlparse(url).hostname or "").lower() if url.startswith("http") else ""
 
-    if not url.startswith("http"):
+@traced("db")
+def perf_report(hours: int, domain: str | None, metric: str) -> list[tuple]:
+    """
+    النسب المئوية لكل (دومين، نوع) في استعلام واحد: الصفوف مرتبة داخل كل مجموعة
+    بـ ROW_NUMBER، والنسبة p هي أول قيمة رتبتها >= p% من عدد المجموعة (nearest-rank).
+    نطاق الوقت يمر على idx_requests_created فلا يُقرأ إلا صفوف النافذة.
+    """
+    expr = PERF_METRICS[metric]
+    since = (datetime.utcnow() - timedelta(hours=hours)).isoformat()
+    where = [
+        "created_at >= ?",
+        "status = 'success'",
+        "action_type IN ('video', 'audio')",
+        f"({expr}) IS NOT NULL",
+    ]
+    params: list = [since]
+    if domain:
+        where.append("domain = ?")
+        params.append(domain)
+
+    cols = ",\n            ".join(f"MIN(CASE WHEN rn >= n * {p / 100} THEN v END)" for p in PERF_PERCENTILES)
+    sql = f"""
+        WITH w AS (
+            SELECT domain, action_type, bytes, ({expr}) AS v,
+                   ROW_NUMBER() OVER (PARTITION BY domain, action_type ORDER BY ({expr})) AS rn,
+                   COUNT(*) OVER (PARTITION BY domain, action_type) AS n
+            FROM requests
+            WHERE {' AND '.join(where)}
+        )
+        SELECT domain, action_type, MAX(n) AS cnt,
+            {cols},
+            SUM(bytes)
+        FROM w
+        GROUP BY domain, action_type
+        ORDER BY cnt DESC
+        LIMIT ?;
+    """
+    params.append(PERF_MAX_ROWS)
+
+    conn = get_conn()
+    try:
+        return conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+
+def _fmt_ms(ms: float | None) -> str:
+    if ms is None:
+        return "-"
+    return f"{ms:.0f}ms" if ms < 1000 else f"{ms / 1000:.1f}s"
+
+
+@router.message(Command("perf"))
+async def cmd_perf(message: Message):
+    """p50 / p95 / p99 لأزمنة الإرسال الناجحة لكل دومين ونوع خلال نافذة زمنية"""
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ هذا الأمر للأدمن فقط.")
+        return
+
+    try:
+        opts = parse_perf_args(message.text or "")
+    except ValueError as e:
+        await message.answer(f"❌ معامل غير معروف: {e}\n\n{PERF_USAGE}")
+        return
+
+    rows = await asyncio.to_thread(perf_report, opts["hours"], opts["domain"], opts["metric"])
+    if not rows:
+        await message.answer(f"ℹ️ لا توجد طلبات ناجحة مسجلة خلال آخر {opts['hours']} ساعة.")
+        return
+
+    labels = " / ".join(f"p{p}" for p in PERF_PERCENTILES)
+    text = f"⏱️ الأداء ({opts['metric']}) خلال آخر {opts['hours']} ساعة — {labels}:\n\n"
+    for domain, action, cnt, *percentiles, total_bytes in rows:
+        text += (
+            f"• {domain or '-'} [{action}] n={cnt}\n"
+            f"  {' / '.join(_fmt_ms(v) for v in percentiles)}"
+        )
+        if total_bytes:
+            text += f" | {total_bytes / (1024 * 1024):.1f}MB"
+        text += "\n"
+
+    await message.answer(text)
+
+
+PROFILE_USAGE = "استخدم الأمر بهذا الشكل:\n/profile <seconds> [all|bot|workers]"
+
+
+@router.message(Command("profile"))
+async def cmd_profile(message: Message):
+    """تحليل أداء البوت و/أو العمّال بأخذ عيّنات لمدة محددة؛ كل عملية ترسل ملفاتها"""
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ هذا الأمر للأدمن فقط.")
+        return
+
+    parts = message.text.split()
+    try:
+        seconds = int(parts[1]) if len(parts) > 1 else 10
+    except ValueError:
+        await message.answer(PROFILE_USAGE)
+        return
+    target = parts[2].lower() if len(parts) > 2 else "all"
+    if target not in PROFILE_TARGETS:
+        await message.answer(PROFILE_USAGE)
+        return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    # بدون عمّال (WORKER_COUNT=0) تُنفَّذ المهام داخل البوت نفسه
+    profile_bot = target in ("all", "bot") or WORKER_COUNT == 0
+    profile_workers = target in ("all", "workers")
+
+    if profile_bot and PROFILE_LOCK.locked():
+        await message.answer("⏳ يوجد تحليل أداء قيد التشغيل بالفعل.")
+        return
+
+    scope = {"all": "البوت + العمّال", "bot": "البوت", "workers": "العمّال"}[target]
+    await message.answer(f"🔬 بدء تحليل الأداء لمدة {seconds} ثانية ({scope})...")
+    if profile_workers:
+        await asyncio.to_thread(request_worker_profile, message.chat.id, seconds)
+    if profile_bot:
+        await run_profile(message.chat.id, seconds, "bot")
+
+
+@router.message(Command("startup"))
+async def cmd_startup(message: Message):
+    """تفصيل زمن آخر تشغيل للبوت"""
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ هذا الأمر للأدمن فقط.")
+        return
+
+    text = "⏱️ تفصيل زمن التشغيل (ms):\n\n"
+    for stage, ms in STARTUP_TIMINGS.items():
+        text += f"  • {stage}: {ms}\n"
+    await message.answer(text)
+
+
+# ================== البث الجماعي (broadcast) ==================
+
+# حد تيليجرام العام للرسائل الجماعية ~30 رسالة/ثانية؛ نبقى تحته بهامش
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+# البث يأخذ رموزه من الدلو العام للواجهة؛ هذا أقصى جزء منه حتى تبقى للرسائل التفاعلية حصة
+BROADCAST_SHARE = float(os.getenv("BROADCAST_SHARE", "0.6"))
+BROADCAST_CONCURRENCY = 25
+# عدد المستلمين في كل صفحة (keyset)؛ التقدم يُحفظ بعد كل صفحة
+BROADCAST_PAGE = 200
+BROADCAST_MAX_TRIES = 3
+BROADCAST_PROGRESS_INTERVAL = 15
+
+BROADCAST_BUCKET = TokenBucket(BROADCAST_RATE)
+BROADCAST_TASKS: dict[int, asyncio.Task] = {}
+
+
+def fit_broadcast_rate():
+    """
+    البث جزء من حصة هذه العملية من الحد العام وليس إضافة فوقها؛ يُستدعى بعد OUTBOUND.set_share
+    """
+    share = OUTBOUND.global_bucket.rate
+    if share > 0:
+        BROADCAST_BUCKET.set_rate(min(BROADCAST_RATE, share * BROADCAST_SHARE))
+
+
+def create_broadcast(admin_id: int, from_chat_id: int | None, message_id: int | None, text: str | None) -> int:
+    now = datetime.utcnow().isoformat()
+    with closing(get_conn()) as conn:
+        c = conn.cursor()
+        c.execute(
+            """
+            INSERT INTO broadcasts (admin_id, from_chat_id, message_id, text, status, created_at, updated_at)
+            VALUES (?, ?, ?, ?, 'running', ?, ?);
+            """,
+            (admin_id, from_chat_id, message_id, text, now, now),
+        )
+        broadcast_id = c.lastrowid
+        conn.commit()
+    return broadcast_id
+
+
+def get_broadcast(broadcast_id: int | None = None) -> dict | None:
+    """
+    البث المحدد، أو آخر بث لو لم يُحدد
+    """
+    with closing(get_conn()) as conn:
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        if broadcast_id is None:
+            c.execute("SELECT * FROM broadcasts ORDER BY id DESC LIMIT 1;")
+        else:
+            c.execute("SELECT * FROM broadcasts WHERE id = ?;", (broadcast_id,))
+        row = c.fetchone()
+    return dict(row) if row else None
+
+
+def set_broadcast_status(broadcast_id: int, status: str):
+    with closing(get_conn()) as conn:
+        conn.execute(
+            "UPDATE broadcasts SET status = ?, updated_at = ? WHERE id = ?;",
+            (status, datetime.utcnow().isoformat(), broadcast_id),
+        )
+        conn.commit()
+
+
+def fetch_broadcast_page(after_user_id: int) -> list[tuple[int, int]]:
+    with closing(get_conn()) as conn:
+        c = conn.cursor()
+        c.execute(
+            """
+            SELECT id, telegram_id FROM users
+            WHERE id > ? AND blocked_at IS NULL AND telegram_id IS NOT NULL
+            ORDER BY id
+            LIMIT ?;
+            """,
+            (after_user_id, BROADCAST_PAGE),
+        )
+        rows = c.fetchall()
+    return rows
+
+
+def save_broadcast_page(broadcast_id: int, last_user_id: int, counts: collections.Counter, blocked_ids: list[int]):
+    """
+    حفظ التقدم وتعليم المحظورين في معاملة واحدة
+    """
+    now = datetime.utcnow().isoformat()
+    with closing(get_conn()) as conn:
+        c = conn.cursor()
+        c.execute(
+            """
+            UPDATE broadcasts
+            SET last_user_id = ?, sent = sent + ?, failed = failed + ?, blocked = blocked + ?, updated_at = ?
+            WHERE id = ?;
+            """,
+            (last_user_id, counts["sent"], counts["failed"], counts["blocked"], now, broadcast_id),
+        )
+        c.executemany("UPDATE users SET blocked_at = ? WHERE id = ?;", [(now, uid) for uid in blocked_ids])
+        conn.commit()
+
+
+async def _broadcast_send_one(b: dict, telegram_id: int) -> str:
+    # BROADCAST_BUCKET يحد البث وحده، والدلو العام للجدول يجمعه مع الرسائل التفاعلية
+    token = OUTBOUND_SELF_PACED.set(True)
+    try:
+        for _attempt in range(BROADCAST_MAX_TRIES):
+            await BROADCAST_BUCKET.acquire()
+            try:
+                if b["message_id"]:
+                    await bot.copy_message(
+                        chat_id=telegram_id, from_chat_id=b["from_chat_id"], message_id=b["message_id"]
+                    )
+                else:
+                    await bot.send_message(telegram_id, b["text"])
+                return "sent"
+            except TelegramRetryAfter as e:
+                # تيليجرام طلب التوقف: نوقف كل المرسلين وليس هذا فقط
+                BROADCAST_BUCKET.pause(e.retry_after)
+                log.warning("broadcast_flood_wait", extra={"fields": {"retry_after": e.retry_after}})
+            except TelegramForbiddenError:
+                return "blocked"
+            except TelegramBadRequest as e:
+                if "chat not found" in str(e).lower() or "deactivated" in str(e).lower():
+                    return "blocked"
+                return "failed"
+            except Exception as e:
+                log.debug("broadcast send error: %s", e)
+                await asyncio.sleep(1)
+        return "failed"
+    finally:
+        OUTBOUND_SELF_PACED.reset(token)
+
+
+def broadcast_progress_text(b: dict) -> str:
+    return (
+        f"📣 البث #{b['id']} ({b['status']}):\n"
+        f"✅ أُرسل: {b['sent']}\n"
+        f"🚫 حظروا البوت: {b['blocked']}\n"
+        f"❌ فشل: {b['failed']}"
+    )
+
+
+async def run_broadcast(broadcast_id: int):
+    b = get_broadcast(broadcast_id)
+    if not b:
+        return
+    cursor = b["last_user_id"] or 0
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    last_report = time.monotonic()
+    log.info("broadcast_started", extra={"fields": {"broadcast_id": broadcast_id, "cursor": cursor}})
+
+    async def send(telegram_id: int) -> str:
+        async with sem:
+            return await _broadcast_send_one(b, telegram_id)
+
+    try:
+        while True:
+            rows = await asyncio.to_thread(fetch_broadcast_page, cursor)
+            if not rows:
+                await asyncio.to_thread(set_broadcast_status, broadcast_id, "done")
+                break
+
+            results = await asyncio.gather(*(send(tg_id) for _uid, tg_id in rows))
+            counts = collections.Counter(results)
+            blocked_ids = [uid for (uid, _tg), r in zip(rows, results) if r == "blocked"]
+            cursor = rows[-1][0]
+            await asyncio.to_thread(save_broadcast_page, broadcast_id, cursor, counts, blocked_ids)
+
+            current = await asyncio.to_thread(get_broadcast, broadcast_id)
+            if current["status"] != "running":
+                break
+            if b["admin_id"] and time.monotonic() - last_report > BROADCAST_PROGRESS_INTERVAL:
+                last_report = time.monotonic()
+                try:
+                    await bot.send_message(b["admin_id"], broadcast_progress_text(current))
+                except Exception:
+                    pass
+    finally:
+        BROADCAST_TASKS.pop(broadcast_id, None)
+
+    final = get_broadcast(broadcast_id)
+    log.info("broadcast_finished", extra={"fields": {k: final[k] for k in ("id", "status", "sent", "failed", "blocked")}})
+    if b["admin_id"]:
+        try:
+            await bot.send_message(b["admin_id"], broadcast_progress_text(final))
+        except Exception:
+            pass
+
+
+def start_broadcast_task(broadcast_id: int):
+    BROADCAST_TASKS[broadcast_id] = asyncio.create_task(run_broadcast(broadcast_id))
+
+
+def resume_broadcasts():
+    """
+    أي بث بقي running (توقف البوت أثناءه) يُستأنف من آخر صفحة محفوظة
+    """
+    with closing(get_conn()) as conn:
+        c = conn.cursor()
+        c.execute("SELECT id FROM broadcasts WHERE status = 'running';")
+        ids = [r[0] for r in c.fetchall()]
+    for broadcast_id in ids:
+        log.info("broadcast_resumed", extra={"fields": {"broadcast_id": broadcast_id}})
+        start_broadcast_task(broadcast_id)
+
+
+@router.message(Command("broadcast"))
+async def cmd_broadcast(message: Message):
+    """
+    /broadcast <نص> أو بالرد على رسالة (تُنسخ كما هي)، و /broadcast status | cancel
+    """
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ هذا الأمر للأدمن فقط.")
+        return
+
+    parts = message.text.split(maxsplit=1)
+    arg = parts[1].strip() if len(parts) > 1 else ""
+
+    if arg in ("status", "cancel"):
+        b = get_broadcast()
+        if not b:
+            await message.answer("ℹ️ لا يوجد أي بث حتى الآن.")
+            return
+        if arg == "cancel" and b["status"] == "running":
+            set_broadcast_status(b["id"], "cancelled")
+            b["status"] = "cancelled"
+        await message.answer(broadcast_progress_text(b))
+        return
+
+    if BROADCAST_TASKS:
+        await message.answer("⏳ يوجد بث قيد التشغيل بالفعل، استخدم /broadcast status أو /broadcast cancel")
+        return
+
+    if message.reply_to_message:
+        broadcast_id = create_broadcast(
+            message.from_user.id, message.chat.id, message.reply_to_message.message_id, None
+        )
+    elif arg:
+        broadcast_id = create_broadcast(message.from_user.id, None, None, arg)
+    else:
+        await message.answer(
+            "استخدم الأمر بهذا الشكل:\n/broadcast <النص>\nأو رُد على رسالة بـ /broadcast لنسخها لكل المستخدمين."
+        )
+        return
+
+    start_broadcast_task(broadcast_id)
+    await message.answer(f"📣 بدأ البث #{broadcast_id} لكل المستخدمين...")
+
+
+# ================== تصدير البيانات (export) ==================
+
+# الجداول المسموح بتصديرها وعمود التاريخ الذي يُفلتر عليه كل منها
+EXPORT_TABLES = {
+    "requests": "created_at",
+    "videos": "first_seen_at",
+    "users": "created_at",
+}
+EXPORT_FORMATS = ("csv", "jsonl")
+EXPORT_BATCH = 1000
+
+EXPORT_LOCK = asyncio.Lock()
+
+EXPORT_USAGE = (
+    "استخدم الأمر بهذا الشكل:\n"
+    "/export <requests|videos|users> [csv|jsonl] [from=YYYY-MM-DD] [to=YYYY-MM-DD] [cols=a,b,c] [after=id]"
+)
+
+
+def table_columns(table: str) -> list[str]:
+    with closing(get_conn()) as conn:
+        c = conn.cursor()
+        c.execute(f"PRAGMA table_info({table});")
+        cols = [row[1] for row in c.fetchall()]
+    return cols
+
+
+def parse_export_args(args: list[str]) -> dict:
+    """
+    يرجع إعدادات التصدير، أو يرمي ValueError برسالة مناسبة للأدمن
+    """
+    if not args or args[0] not in EXPORT_TABLES:
+        raise ValueError(EXPORT_USAGE)
+    opts = {"table": args[0], "fmt": "csv", "from": None, "to": None, "cols": None, "after": 0}
+    for arg in args[1:]:
+        key, sep, value = arg.partition("=")
+        if not sep and key in EXPORT_FORMATS:
+            opts["fmt"] = key
+        elif key in ("from", "to"):
+            try:
+                day = datetime.strptime(value, "%Y-%m-%d")
+            except ValueError:
+                raise ValueError(f"❌ تاريخ غير صالح: {value}")
+            # to شامل لليوم كله
+            opts[key] = (day + timedelta(days=1) if key == "to" else day).isoformat()
+        elif key == "cols":
+            opts["cols"] = [col.strip() for col in value.split(",") if col.strip()]
+        elif key == "after" and value.isdigit():
+            opts["after"] = int(value)
+        else:
+            raise ValueError(f"❌ خيار غير معروف: {arg}\n\n{EXPORT_USAGE}")
+
+    available = table_columns(opts["table"])
+    if opts["cols"] is None:
+        opts["cols"] = available
+    unknown = [col for col in opts["cols"] if col not in available]
+    if unknown:
+        raise ValueError(f"❌ أعمدة غير موجودة: {', '.join(unknown)}\nالمتاح: {', '.join(available)}")
+    return opts
+
+
+@traced("export")
+def export_table(opts: dict, path: str, max_bytes: int) -> dict:
+    """
+    يقرأ الصفوف على دفعات (fetchmany) ويكتبها مضغوطة مباشرة إلى الملف،
+    فلا يُحمَّل الناتج كاملًا في الذاكرة. يتوقف عند max_bytes ويرجع آخر id
+    حتى يكمل الأدمن بـ after=
+    """
+    table, cols = opts["table"], opts["cols"]
+    date_col = EXPORT_TABLES[table]
+    where, params = ["id > ?"], [opts["after"]]
+    if opts["from"]:
+        where.append(f"{date_col} >= ?")
+        params.append(opts["from"])
+    if opts["to"]:
+        where.append(f"{date_col} < ?")
+        params.append(opts["to"])
+    # id يُجلب دائمًا لتتبع موضع التوقف حتى لو لم يُطلب ضمن الأعمدة
+    sql = (
+        f"SELECT id, {', '.join(cols)} FROM {table} "
+        f"WHERE {' AND '.join(where)} ORDER BY id;"
+    )
+
+    rows = 0
+    last_id = opts["after"]
+    truncated = False
+    conn = get_conn()
+    try:
+        cur = conn.execute(sql, params)
+        with open(path, "wb") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6) as gz:
+                out = io.TextIOWrapper(gz, encoding="utf-8", newline="")
+                writer = csv.writer(out) if opts["fmt"] == "csv" else None
+                if writer:
+                    writer.writerow(cols)
+                while True:
+                    batch = cur.fetchmany(EXPORT_BATCH)
+                    if not batch:
+                        break
+                    for row in batch:
+                        if writer:
+                            writer.writerow(row[1:])
+                        else:
+                            out.write(json.dumps(dict(zip(cols, row[1:])), ensure_ascii=False) + "\n")
+                    rows += len(batch)
+                    last_id = batch[-1][0]
+                    out.flush()
+                    if raw.tell() >= max_bytes:
+                        truncated = True
+                        break
+                out.flush()
+                out.detach()
+    finally:
+        conn.close()
+    return {"rows": rows, "last_id": last_id, "truncated": truncated, "bytes": os.path.getsize(path)}
+
+
+@router.message(Command("export"))
+async def cmd_export(message: Message):
+    """تصدير جدول كاملًا أو جزئيًا كملف CSV/JSONL مضغوط"""
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ هذا الأمر للأدمن فقط.")
+        return
+
+    try:
+        opts = await asyncio.to_thread(parse_export_args, message.text.split()[1:])
+    except ValueError as e:
+        await message.answer(str(e))
+        return
+
+    if EXPORT_LOCK.locked():
+        await message.answer("⏳ يوجد تصدير قيد التشغيل بالفعل.")
+        return
+
+    async with EXPORT_LOCK:
+        await message.answer(f"📦 جاري تصدير {opts['table']}...")
+        workspace = new_workspace()
+        stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+        filename = f"{opts['table']}-{stamp}.{opts['fmt']}.gz"
+        path = os.path.join(workspace, filename)
+        try:
+            # هامش صغير تحت حد الرفع لأن آخر دفعة تُكتب قبل الفحص
+            result = await asyncio.to_thread(export_table, opts, path, MAX_UPLOAD_BYTES - 2 * 1024 * 1024)
+            log.info("export_done", extra={"fields": {"table": opts["table"], **result}})
+
+            caption = f"📊 {opts['table']}: {result['rows']} صف"
+            if result["truncated"]:
+                caption += (
+                    f"\n⚠️ توقف التصدير عند حد حجم الملف، للإكمال أضف after={result['last_id']}"
+                )
+            await message.answer_document(FSInputFile(path, filename=filename), caption=caption)
+        except Exception as e:
+            log.exception("export_failed")
+            await message.answer(f"❌ فشل التصدير: {e}")
+        finally:
+            remove_workspace(workspace)
+
+
+# ================== حدود التحميل لكل مصدر (origin limits) ==================
+
+# عند الضغط تخنق المواقع (يوتيوب/تيك توك) عنوان IP كله، فنحد التوازي والسرعة لكل دومين.
+# kbps = 0 يعني بدون حد. "*" = الافتراضي لأي دومين، "global" = مجموع كل التحميلات.
+DEFAULT_ORIGIN_LIMITS = {
+    "*": {"concurrency": int(os.getenv("ORIGIN_CONCURRENCY", "4")), "kbps": int(os.getenv("ORIGIN_KBPS", "0"))},
+    "global": {"concurrency": int(os.getenv("DOWNLOAD_CONCURRENCY", "0")), "kbps": int(os.getenv("EGRESS_KBPS", "0"))},
+    "youtube.com": {"concurrency": 3, "kbps": 0},
+    "tiktok.com": {"concurrency": 2, "kbps": 0},
+}
+# كل عملية تعيد قراءة القيم المعدلة من القاعدة بعد هذه المدة
+ORIGIN_LIMITS_RELOAD = 10
+ORIGIN_SLOT_POLL = 1.0
+
+
+class OriginLimiter:
+    """
+    حد التوازي (عدد التحميلات الجارية) ودلو رموز للسرعة لكل دومين، مع حد عام فوق الكل.
+    يعمل من خيوط التحميل؛ القيم قابلة للتعديل أثناء التشغيل (/setlimit).
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self.limits: dict[str, dict] = {k: dict(v) for k, v in DEFAULT_ORIGIN_LIMITS.items()}
+        self.active: collections.Counter = collections.Counter()
+        self.buckets: dict[str, TokenBucket] = {}
+        self.share = 1
+        self.loaded_at = 0.0
+
+    def set_share(self, processes: int):
+        """
+        العمّال عمليات منفصلة؛ الحدود تُقسم بينها
+        """
+        with self._cond:
+            self.share = max(1, processes)
+            self.buckets.clear()
+
+    def reload(self):
+        limits = {k: dict(v) for k, v in DEFAULT_ORIGIN_LIMITS.items()}
+        with closing(get_conn()) as conn:
+            c = conn.cursor()
+            c.execute("SELECT domain, concurrency, kbps FROM origin_limits;")
+            for domain, concurrency, kbps in c.fetchall():
+                limits[domain] = {"concurrency": concurrency, "kbps": kbps}
+        with self._cond:
+            self.limits = limits
+            self.loaded_at = time.monotonic()
+            # السرعات قد تغيرت؛ الدلاء تُبنى من جديد عند أول استخدام
+            self.buckets.clear()
+            self._cond.notify_all()
+
+    def _maybe_reload(self):
+        if time.monotonic() - self.loaded_at > ORIGIN_LIMITS_RELOAD:
+            try:
+                self.reload()
+            except Exception as e:
+                log.warning("origin limits reload error: %s", e)
+                self.loaded_at = time.monotonic()
+
+    def limit(self, key: str) -> dict:
+        return self.limits.get(key) or self.limits["*"]
+
+    def _cap(self, key: str) -> int:
+        cap = self.limit(key)["concurrency"]
+        return 0 if cap <= 0 else max(1, -(-cap // self.share))
+
+    def _bucket(self, key: str) -> TokenBucket | None:
+        kbps = self.limit(key)["kbps"]
+        if kbps <= 0:
+            return None
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            rate = kbps * 1024 / self.share
+            bucket = self.buckets[key] = TokenBucket(rate, rate)
+        return bucket
+
+    def _has_room(self, domain: str) -> bool:
+        cap, total_cap = self._cap(domain), self._cap("global")
+        if cap and self.active[domain] >= cap:
+            return False
+        if total_cap and sum(self.active.values()) >= total_cap:
+            return False
+        return True
+
+    @contextmanager
+    def slot(self, url: str, cancel_event: threading.Event | None = None):
+        """
+        ينتظر مكانًا لهذا الدومين ثم يعطي throttle(nbytes) الذي يبطئ القارئ حسب الدلو
+        """
+        self._maybe_reload()
+        domain = canonical_domain(url) or "*"
+        with span("origin_wait"):
+            with self._cond:
+                while not self._has_room(domain):
+                    if cancel_event is not None and cancel_event.is_set():
+                        raise RuntimeError("cancelled")
+                    self._cond.wait(ORIGIN_SLOT_POLL)
+                self.active[domain] += 1
+                buckets = [b for b in (self._bucket(domain), self._bucket("global")) if b is not None]
+
+        def throttle(nbytes: int):
+            for bucket in buckets:
+                bucket.acquire_blocking(nbytes)
+
+        try:
+            yield throttle
+        finally:
+            with self._cond:
+                self.active[domain] -= 1
+                if self.active[domain] <= 0:
+                    del self.active[domain]
+                self._cond.notify_all()
+
+
+ORIGIN_LIMITER = OriginLimiter()
+
+
+def throttle_hook(throttle):
+    """
+    progress hook لـ yt-dlp: يحجز من الدلو بقدر ما نزل منذ آخر استدعاء؛
+    الانتظار داخل الـ hook يبطئ حلقة التحميل نفسها
+    """
+    seen = {"bytes": 0}
+
+    def hook(status: dict):
+        if status.get("status") != "downloading":
+            return
+        done = status.get("downloaded_bytes") or 0
+        if done < seen["bytes"]:
+            # ملف جديد (فيديو ثم صوت للدمج)
+            seen["bytes"] = 0
+        if done > seen["bytes"]:
+            throttle(done - seen["bytes"])
+            seen["bytes"] = done
+
+    return hook
+
+
+def set_origin_limit(domain: str, concurrency: int, kbps: int):
+    with closing(get_conn()) as conn:
+        conn.execute(
+            """
+            INSERT INTO origin_limits (domain, concurrency, kbps, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(domain) DO UPDATE SET
+                concurrency = excluded.concurrency, kbps = excluded.kbps, updated_at = excluded.updated_at;
+            """,
+            (domain, concurrency, kbps, datetime.utcnow().isoformat()),
+        )
+        conn.commit()
+
+
+def reset_origin_limit(domain: str):
+    with closing(get_conn()) as conn:
+        conn.execute("DELETE FROM origin_limits WHERE domain = ?;", (domain,))
+        conn.commit()
+
+
+def _fmt_limit(limit: dict) -> str:
+    concurrency = limit["concurrency"] or "∞"
+    kbps = f"{limit['kbps']} KB/s" if limit["kbps"] else "∞"
+    return f"توازي: {concurrency} | سرعة: {kbps}"
+
+
+@router.message(Command("limits"))
+async def cmd_limits(message: Message):
+    """حدود التحميل الحالية لكل مصدر والتحميلات الجارية في هذه العملية"""
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ هذا الأمر للأدمن فقط.")
+        return
+
+    await asyncio.to_thread(ORIGIN_LIMITER.reload)
+    lines = ["🚦 حدود التحميل لكل مصدر:\n"]
+    for domain, limit in sorted(ORIGIN_LIMITER.limits.items()):
+        active = sum(ORIGIN_LIMITER.active.values()) if domain == "global" else ORIGIN_LIMITER.active.get(domain, 0)
+        lines.append(f"🌐 {domain} | {_fmt_limit(limit)} | جارٍ: {active}")
+    lines.append("\nللتعديل: /setlimit <domain|*|global> concurrency=N kbps=N  (0 = بدون حد)")
+    lines.append("للرجوع للافتراضي: /setlimit <domain> reset")
+    await message.answer("\n".join(lines))
+
+
+@router.message(Command("setlimit"))
+async def cmd_set_limit(message: Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ هذا الأمر للأدمن فقط.")
+        return
+
+    args = message.text.split()[1:]
+    usage = "استخدم الأمر بهذا الشكل:\n/setlimit <domain|*|global> concurrency=N kbps=N\n/setlimit <domain> reset"
+    if len(args) < 2:
+        await message.answer(usage)
+        return
+
+    target = args[0].lower()
+    if target not in ("*", "global"):
+        target = canonical_domain(target if target.startswith("http") else f"https://{target}") or target
+
+    if args[1] == "reset":
+        await asyncio.to_thread(reset_origin_limit, target)
+    else:
+        limit = dict(ORIGIN_LIMITER.limit(target))
+        for arg in args[1:]:
+            key, _sep, value = arg.partition("=")
+            if key not in ("concurrency", "kbps") or not value.isdigit():
+                await message.answer(usage)
+                return
+            limit[key] = int(value)
+        await asyncio.to_thread(set_origin_limit, target, limit["concurrency"], limit["kbps"])
+
+    await asyncio.to_thread(ORIGIN_LIMITER.reload)
+    log.info("origin_limit_changed", extra={"fields": {"domain": target, **ORIGIN_LIMITER.limit(target)}})
+    await message.answer(
+        f"✅ {target}: {_fmt_limit(ORIGIN_LIMITER.limit(target))}\n"
+        f"(بقية العمليات تطبقه خلال {ORIGIN_LIMITS_RELOAD} ثوانٍ)"
+    )
+
+
+# ================== أوامر البوت الأساسية ==================
+
+
+@router.message(Command("start"))
+async def cmd_start(message: Message):
+    await message.answer(
+        "👋 أهلاً بك في بوت الفيديو.\n\n"
+        "أرسل رابط من أي موقع يدعم الفيديو (YouTube, TikTok, Facebook, X, Vimeo, ...)\n"
+        "أو رابط فيديو مباشر (.mp4 / .webm / .mov / .mkv).\n\n"
+        "سيتم تحليل الرابط، ثم سيُطلب منك:\n"
+        "1️⃣ اختيار الإرسال كـ 🎬 فيديو أو 🎧 صوت.\n"
+        "2️⃣ لو اخترت فيديو سيتم إظهار جودات مختلفة (إن وُجدت) لتختار منها.\n\n"
+        "📌 بعض المنصات المحمية (مثل Netflix, Shahid...) محظورة.\n"
+    )
+
+
+@router.message(F.text)
+async def handle_link(message: Message):
+    trace_id = bind_trace()
+
+    # حظر المستخدم
+    if message.from_user.id in BANNED_USERS:
+        await message.answer("🚫 تم حظرك من استخدام هذا البوت.")
+        return
+
+    url = (message.text or "").strip()
+    if url.startswith("http"):
+        url = canonicalize_url(url)
+
+    # تجهيز user (من الذاكرة، والكتابة في القاعدة مؤجلة)
+    user_db_id = USER_REGISTRY.touch(message.from_user)
+    domain = canonical_domain(url) if url.startswith("http") else ""
+
+    if not url.startswith("http"):
         await message.answer("❌ الرجاء إرسال رابط صحيح يبدأ بـ http أو https.")
         log_request_db(
             user_id=user_db_id,
@@ -805,172 +3307,1385 @@ async def handle_link(message: Message):
         )
         return
 
-    wait_msg = await message.answer("🔍 جاري تحليل الرابط...")
+    breaker = get_breaker(domain)
+    if not breaker.allow():
+        await message.answer(breaker_open_text(breaker))
+        log_request_db(
+            user_id=user_db_id,
+            url=url,
+            domain=domain,
+            action_type="unknown",
+            quality="",
+            status="fail",
+            error="circuit_open",
+        )
+        return
+
+    try:
+        wait_msg = await message.answer("🔍 جاري تحليل الرابط...")
+    except Exception:
+        breaker.release()
+        raise
+
+    try:
+        started = time.perf_counter()
+        with breaker.attempt() as report:
+            video_info = await run_with_deadline(
+                "extract", get_direct_video_url, url, cancel_event=threading.Event()
+            )
+            report(breaker_outcome(video_info))
+        extract_ms = (time.perf_counter() - started) * 1000
+
+        if not video_info.get("success"):
+            await wait_msg.edit_text(f"❌ {video_info.get('error', 'تعذر التعامل مع الرابط.')}")
+            log_request_db(
+                user_id=user_db_id,
+                url=url,
+                domain=domain,
+                action_type="unknown",
+                quality="",
+                status="fail",
+                error=video_info.get("error", "extract_error"),
+                extract_ms=extract_ms,
+            )
+            return
+
+        # يُحفظ مع الجلسة حتى يُسجَّل مع طلب الإرسال بعد اختيار المستخدم
+        video_info["extract_ms"] = round(extract_ms, 1)
+
+        vtype = video_info.get("type", "unknown")
+
+        if vtype == "direct":
+            platform_name = "رابط مباشر"
+        elif vtype in ["link", "unknown"]:
+            platform_name = "منصة غير معروفة"
+        else:
+            platform_name = vtype.capitalize()
+
+        info_text = f"✅ تم العثور على فيديو من: {platform_name}\n"
+
+        if video_info.get("title"):
+            title = video_info["title"]
+            if len(title) > 50:
+                title = title[:50] + "..."
+            info_text += f"📹 {title}\n"
+
+        if video_info.get("uploader"):
+            info_text += f"👤 {video_info['uploader']}\n"
+
+        if video_info.get("duration"):
+            minutes = video_info["duration"] // 60
+            seconds = video_info["duration"] % 60
+            info_text += f"⏱️ {minutes}:{seconds:02d}\n"
+
+        session_id = await asyncio.to_thread(
+            create_link_session, message.from_user.id, user_db_id, url, platform_name, video_info, trace_id
+        )
+        keep_prefetch(session_id, await start_prefetch(url, domain, video_info))
+
+        kb = InlineKeyboardMarkup(
+            inline_keyboard=[
+                [
+                    InlineKeyboardButton(text="🎬 فيديو", callback_data=type_callback("v", session_id)),
+                    InlineKeyboardButton(text="🎧 صوت", callback_data=type_callback("a", session_id)),
+                ]
+            ]
+        )
+
+        await wait_msg.edit_text(
+            info_text + "\n\nاختر نوع الإرسال الذي تريده:", reply_markup=kb
+        )
+        log_trace_summary("link_analyzed", domain=domain, vtype=vtype)
+
+    except Exception as e:
+        log.exception("Unexpected error: %s", e)
+        try:
+            await wait_msg.edit_text(f"❌ حدث خطأ غير متوقع أثناء معالجة الرابط:\n{e}")
+        except Exception:
+            pass
+        log_request_db(
+            user_id=user_db_id,
+            url=url,
+            domain=domain,
+            action_type="unknown",
+            quality="",
+            status="fail",
+            error=str(e),
+        )
+
+
+# ================== جلسات الروابط وأزرار الإرسال ==================
+
+# الجلسة تبقى صالحة يومًا؛ بعدها يطلب البوت إرسال الرابط من جديد
+LINK_SESSION_TTL = 24 * 3600
+LINK_SESSION_PURGE_INTERVAL = 3600
+# مفتاح توقيع الأزرار: مشترك بين كل العمليات التي تستخدم نفس التوكن
+CALLBACK_SECRET = (os.getenv("CALLBACK_SECRET") or "").encode() or hashlib.sha256(
+    b"callback:" + BOT_TOKEN.encode()
+).digest()
+CALLBACK_SIG_BYTES = 6
+
+SESSION_EXPIRED_TEXT = "⏳ انتهت الجلسة، أرسل الرابط مرة أخرى."
+
+# التحميل المسبق محلي في العملية التي حللت الرابط؛ الأزرار تعمل بدونه من أي عملية
+SESSION_PREFETCHES: dict[int, "Prefetch"] = {}
+
+
+def create_link_session(
+    telegram_id: int, user_db_id: int | None, url: str, platform_name: str, video_info: dict, trace_id: str
+) -> int:
+    with closing(get_conn()) as conn:
+        c = conn.cursor()
+        c.execute(
+            """
+            INSERT INTO link_sessions (telegram_id, user_db_id, url, platform_name, video_info, trace_id, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?);
+            """,
+            (telegram_id, user_db_id, url, platform_name, json.dumps(video_info, ensure_ascii=False), trace_id, time.time()),
+        )
+        session_id = c.lastrowid
+        conn.commit()
+    return session_id
+
+
+def load_link_session(session_id: int, telegram_id: int) -> dict | None:
+    with closing(get_conn()) as conn:
+        c = conn.cursor()
+        c.execute(
+            """
+            SELECT url, video_info, platform_name, user_db_id, trace_id FROM link_sessions
+            WHERE id = ? AND telegram_id = ? AND created_at > ?;
+            """,
+            (session_id, telegram_id, time.time() - LINK_SESSION_TTL),
+        )
+        row = c.fetchone()
+    if not row:
+        return None
+    return {
+        "url": row[0],
+        "video_info": json.loads(row[1]),
+        "platform_name": row[2],
+        "user_db_id": row[3],
+        "trace_id": row[4],
+        "prefetch": SESSION_PREFETCHES.pop(session_id, None),
+    }
+
+
+def purge_link_sessions() -> int:
+    with closing(get_conn()) as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM link_sessions WHERE created_at < ?;", (time.time() - LINK_SESSION_TTL,))
+        deleted = c.rowcount
+        conn.commit()
+    return deleted
+
+
+async def link_session_purge_loop(stop: asyncio.Event):
+    while not stop.is_set():
+        try:
+            deleted = await asyncio.to_thread(purge_link_sessions)
+            if deleted:
+                log.info("link_sessions_purged", extra={"fields": {"count": deleted}})
+        except Exception as e:
+            log.warning("link sessions purge error: %s", e)
+        try:
+            deleted = await asyncio.to_thread(purge_finished_jobs)
+            if deleted:
+                log.info("jobs_purged", extra={"fields": {"count": deleted}})
+        except Exception as e:
+            log.warning("jobs purge error: %s", e)
+        await _wait_or_stop(stop, LINK_SESSION_PURGE_INTERVAL)
+
+
+def keep_prefetch(session_id: int, pf: "Prefetch | None"):
+    if pf is None:
+        return
+    SESSION_PREFETCHES[session_id] = pf
+    loop = asyncio.get_running_loop()
+    pf.task.add_done_callback(
+        lambda _t: loop.call_later(PREFETCH_TTL, SESSION_PREFETCHES.pop, session_id, None)
+    )
+
+
+def _b36(n: int) -> str:
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    out = ""
+    while True:
+        n, r = divmod(n, 36)
+        out = digits[r] + out
+        if not n:
+            return out
+
+
+def _sign(payload: str) -> str:
+    digest = hmac.new(CALLBACK_SECRET, payload.encode("utf-8"), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:CALLBACK_SIG_BYTES]).decode("ascii")
+
+
+def type_callback(kind: str, session_id: int) -> str:
+    """
+    t:<v|a>:<session>:<sig>
+    """
+    payload = f"t:{kind}:{_b36(session_id)}"
+    return f"{payload}:{_sign(payload)}"
+
+
+def quality_callback(session_id: int, height: int | None, format_id: str | None) -> str:
+    """
+    q:<session>:<height|0>:<sig>:<format_id>؛ format_id آخرًا لأنه قد يحوي ":"،
+    ويُحذف لو تجاوز الناتج حد تيليجرام (تكفي الجودة حينها)
+    """
+    head = f"q:{_b36(session_id)}:{height or 0}"
+    for fid in (format_id or "", ""):
+        data = f"{head}:{_sign(head + ':' + fid)}:{fid}"
+        if len(data.encode("utf-8")) <= CALLBACK_DATA_MAX:
+            return data
+    raise ValueError("callback data too long")
+
+
+def parse_callback(data: str) -> dict | None:
+    """
+    يرجع محتوى الزر بعد التحقق من توقيعه، أو None لو كان مزورًا أو قديم الصيغة
+    """
+    try:
+        if data.startswith("t:"):
+            _t, kind, sid, sig = data.split(":", 3)
+            payload = f"t:{kind}:{sid}"
+            fields = {"kind": kind}
+        elif data.startswith("q:"):
+            _q, sid, height, sig, fid = data.split(":", 4)
+            payload = f"q:{sid}:{height}:{fid}"
+            fields = {"kind": "q", "height": int(height) or None, "format_id": fid or None}
+        else:
+            return None
+        if not hmac.compare_digest(sig, _sign(payload)):
+            return None
+        return {"session_id": int(sid, 36), **fields}
+    except ValueError:
+        return None
+
+
+async def load_callback_session(call: CallbackQuery) -> tuple[dict, dict] | None:
+    token = parse_callback(call.data)
+    state = None
+    if call.from_user.id in BANNED_USERS:
+        await call.answer("🚫 تم حظرك من استخدام هذا البوت.", show_alert=True)
+        return None
+    if token is not None:
+        state = await asyncio.to_thread(load_link_session, token["session_id"], call.from_user.id)
+    if state is None:
+        await call.answer(SESSION_EXPIRED_TEXT, show_alert=True)
+        return None
+    bind_trace(state.get("trace_id"))
+    return token, state
+
+
+@router.callback_query(F.data.startswith("t:"))
+async def cb_choose_type(call: CallbackQuery):
+    loaded = await load_callback_session(call)
+    if loaded is None:
+        return
+    token, state = loaded
+
+    url = state["url"]
+    video_info = state["video_info"]
+    platform_name = state["platform_name"]
+    user_db_id = state["user_db_id"]
+
+    await call.answer()
+
+    if token["kind"] == "a":
+        await call.message.edit_text("🎧 جاري تجهيز الصوت وإرساله، انتظر قليلاً...")
+        await submit_with_prefetch(
+            state, "audio", call.message, url, video_info, platform_name, None, user_db_id
+        )
+    else:
+        qualities = video_info.get("qualities") or []
+        if not qualities:
+            await call.message.edit_text(
+                "🎬 لا توجد عدة جودات متاحة، سيتم الإرسال بأفضل جودة تلقائيًا..."
+            )
+            await submit_with_prefetch(
+                state, "video", call.message, url, video_info, platform_name, None, user_db_id
+            )
+            return
+
+        # التحميل المسبق للصوت لم يعد مفيدًا بعد اختيار الفيديو، أما الفيديو فينتظر اختيار الجودة
+        pf = state.get("prefetch")
+        if pf is not None and pf.action != "video":
+            discard_prefetch(state)
+        elif pf is not None:
+            SESSION_PREFETCHES[token["session_id"]] = pf
+
+        rows = []
+        row = []
+        for q in qualities[:4]:
+            h = q["height"]
+            btn = InlineKeyboardButton(
+                text=f"{h}p", callback_data=quality_callback(token["session_id"], h, q.get("format_id"))
+            )
+            row.append(btn)
+        if row:
+            rows.append(row)
+
+        rows.append(
+            [
+                InlineKeyboardButton(
+                    text="⭐ أفضل جودة تلقائيًا",
+                    callback_data=quality_callback(token["session_id"], None, None),
+                )
+            ]
+        )
+
+        kb = InlineKeyboardMarkup(inline_keyboard=rows)
+        await call.message.edit_text("🎬 اختر جودة الفيديو التي تريدها:", reply_markup=kb)
+
+
+@router.callback_query(F.data.startswith("q:"))
+async def cb_choose_quality(call: CallbackQuery):
+    loaded = await load_callback_session(call)
+    if loaded is None:
+        return
+    token, state = loaded
+
+    url = state["url"]
+    video_info = state["video_info"]
+    platform_name = state["platform_name"]
+    user_db_id = state["user_db_id"]
+
+    await call.answer()
+
+    height = token["height"]
+    if token["format_id"]:
+        # الصيغة المحددة في الزر هي المرجع لو ما زالت ضمن الجلسة
+        match = next(
+            (q for q in video_info.get("qualities") or [] if q.get("format_id") == token["format_id"]), None
+        )
+        if match is not None:
+            height = match["height"]
+
+    if height is None:
+        await call.message.edit_text("⬇️ جاري التحميل بأفضل جودة متاحة...")
+    else:
+        await call.message.edit_text(f"⬇️ جاري التحميل بالجودة {height}p...")
+
+    await submit_with_prefetch(
+        state, "video", call.message, url, video_info, platform_name, height, user_db_id
+    )
+
+
+@router.callback_query(F.data.in_(["type_video", "type_audio"]) | F.data.startswith("q_"))
+async def cb_legacy_buttons(call: CallbackQuery):
+    # أزرار رسائل ما قبل الجلسات المشتركة
+    await call.answer(SESSION_EXPIRED_TEXT, show_alert=True)
+
+
+# ================== قاطع دائرة لكل دومين + مهلة لكل مرحلة ==================
+
+# نافذة الفشل المتدحرجة، وأقل عدد محاولات قبل الحكم، ونسبة الفشل التي تفتح القاطع
+BREAKER_WINDOW = 300
+BREAKER_MIN_CALLS = 5
+BREAKER_FAILURE_RATE = 0.6
+# مدة بقاء القاطع مفتوحًا قبل السماح بمحاولة اختبار واحدة
+BREAKER_OPEN_SECONDS = 120
+
+# المهلة القصوى لكل مرحلة بالثواني
+STAGE_DEADLINES = {
+    "extract": int(os.getenv("EXTRACT_DEADLINE", "45")),
+    "download": int(os.getenv("DOWNLOAD_DEADLINE", "300")),
+    "upload": int(os.getenv("UPLOAD_DEADLINE", "180")),
+}
+
+
+class CircuitBreaker:
+    """
+    closed: الطلبات تمر / open: رفض فوري حتى تنتهي المدة / half_open: طلب اختبار واحد يقرر
+    """
+
+    def __init__(self, domain: str):
+        self.domain = domain
+        self.state = "closed"
+        self.opened_at = 0.0
+        self._events: collections.deque[tuple[float, bool]] = collections.deque()
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def retry_after(self) -> int:
+        return max(0, int(self.opened_at + BREAKER_OPEN_SECONDS - time.monotonic()))
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < BREAKER_OPEN_SECONDS:
+                    return False
+                self.state = "half_open"
+                self._probe_in_flight = False
+            if self.state == "half_open":
+                if self._probe_in_flight:
+                    return False
+                self._probe_in_flight = True
+            return True
+
+    def record(self, ok: bool):
+        now = time.monotonic()
+        with self._lock:
+            if self.state == "half_open":
+                self._probe_in_flight = False
+                if ok:
+                    self.state = "closed"
+                    self._events.clear()
+                else:
+                    self._open(now)
+                return
+
+            self._events.append((now, ok))
+            while self._events and now - self._events[0][0] > BREAKER_WINDOW:
+                self._events.popleft()
+            failures = sum(1 for _t, good in self._events if not good)
+            if (
+                self.state == "closed"
+                and len(self._events) >= BREAKER_MIN_CALLS
+                and failures / len(self._events) >= BREAKER_FAILURE_RATE
+            ):
+                self._open(now)
+
+    def release(self):
+        """
+        إنهاء طلب بلا نتيجة: يحرر طلب الاختبار (half_open) دون أن يقرر حالة القاطع
+        """
+        with self._lock:
+            self._probe_in_flight = False
+
+    @contextmanager
+    def attempt(self):
+        """
+        يغلّف ما بعد allow() الناجح: report(outcome) يسجّل النتيجة (None = لا تُحسب)،
+        والخروج بدون تسجيل (استثناء، إلغاء) يحرر طلب الاختبار حتى لا يبقى القاطع مغلقًا للأبد
+        """
+        reported = False
+
+        def report(outcome: bool | None):
+            nonlocal reported
+            reported = True
+            if outcome is None:
+                self.release()
+            else:
+                self.record(outcome)
+
+        try:
+            yield report
+        finally:
+            if not reported:
+                self.release()
+
+    def _open(self, now: float):
+        self.state = "open"
+        self.opened_at = now
+        log.warning("circuit_open", extra={"fields": {"domain": self.domain}})
+
+
+BREAKERS: dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(domain: str) -> CircuitBreaker:
+    breaker = BREAKERS.get(domain)
+    if breaker is None:
+        breaker = BREAKERS.setdefault(domain, CircuitBreaker(domain))
+    return breaker
+
+
+def breaker_open_text(breaker: CircuitBreaker) -> str:
+    return (
+        "⚠️ هذا الموقع يفشل بشكل متكرر حاليًا، تم إيقاف الطلبات إليه مؤقتًا.\n"
+        f"حاول مرة أخرى بعد {breaker.retry_after() or 1} ثانية."
+    )
+
+
+async def run_with_deadline(
+    stage: str,
+    func,
+    *args,
+    cancel_event: threading.Event | None = None,
+    executor: concurrent.futures.Executor | None = None,
+    **kwargs,
+) -> dict:
+    """
+    يشغّل دالة متزامنة (ترجع dict بـ success/error) في خيط بمهلة قصوى.
+    عند انتهاء المهلة يُضبط cancel_event ليتوقف التحميل عند أول progress hook،
+    ويرجع فشلًا فوريًا حتى لا ينتظر المستخدم أو العامل أكثر.
+    executor: منفذ خاص بدل منفذ asyncio.to_thread الافتراضي
+    """
+    if cancel_event is not None:
+        kwargs["cancel_event"] = cancel_event
+    timeout = STAGE_DEADLINES[stage]
+    if executor is None:
+        work = asyncio.to_thread(func, *args, **kwargs)
+    else:
+        # مثل to_thread: ينقل سياق التتبع إلى الخيط
+        call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+        work = asyncio.get_running_loop().run_in_executor(executor, call)
+    try:
+        return await asyncio.wait_for(work, timeout)
+    except asyncio.TimeoutError:
+        if cancel_event is not None:
+            cancel_event.set()
+        log.warning("stage_deadline_exceeded", extra={"fields": {"stage": stage, "timeout": timeout}})
+        return {
+            "success": False,
+            "timeout": True,
+            "error": f"⏱️ تجاوزت العملية المهلة المحددة ({timeout} ثانية).",
+        }
+
+
+# ================== كاش الوسائط على القرص (LRU بميزانية بايت) ==================
+
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", "media_cache")
+# 0 = تعطيل الكاش
+MEDIA_CACHE_BYTES = int(os.getenv("MEDIA_CACHE_MB", "2048")) * 1024 * 1024
+
+
+def media_cache_key(url: str, fmt: str) -> str:
+    return hashlib.sha256(f"{url}|{fmt}".encode("utf-8")).hexdigest()
+
+
+def _link_or_copy(src: str, dst: str):
+    """
+    hardlink بدون أي نسخ للبيانات، مع نسخ عادي لو كان المجلدان على أقراص مختلفة
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class MediaCache:
+    """
+    كاش معنون بالمحتوى: المفتاح sha256(url|format) والملف في root/ab/<key>.
+    الكتابة ذرّية (ملف .part ثم os.replace)، والترتيب LRU حسب mtime حتى يبقى صحيحًا بعد إعادة الفهرسة.
+    العمّال يكتبون في نفس المجلد، فالإخلاء يعتمد على المجموع الفعلي على القرص وليس على ما كتبته هذه العملية.
+    """
+
+    def __init__(self, root: str, budget_bytes: int):
+        self.root = root
+        self.budget = budget_bytes
+        self._lock = threading.Lock()
+        self._index: collections.OrderedDict[str, int] = collections.OrderedDict()
+        self._total = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.budget > 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key)
+
+    def reindex(self):
+        """
+        يبني الفهرس من القرص (عند بدء التشغيل) ويحذف بقايا الكتابات غير المكتملة
+        """
+        if not self.enabled:
+            return
+        self._sync()
+        log.info(
+            "media_cache_reindexed",
+            extra={"fields": {"files": len(self._index), "bytes": self._total}},
+        )
+
+    def _sync(self):
+        """
+        إعادة قراءة المجلد كله (ملفات كل العمليات) ثم الإخلاء حتى الميزانية
+        """
+        entries = []
+        os.makedirs(self.root, exist_ok=True)
+        for dirpath, _dirnames, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if name.endswith(".part"):
+                    # كتابة انقطعت؛ نتركها لو كانت حديثة (قد تكون لعملية أخرى)
+                    if time.time() - st.st_mtime > 3600:
+                        self._remove_file(path)
+                    continue
+                entries.append((st.st_mtime, name, st.st_size))
+
+        entries.sort()
+        with self._lock:
+            self._index = collections.OrderedDict((name, size) for _mtime, name, size in entries)
+            self._total = sum(size for _mtime, _name, size in entries)
+            self._evict_locked()
+
+    @staticmethod
+    def _remove_file(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log.warning("media cache remove error %s: %s", path, e)
+
+    def _evict_locked(self):
+        while self._total > self.budget and self._index:
+            key, size = self._index.popitem(last=False)
+            self._total -= size
+            self._remove_file(self._path(key))
+            log.debug("media_cache_evicted", extra={"fields": {"key": key, "bytes": size}})
+
+    def has(self, key: str) -> bool:
+        return self.enabled and os.path.exists(self._path(key))
+
+    def checkout(self, key: str, dest_path: str) -> dict | None:
+        """
+        لو كان الملف في الكاش: يربطه داخل مجلد العمل (حتى لا يتأثر بالإخلاء أثناء الرفع)
+        ويرجع نتيجة بنفس شكل دوال التحميل
+        """
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        with self._lock:
+            try:
+                size = os.path.getsize(path)
+                _link_or_copy(path, dest_path)
+                os.utime(path)
+            except OSError:
+                if key in self._index:
+                    self._total -= self._index.pop(key)
+                return None
+            if key not in self._index:
+                self._total += size
+            self._index[key] = size
+            self._index.move_to_end(key)
+
+        log.info("media_cache_hit", extra={"fields": {"key": key, "bytes": size}})
+        return {"success": True, "file_path": dest_path, "file_size": size, "cached": True}
+
+    def put(self, key: str, src_path: str):
+        if not self.enabled:
+            return
+        try:
+            size = os.path.getsize(src_path)
+            if size <= 0 or size > self.budget:
+                return
+            dest = self._path(key)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            tmp = f"{dest}.{os.getpid()}.{threading.get_ident()}.part"
+            _link_or_copy(src_path, tmp)
+            os.replace(tmp, dest)
+        except Exception as e:
+            log.warning("media cache put error: %s", e)
+            return
+
+        # مسح المجلد يكلّف أجزاء من الثانية مقابل تحميل استغرق ثوانٍ
+        self._sync()
+
+
+MEDIA_CACHE = MediaCache(MEDIA_CACHE_DIR, MEDIA_CACHE_BYTES)
+
+
+# ================== مساحة عمل مؤقتة لكل طلب ==================
+
+WORK_DIR = os.getenv("WORK_DIR", "work")
+
+
+def new_workspace() -> str:
+    """
+    مجلد مؤقت خاص بكل طلب حتى لا تتصادم الملفات بين الطلبات المتزامنة
+    """
+    os.makedirs(WORK_DIR, exist_ok=True)
+    return tempfile.mkdtemp(prefix="job-", dir=WORK_DIR)
+
+
+def remove_workspace(workspace: str):
+    try:
+        shutil.rmtree(workspace)
+        log.debug("🧹 تم حذف مجلد العمل المؤقت: %s", workspace)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        log.warning("خطأ أثناء حذف مجلد العمل المؤقت %s: %s", workspace, e)
+
+
+def find_format_id(video_info: dict, height: int | None) -> str | None:
+    if height is None:
+        return None
+    for q in video_info.get("qualities") or []:
+        if q["height"] == height:
+            return q["format_id"]
+    return None
+
+
+def download_video_job(
+    url: str,
+    video_info: dict,
+    height: int | None,
+    workspace: str,
+    strategies: list[str] | None = None,
+    cancel_event: threading.Event | None = None,
+) -> dict:
+    """
+    تحميل الفيديو إلى مجلد العمل: الكاش أولًا، ثم استراتيجيات التحميل بالترتيب
+    ("ytdlp" ثم "fallback" افتراضيًا). النتيجة تحمل الاستراتيجية الناجحة
+    وقائمة المحاولات (strategy, ok, ms) لتسجيلها في إحصائيات الاستراتيجيات.
+    """
+    job_started = time.perf_counter()
+    ext = video_info.get("ext", "mp4")
+    tmp_path = os.path.join(workspace, f"video.{ext}")
+    direct = video_info.get("type") == "direct"
+    format_id = None if direct else find_format_id(video_info, height)
+
+    cache_key = media_cache_key(video_info.get("webpage_url") or url, f"video:{format_id or 'auto'}")
+    cached = MEDIA_CACHE.checkout(cache_key, tmp_path)
+    if cached:
+        cached.update(strategy="cache", download_ms=(time.perf_counter() - job_started) * 1000)
+        return cached
+
+    if strategies is None:
+        strategies = [s for s in video_strategy_candidates(video_info) if s != "direct_url"]
+
+    dl = {"success": False, "error": "لا توجد طريقة تحميل متاحة لهذا الرابط"}
+    attempts = []
+    for strategy in strategies:
+        if cancel_event is not None and cancel_event.is_set():
+            break
+        started = time.perf_counter()
+        if strategy == "ytdlp":
+            dl = download_with_ytdlp(url, tmp_path, format_id=format_id, cancel_event=cancel_event)
+        elif strategy == "fallback":
+            dl = download_video_fallback(video_info.get("url") or url, tmp_path, cancel_event)
+        else:
+            continue
+        attempts.append((strategy, bool(dl["success"]), (time.perf_counter() - started) * 1000))
+        if dl["success"]:
+            dl["strategy"] = strategy
+            break
+
+    dl["attempts"] = attempts
+    dl["download_ms"] = (time.perf_counter() - job_started) * 1000
+    if dl["success"]:
+        MEDIA_CACHE.put(cache_key, dl["file_path"])
+    return dl
+
+
+def download_audio_job(
+    url: str,
+    video_info: dict,
+    workspace: str,
+    cancel_event: threading.Event | None = None,
+) -> dict:
+    job_started = time.perf_counter()
+    tmp_path = os.path.join(workspace, "audio.mp3")
+    cache_key = media_cache_key(video_info.get("webpage_url") or url, "audio")
+    cached = MEDIA_CACHE.checkout(cache_key, tmp_path)
+    if cached:
+        cached.update(strategy="cache", download_ms=(time.perf_counter() - job_started) * 1000)
+        return cached
+
+    dl = download_audio_with_ytdlp(url, tmp_path, cancel_event)
+    dl["download_ms"] = (time.perf_counter() - job_started) * 1000
+    if dl["success"]:
+        dl["strategy"] = "ytdlp"
+        MEDIA_CACHE.put(cache_key, dl["file_path"])
+    return dl
+
+
+# ================== التحميل المسبق (prefetch) أثناء اختيار المستخدم ==================
+
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "1") == "1"
+# ميزانية التحميل التخميني: مجموع الأحجام المتوقعة للتحميلات الجارية + عددها
+PREFETCH_BUDGET_BYTES = int(os.getenv("PREFETCH_BUDGET_MB", "200")) * 1024 * 1024
+PREFETCH_MAX_CONCURRENT = int(os.getenv("PREFETCH_MAX_CONCURRENT", "4"))
+PREFETCH_UNKNOWN_SIZE = 25 * 1024 * 1024
+# أقل عدد طلبات ناجحة للدومين، وأقل نسبة للاختيار الأشهر حتى نخمّن
+PREFETCH_MIN_HISTORY = 5
+PREFETCH_MIN_SHARE = 0.5
+# مدة الاحتفاظ بملف محمّل مسبقًا لم يطلبه المستخدم
+PREFETCH_TTL = 600
+# التوقع من آخر أيام فقط، ويُحفظ لكل دومين فترة قبل إعادة حسابه
+PREFETCH_HISTORY_DAYS = 7
+PREFETCH_PREDICTION_TTL = 300
+PREFETCH_PREDICTION_MAX = 1000
+
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+
+_prefetch_in_flight = 0
+_prefetch_reserved_bytes = 0
+# domain -> (وقت الانتهاء، Future التوقع)؛ الطلبات المتزامنة لنفس الدومين تنتظر نفس الاستعلام
+_prefetch_predictions: dict[str, tuple[float, asyncio.Future]] = {}
+# خيوط التحميل المسبق منفصلة عن منفذ to_thread الافتراضي حتى لا تزاحم الاستخراج وقاعدة البيانات
+PREFETCH_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=PREFETCH_MAX_CONCURRENT, thread_name_prefix="prefetch"
+)
+# مهام تنتظر تحميلًا مسبقًا جاريًا ثم تضع الإرسال في الطابور
+_prefetch_handoffs: set[asyncio.Task] = set()
+
+
+class Prefetch:
+    """
+    تحميل تخميني لاختيار واحد (action, height) داخل مجلد عمل خاص به
+    """
+
+    def __init__(self, action: str, height: int | None, reserved_bytes: int):
+        self.action = action
+        self.height = height
+        self.reserved_bytes = reserved_bytes
+        self.workspace = new_workspace()
+        self.cancel_event = threading.Event()
+        self.task: asyncio.Task | None = None
+        self.claimed = False
+
+    def matches(self, action: str, height: int | None) -> bool:
+        return self.action == action and self.height == height
+
+    def discard(self):
+        """
+        إلغاء التحميل (إن كان جاريًا) وحذف مجلد العمل بعد انتهاء الخيط
+        """
+        if self.claimed:
+            return
+        self.claimed = True
+        self.cancel_event.set()
+        if self.task is None or self.task.done():
+            remove_workspace(self.workspace)
+        else:
+            self.task.add_done_callback(lambda _t: remove_workspace(self.workspace))
+
+
+def predict_choice(domain: str) -> tuple[str, str] | None:
+    """
+    أكثر (نوع، جودة) نجاحًا لهذا الدومين خلال آخر PREFETCH_HISTORY_DAYS من جدول requests
+    (نطاق على idx_requests_domain_created بدل كل تاريخ الدومين)
+    """
+    if not domain:
+        return None
+    since = (datetime.utcnow() - timedelta(days=PREFETCH_HISTORY_DAYS)).isoformat()
+    with closing(get_conn()) as conn:
+        c = conn.cursor()
+        c.execute(
+            """
+            SELECT action_type, quality, COUNT(*) AS cnt
+            FROM requests
+            WHERE domain = ? AND created_at >= ? AND status = 'success' AND action_type IN ('video', 'audio')
+            GROUP BY action_type, quality
+            ORDER BY cnt DESC;
+            """,
+            (domain, since),
+        )
+        rows = c.fetchall()
+
+    total = sum(r[2] for r in rows)
+    if total < PREFETCH_MIN_HISTORY or rows[0][2] / total < PREFETCH_MIN_SHARE:
+        return None
+    return rows[0][0], rows[0][1] or "auto"
+
+
+async def cached_prediction(domain: str) -> tuple[str, str] | None:
+    """
+    predict_choice خارج حلقة الأحداث، مع حفظ النتيجة لكل دومين PREFETCH_PREDICTION_TTL ثانية
+    """
+    now = time.monotonic()
+    entry = _prefetch_predictions.get(domain)
+    if entry is None or entry[0] < now:
+        if len(_prefetch_predictions) >= PREFETCH_PREDICTION_MAX:
+            for key in [k for k, (expires, _f) in _prefetch_predictions.items() if expires < now]:
+                del _prefetch_predictions[key]
+        future = asyncio.ensure_future(asyncio.to_thread(predict_choice, domain))
+        entry = _prefetch_predictions[domain] = (now + PREFETCH_PREDICTION_TTL, future)
+    try:
+        return await asyncio.shield(entry[1])
+    except Exception as e:
+        log.warning("prefetch prediction error: %s", e)
+        _prefetch_predictions.pop(domain, None)
+        return None
+
+
+def _release_prefetch_budget(pf: Prefetch):
+    global _prefetch_in_flight, _prefetch_reserved_bytes
+    _prefetch_in_flight -= 1
+    _prefetch_reserved_bytes -= pf.reserved_bytes
+
+
+async def start_prefetch(url: str, domain: str, video_info: dict) -> Prefetch | None:
+    """
+    يبدأ تحميل الاختيار الأرجح في الخلفية فور انتهاء التحليل، ضمن ميزانية محدودة
+    """
+    global _prefetch_in_flight, _prefetch_reserved_bytes
+
+    if not PREFETCH_ENABLED or video_info.get("type") == "direct":
+        return None
+
+    guess = await cached_prediction(domain)
+    if guess is None:
+        return None
+    action, quality = guess
+
+    qualities = video_info.get("qualities") or []
+    if action == "audio":
+        height = None
+        estimate = PREFETCH_UNKNOWN_SIZE
+    elif not qualities or quality == "auto":
+        height = None
+        estimate = video_info.get("filesize") or PREFETCH_UNKNOWN_SIZE
+    else:
+        try:
+            height = int(quality.rstrip("p"))
+        except ValueError:
+            return None
+        match = next((q for q in qualities if q["height"] == height), None)
+        if match is None:
+            return None
+        estimate = match.get("filesize") or PREFETCH_UNKNOWN_SIZE
+
+    if estimate > MAX_UPLOAD_BYTES:
+        return None
+    if (
+        _prefetch_in_flight >= PREFETCH_MAX_CONCURRENT
+        or _prefetch_reserved_bytes + estimate > PREFETCH_BUDGET_BYTES
+    ):
+        log.info("prefetch_skipped_budget", extra={"fields": {"domain": domain}})
+        return None
+
+    pf = Prefetch(action, height, estimate)
+    _prefetch_in_flight += 1
+    _prefetch_reserved_bytes += estimate
+
+    if action == "audio":
+        func, args = download_audio_job, (url, video_info, pf.workspace)
+    else:
+        func, args = download_video_job, (url, video_info, height, pf.workspace)
+
+    pf.task = asyncio.create_task(
+        deliver_download(domain, func, *args, cancel_event=pf.cancel_event, executor=PREFETCH_EXECUTOR)
+    )
+
+    def on_done(_task: asyncio.Task):
+        _release_prefetch_budget(pf)
+        asyncio.get_running_loop().call_later(PREFETCH_TTL, pf.discard)
+
+    pf.task.add_done_callback(on_done)
+    log.info(
+        "prefetch_started",
+        extra={"fields": {"domain": domain, "action": action, "height": height, "estimate": estimate}},
+    )
+    return pf
+
+
+def discard_prefetch(state: dict | None):
+    if state and state.get("prefetch"):
+        state.pop("prefetch").discard()
+
+
+async def claim_prefetch(state: dict, action: str, height: int | None) -> dict | None:
+    """
+    لو طابق اختيار المستخدم التحميل المسبق: ننتظره ونعيد نتيجته (مع مجلد العمل)،
+    وإلا نلغيه ونرجع None ليبدأ التحميل العادي.
+    """
+    pf: Prefetch | None = state.pop("prefetch", None)
+    if pf is None or pf.claimed:
+        # claimed: انتهت مدته وحُذف مجلده
+        return None
+
+    if not pf.matches(action, height):
+        pf.discard()
+        log.info("prefetch_miss", extra={"fields": {"action": action, "height": height}})
+        return None
+
+    pf.claimed = True
+    try:
+        dl = await pf.task
+    except Exception as e:
+        dl = {"success": False, "error": str(e)}
+
+    if not dl.get("success"):
+        remove_workspace(pf.workspace)
+        log.info("prefetch_failed", extra={"fields": {"error": dl.get("error")}})
+        return None
+
+    log.info("prefetch_hit", extra={"fields": {"action": action, "height": height}})
+    return {**dl, "workspace": pf.workspace}
+
+
+async def submit_with_prefetch(
+    state: dict,
+    kind: str,
+    message: Message,
+    url: str,
+    video_info: dict,
+    platform_name: str,
+    height: int | None,
+    user_db_id: int,
+):
+    """
+    يضع الإرسال في الطابور دون أن ينتظر المعالج: لو كان التحميل المسبق المطابق ما زال
+    جاريًا، تُضاف المهمة من الخلفية عند انتهائه
+    """
+    async def submit():
+        prefetched = await claim_prefetch(state, kind, height)
+        submit_delivery(kind, message, url, video_info, platform_name, height, user_db_id, prefetched)
+
+    pf: Prefetch | None = state.get("prefetch")
+    if pf is None or pf.claimed or not pf.matches(kind, height) or pf.task.done():
+        # لا انتظار هنا: لا يوجد تحميل مسبق مطابق أو انتهى بالفعل
+        await submit()
+        return
+
+    async def handoff():
+        try:
+            await submit()
+        except Exception as e:
+            log.exception("prefetch handoff error: %s", e)
+            await message.answer(f"❌ حدث خطأ أثناء تجهيز الطلب:\n{e}")
 
-    try:
-        video_info = get_direct_video_url(url)
+    task = asyncio.create_task(handoff())
+    _prefetch_handoffs.add(task)
+    task.add_done_callback(_prefetch_handoffs.discard)
 
-        if not video_info.get("success"):
-            await wait_msg.edit_text(f"❌ {video_info.get('error', 'تعذر التعامل مع الرابط.')}")
-            log_request_db(
-                user_id=user_db_id,
-                url=url,
-                domain=domain,
-                action_type="unknown",
-                quality="",
-                status="fail",
-                error=video_info.get("error", "extract_error"),
-            )
-            return
 
-        vtype = video_info.get("type", "unknown")
+async def deliver_download(
+    domain: str,
+    func,
+    *args,
+    cancel_event: threading.Event | None = None,
+    executor: concurrent.futures.Executor | None = None,
+    **kwargs,
+) -> dict:
+    """
+    تحميل الإرسال الفعلي (والمسبق): يرفض فورًا لو كان قاطع الدومين مفتوحًا، ويطبّق مهلة التحميل،
+    ويسجّل النتيجة في القاطع (أخطاء الموقع فقط؛ الكاش وأخطاء الرابط والإلغاء لا تُحسب)
+    """
+    breaker = get_breaker(domain)
+    if not breaker.allow():
+        return {"success": False, "error": breaker_open_text(breaker)}
 
-        if vtype == "direct":
-            platform_name = "رابط مباشر"
-        elif vtype in ["link", "unknown"]:
-            platform_name = "منصة غير معروفة"
-        else:
-            platform_name = vtype.capitalize()
+    with breaker.attempt() as report:
+        dl = await run_with_deadline(
+            "download", func, *args, cancel_event=cancel_event or threading.Event(), executor=executor, **kwargs
+        )
+        report(breaker_outcome(dl))
+    return dl
 
-        info_text = f"✅ تم العثور على فيديو من: {platform_name}\n"
 
-        if video_info.get("title"):
-            title = video_info["title"]
-            if len(title) > 50:
-                title = title[:50] + "..."
-            info_text += f"📹 {title}\n"
+# ================== الرفع المتدفق (من التحميل إلى تيليجرام بدون قرص) ==================
 
-        if video_info.get("uploader"):
-            info_text += f"👤 {video_info['uploader']}\n"
+STREAM_UPLOADS = os.getenv("STREAM_UPLOADS", "1") == "1"
+STREAM_CHUNK_SIZE = 64 * 1024
+# أقصى ذاكرة للمخزن الوسيط = STREAM_BUFFER_CHUNKS * STREAM_CHUNK_SIZE
+STREAM_BUFFER_CHUNKS = int(os.getenv("STREAM_BUFFER_CHUNKS", "32"))
+STREAM_PUT_POLL = 1.0
 
-        if video_info.get("duration"):
-            minutes = video_info["duration"] // 60
-            seconds = video_info["duration"] % 60
-            info_text += f"⏱️ {minutes}:{seconds:02d}\n"
+_STREAM_DONE = object()
 
-        USER_STATE[message.from_user.id] = {
-            "url": url,
-            "video_info": video_info,
-            "platform_name": platform_name,
-            "user_db_id": user_db_id,
-        }
 
-        kb = InlineKeyboardMarkup(
-            inline_keyboard=[
-                [
-                    InlineKeyboardButton(text="🎬 فيديو", callback_data="type_video"),
-                    InlineKeyboardButton(text="🎧 صوت", callback_data="type_audio"),
-                ]
-            ]
-        )
+class StreamAborted(Exception):
+    pass
 
-        await wait_msg.edit_text(
-            info_text + "\n\nاختر نوع الإرسال الذي تريده:", reply_markup=kb
-        )
 
-    except Exception as e:
-        print(f"Unexpected error: {e}")
+class StreamingInputFile(InputFile):
+    """
+    InputFile يقرأ من منتج في خيط خلفي عبر طابور محدود: المنتج يتوقف عندما يمتلئ
+    الطابور (backpressure) فلا تتجاوز الذاكرة حجم المخزن مهما كان حجم الملف.
+    producer(write, cancel_event) يستدعي write(chunk) لكل جزء.
+    """
+
+    def __init__(self, producer, filename: str, expected_size: int):
+        super().__init__(filename=filename, chunk_size=STREAM_CHUNK_SIZE)
+        self.producer = producer
+        self.expected_size = expected_size
+        self.cancel_event = threading.Event()
+        self.bytes_sent = 0
+
+    def _run_producer(self, loop: asyncio.AbstractEventLoop, q: asyncio.Queue):
+        def put(item):
+            fut = asyncio.run_coroutine_threadsafe(q.put(item), loop)
+            while True:
+                try:
+                    fut.result(timeout=STREAM_PUT_POLL)
+                    return
+                except concurrent.futures.TimeoutError:
+                    if self.cancel_event.is_set():
+                        fut.cancel()
+                        raise StreamAborted("consumer gone")
+
+        total = 0
+
+        def write(chunk: bytes):
+            nonlocal total
+            if self.cancel_event.is_set():
+                raise StreamAborted("cancelled")
+            total += len(chunk)
+            # الحجم المعلن هو سبب اختيار هذا المسار؛ أي تجاوز يعني أن الملف ليس كما توقعنا
+            if total > self.expected_size or total > MAX_UPLOAD_BYTES:
+                raise StreamAborted("size exceeded")
+            put(chunk)
+
         try:
-            await wait_msg.edit_text(f"❌ حدث خطأ غير متوقع أثناء معالجة الرابط:\n{e}")
-        except Exception:
-            pass
-        log_request_db(
-            user_id=user_db_id,
-            url=url,
-            domain=domain,
-            action_type="unknown",
-            quality="",
-            status="fail",
-            error=str(e),
-        )
+            self.producer(write, self.cancel_event)
+            put(_STREAM_DONE)
+        except StreamAborted as e:
+            if not self.cancel_event.is_set():
+                put(e)
+        except Exception as e:
+            try:
+                put(e)
+            except StreamAborted:
+                pass
+
+    async def read(self, bot: "Bot"):
+        loop = asyncio.get_running_loop()
+        q: asyncio.Queue = asyncio.Queue(maxsize=STREAM_BUFFER_CHUNKS)
+        producer = loop.run_in_executor(None, self._run_producer, loop, q)
+        try:
+            while True:
+                item = await q.get()
+                if item is _STREAM_DONE:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                self.bytes_sent += len(item)
+                yield item
+        finally:
+            self.cancel_event.set()
+            # تفريغ الطابور حتى لا يبقى المنتج معلقًا
+            while not q.empty():
+                q.get_nowait()
+            await asyncio.shield(producer)
+
+
+def http_stream_producer(source_url: str):
+    def produce(write, cancel_event: threading.Event):
+        headers = {
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
+        }
+        with ORIGIN_LIMITER.slot(source_url, cancel_event) as throttle:
+            with requests.get(source_url, headers=headers, stream=True, timeout=60) as r:
+                r.raise_for_status()
+                for chunk in r.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                    if chunk:
+                        throttle(len(chunk))
+                        write(chunk)
 
+    return produce
 
-# ================== التعامل مع أزرار الإرسال (فيديو / صوت) ==================
 
+def ytdlp_stdout_producer(url: str, format_id: str):
+    """
+    yt-dlp في عملية فرعية يكتب الملف على stdout (-o -)؛ يصلح فقط لصيغة واحدة بدون دمج
+    """
 
-@router.callback_query(F.data.in_(["type_video", "type_audio"]))
-async def cb_choose_type(call: CallbackQuery):
-    state = USER_STATE.get(call.from_user.id)
-    if not state:
-        await call.answer("⏳ انتهت الجلسة، أرسل الرابط مرة أخرى.", show_alert=True)
-        return
+    def produce(write, cancel_event: threading.Event):
+        cmd = [
+            sys.executable,
+            "-m",
+            "yt_dlp",
+            "--quiet",
+            "--no-warnings",
+            "--no-playlist",
+            "--no-part",
+            "--socket-timeout",
+            str(ydl_opts["socket_timeout"]),
+            "-f",
+            format_id,
+            "-o",
+            "-",
+            url,
+        ]
+        with ORIGIN_LIMITER.slot(url, cancel_event) as throttle:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            try:
+                while True:
+                    chunk = proc.stdout.read(STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    # القراءة البطيئة من الأنبوب تبطئ yt-dlp نفسه (backpressure)
+                    throttle(len(chunk))
+                    write(chunk)
+                err = proc.stderr.read().decode("utf-8", "replace").strip()
+                if proc.wait() != 0:
+                    raise RuntimeError(err or f"yt-dlp exited with {proc.returncode}")
+            finally:
+                if proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
 
-    url = state["url"]
-    video_info = state["video_info"]
-    platform_name = state["platform_name"]
-    user_db_id = state["user_db_id"]
+    return produce
 
-    await call.answer()
 
-    if call.data == "type_audio":
-        await call.message.edit_text("🎧 جاري تجهيز الصوت وإرساله، انتظر قليلاً...")
-        await send_audio_from_url(call.message, url, video_info, platform_name, user_db_id)
+def _probe_content_length(source_url: str) -> int | None:
+    try:
+        r = requests.head(source_url, allow_redirects=True, timeout=10)
+        if r.ok and r.headers.get("Content-Length", "").isdigit():
+            return int(r.headers["Content-Length"])
+    except Exception as e:
+        log.debug("content-length probe error: %s", e)
+    return None
+
+
+def stream_plan(url: str, video_info: dict, height: int | None, strategy: str) -> dict | None:
+    """
+    يقرر إن كان يمكن رفع الملف متدفقًا: الحجم معروف مسبقًا (≤ 50MB) وملف واحد بدون دمج.
+    يرجع المنتج والحجم، أو None للمسار العادي عبر القرص.
+    """
+    if not STREAM_UPLOADS:
+        return None
+
+    direct = video_info.get("type") == "direct"
+    format_id = None if direct else find_format_id(video_info, height)
+    if MEDIA_CACHE.has(media_cache_key(video_info.get("webpage_url") or url, f"video:{format_id or 'auto'}")):
+        # الملف موجود محليًا أصلًا
+        return None
+
+    if strategy == "fallback":
+        source_url = video_info.get("url") or url
+        size = video_info.get("filesize") if (direct or height is None) else None
+        size = size or _probe_content_length(source_url)
+        producer = http_stream_producer(source_url)
+    elif strategy == "ytdlp" and not direct:
+        if height is None:
+            fmt = video_info
+        else:
+            fmt = next((q for q in video_info.get("qualities") or [] if q["height"] == height), None)
+        if not fmt or not fmt.get("format_id"):
+            return None
+        if fmt.get("vcodec") == "none" or fmt.get("acodec") in (None, "none"):
+            return None
+        if fmt.get("protocol") not in ("http", "https"):
+            return None
+        size = fmt.get("filesize")
+        producer = ytdlp_stdout_producer(url, fmt["format_id"])
     else:
-        qualities = video_info.get("qualities") or []
-        if not qualities:
-            await call.message.edit_text(
-                "🎬 لا توجد عدة جودات متاحة، سيتم الإرسال بأفضل جودة تلقائيًا..."
-            )
-            await send_video_with_quality(
-                call.message, url, video_info, platform_name, None, user_db_id
-            )
-            return
+        return None
 
-        rows = []
-        row = []
-        for q in qualities[:4]:
-            h = q["height"]
-            btn = InlineKeyboardButton(text=f"{h}p", callback_data=f"q_{h}")
-            row.append(btn)
-        if row:
-            rows.append(row)
+    if not size or size > MAX_UPLOAD_BYTES:
+        return None
+    return {"producer": producer, "size": size, "strategy": strategy}
 
-        rows.append(
-            [
-                InlineKeyboardButton(
-                    text="⭐ أفضل جودة تلقائيًا", callback_data="q_auto"
-                )
-            ]
+
+# ================== اختيار طريقة الإرسال حسب تاريخ كل دومين ==================
+
+# تخفيف وزن النتائج القديمة مع كل محاولة جديدة، ووزن آخر زمن في المتوسط المتحرك
+STRATEGY_DECAY = 0.95
+STRATEGY_EWMA_ALPHA = 0.3
+# بعد هذا العدد (الموزون) من المحاولات نثق بالإحصائية
+STRATEGY_MIN_SAMPLES = 5
+# طريقة نسبة نجاحها أقل من هذا تُتخطى، إلا في نسبة استكشاف صغيرة حتى تتعافى لو أُصلحت
+STRATEGY_SKIP_RATE = 0.2
+STRATEGY_EXPLORE = 0.05
+
+
+def video_strategy_candidates(video_info: dict) -> list[str]:
+    """
+    الترتيب الافتراضي: الرابط المباشر يُرسل لتيليجرام أولًا ثم يُحمّل،
+    وباقي المواقع yt-dlp أولًا ثم التحميل المباشر لرابط الملف
+    """
+    if video_info.get("type") == "direct":
+        return ["direct_url", "fallback"]
+    candidates = ["ytdlp"]
+    if video_info.get("url"):
+        candidates.append("fallback")
+    return candidates
+
+
+@traced("db")
+def record_strategy_outcome(domain: str, strategy: str, ok: bool, ms: float):
+    with closing(get_conn()) as conn:
+        c = conn.cursor()
+        c.execute(
+            """
+            INSERT INTO strategy_stats (domain, strategy, attempts, successes, ewma_ms, updated_at)
+            VALUES (?, ?, 1, ?, ?, ?)
+            ON CONFLICT(domain, strategy) DO UPDATE SET
+                attempts = attempts * ? + 1,
+                successes = successes * ? + excluded.successes,
+                ewma_ms = CASE
+                    WHEN excluded.ewma_ms IS NULL THEN ewma_ms
+                    WHEN ewma_ms IS NULL THEN excluded.ewma_ms
+                    ELSE ewma_ms * (1 - ?) + excluded.ewma_ms * ?
+                END,
+                updated_at = excluded.updated_at;
+            """,
+            (
+                domain,
+                strategy,
+                1 if ok else 0,
+                ms if ok else None,
+                datetime.utcnow().isoformat(),
+                STRATEGY_DECAY,
+                STRATEGY_DECAY,
+                STRATEGY_EWMA_ALPHA,
+                STRATEGY_EWMA_ALPHA,
+            ),
         )
+        conn.commit()
 
-        kb = InlineKeyboardMarkup(inline_keyboard=rows)
-        await call.message.edit_text("🎬 اختر جودة الفيديو التي تريدها:", reply_markup=kb)
 
+@traced("db")
+def order_strategies(domain: str, candidates: list[str]) -> list[str]:
+    """
+    يرتب الطرق حسب الزمن المتوقع حتى النجاح (ewma_ms / نسبة النجاح) ويتخطى
+    الطرق الفاشلة غالبًا. بدون بيانات كافية يبقى الترتيب الافتراضي.
+    """
+    if len(candidates) < 2:
+        return candidates
 
-@router.callback_query(F.data.startswith("q_"))
-async def cb_choose_quality(call: CallbackQuery):
-    state = USER_STATE.get(call.from_user.id)
-    if not state:
-        await call.answer("⏳ انتهت الجلسة، أرسل الرابط مرة أخرى.", show_alert=True)
-        return
+    with closing(get_conn()) as conn:
+        c = conn.cursor()
+        c.execute(
+            "SELECT strategy, attempts, successes, ewma_ms FROM strategy_stats WHERE domain = ?;",
+            (domain,),
+        )
+        stats = {r[0]: r[1:] for r in c.fetchall()}
 
-    url = state["url"]
-    video_info = state["video_info"]
-    platform_name = state["platform_name"]
-    user_db_id = state["user_db_id"]
+    known = {}
+    for strategy in candidates:
+        attempts, successes, ewma_ms = stats.get(strategy, (0, 0, None))
+        if attempts >= STRATEGY_MIN_SAMPLES:
+            known[strategy] = ((successes + 1) / (attempts + 2), ewma_ms)
 
-    await call.answer()
+    usable = [
+        s for s in candidates if s not in known or known[s][0] >= STRATEGY_SKIP_RATE
+    ]
+    skipped = [s for s in candidates if s not in usable]
+    if not usable:
+        # كلها تفشل غالبًا: نجرب الأفضل نسبةً فقط
+        return [max(skipped, key=lambda s: known[s][0])]
 
-    data = call.data
-    if data == "q_auto":
-        height = None
-        await call.message.edit_text("⬇️ جاري التحميل بأفضل جودة متاحة...")
-    else:
-        try:
-            height = int(data.split("_", 1)[1])
-        except ValueError:
-            height = None
-        if height:
-            await call.message.edit_text(f"⬇️ جاري التحميل بالجودة {height}p...")
+    if len(known) == len(candidates):
+        usable.sort(key=lambda s: (known[s][1] or float("inf")) / known[s][0])
+
+    if skipped and random.random() < STRATEGY_EXPLORE:
+        usable += skipped
+    return usable
 
-    await send_video_with_quality(
-        call.message, url, video_info, platform_name, height, user_db_id
-    )
+
+def record_download_attempts(domain: str, dl: dict):
+    """
+    المحاولات الفاشلة تُسجّل فورًا؛ الناجحة تُسجّل بعد الرفع بالزمن الكلي
+    """
+    for strategy, ok, ms in dl.get("attempts") or []:
+        if not ok:
+            record_strategy_outcome(domain, strategy, False, ms)
 
 
 # ================== دوال الإرسال (فيديو / صوت) مع التسجيل في DB ==================
 
 
+class RetryableDeliveryError(Exception):
+    """
+    فشل مؤقت من المصدر (timeout / origin_error): تعود المهمة للطابور بدل إبلاغ المستخدم بالفشل
+    """
+
+
+def record_safely(func, *args, **kwargs):
+    """
+    أخطاء التسجيل لا تُفشل طلبًا، ولا تعيد مهمة سُلّم ملفها بالفعل
+    """
+    try:
+        func(*args, **kwargs)
+    except Exception as e:
+        log.warning("%s error: %s", getattr(func, "__name__", func), e)
+
+
 async def send_video_with_quality(
     message: Message,
     url: str,
@@ -978,11 +4693,16 @@ async def send_video_with_quality(
     platform_name: str,
     height: int | None,
     user_db_id: int,
+    prefetched: dict | None = None,
+    retry_allowed: bool = False,
 ):
-    domain = (urlparse(url).hostname or "").lower()
+    domain = canonical_domain(url)
     quality_str = f"{height}p" if height else "auto"
     status = "fail"
     error_msg = None
+    # download_ms / upload_ms / nbytes / strategy للطريقة التي أوصلت الملف
+    perf: dict = {}
+    workspace = prefetched["workspace"] if prefetched else new_workspace()
 
     try:
         vtype = video_info.get("type", "unknown")
@@ -993,97 +4713,149 @@ async def send_video_with_quality(
             caption += f" | {title[:30]}"
 
         webpage_url = video_info.get("webpage_url", url)
-        log_video_usage(title=title, url=webpage_url, domain=domain)
+        record_safely(log_video_usage, title=title, url=webpage_url, domain=domain)
 
-        if vtype == "direct":
+        async def try_direct_url() -> bool:
             direct_url = video_info.get("url") or url
             await message.answer("📤 محاولة إرسال مباشر بدون تحميل...")
+            started = time.perf_counter()
             send_result = await send_video_direct(message, direct_url, caption, duration)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            record_safely(record_strategy_outcome, domain, "direct_url", send_result["success"], elapsed_ms)
             if send_result["success"]:
-                status = "success"
-                log_request_db(
-                    user_id=user_db_id,
-                    url=url,
-                    domain=domain,
-                    action_type="video",
-                    quality=quality_str,
-                    status=status,
-                    error=None,
-                )
-                print("✅ أُرسل الفيديو مباشرة بدون تحميل.")
-                return
-            await message.answer("⚠️ فشل الإرسال المباشر، سيتم التحميل المؤقت ثم الإرسال...")
-
-            ext = video_info.get("ext", "mp4")
-            tmp_path = f"video_temp.{ext}"
-            dl = download_video_fallback(direct_url, tmp_path)
-
+                perf.update(strategy="direct_url", upload_ms=elapsed_ms)
+            return send_result["success"]
+
+        async def try_stream_upload(plan: dict) -> bool:
+            breaker = get_breaker(domain)
+            if not breaker.allow():
+                return False
+            stream_file = StreamingInputFile(
+                plan["producer"], f"video.{video_info.get('ext', 'mp4')}", plan["size"]
+            )
+            with breaker.attempt() as report:
+                await bot.send_chat_action(message.chat.id, ChatAction.UPLOAD_VIDEO)
+                started = time.perf_counter()
+                try:
+                    with span("upload", mode="stream", bytes=plan["size"]):
+                        await message.answer_video(
+                            video=stream_file,
+                            caption=caption,
+                            duration=duration or None,
+                            supports_streaming=True,
+                            request_timeout=STAGE_DEADLINES["download"] + STAGE_DEADLINES["upload"],
+                        )
+                except Exception as e:
+                    log.warning(
+                        "stream upload failed: %s",
+                        e,
+                        extra={"fields": {"strategy": plan["strategy"], "bytes_sent": stream_file.bytes_sent}},
+                    )
+                    report(False)
+                    record_safely(record_strategy_outcome, domain, plan["strategy"], False, (time.perf_counter() - started) * 1000)
+                    return False
+                report(True)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            record_safely(record_strategy_outcome, domain, plan["strategy"], True, elapsed_ms)
+            # التحميل والرفع متداخلان هنا، فالزمن كله يُحسب رفعًا
+            perf.update(strategy=f"stream:{plan['strategy']}", upload_ms=elapsed_ms, nbytes=stream_file.bytes_sent)
+            return True
+
+        if prefetched:
+            dl = prefetched
+            order = []
         else:
-            ext = video_info.get("ext", "mp4")
-            tmp_path = f"video_temp.{ext}"
-
-            format_id = None
-            if height is not None:
-                for q in video_info.get("qualities") or []:
-                    if q["height"] == height:
-                        format_id = q["format_id"]
-                        break
-
-            if format_id:
-                dl = download_with_ytdlp(url, tmp_path, format_id=format_id)
-            else:
-                dl = download_with_ytdlp(url, tmp_path, format_id=None)
+            order = order_strategies(domain, video_strategy_candidates(video_info))
+            downloads = [s for s in order if s != "direct_url"]
+            dl = {"success": False, "error": "لا توجد طريقة تحميل متاحة لهذا الرابط"}
+
+            if order[0] == "direct_url":
+                if await try_direct_url():
+                    status = "success"
+                    log.info("✅ أُرسل الفيديو مباشرة بدون تحميل.")
+                    return
+                if downloads:
+                    await message.answer("⚠️ فشل الإرسال المباشر، سيتم التحميل المؤقت ثم الإرسال...")
+
+            if downloads:
+                plan = await asyncio.to_thread(stream_plan, url, video_info, height, downloads[0])
+                if plan and await try_stream_upload(plan):
+                    status = "success"
+                    log.info("✅ تم رفع الفيديو متدفقًا بدون تخزين على القرص.")
+                    return
+
+                dl = await deliver_download(
+                    domain, download_video_job, url, video_info, height, workspace, strategies=downloads
+                )
+                record_safely(record_download_attempts, domain, dl)
 
-            if (not dl["success"]) and video_info.get("url"):
-                dl = download_video_fallback(video_info["url"], tmp_path)
+        if not dl["success"] and "direct_url" in order[1:]:
+            if await try_direct_url():
+                status = "success"
+                log.info("✅ أُرسل الفيديو مباشرة بعد فشل التحميل.")
+                return
 
+        perf.update(download_ms=dl.get("download_ms"), strategy=dl.get("strategy"))
         if not dl["success"]:
             error_msg = dl["error"]
+            if retry_allowed and breaker_outcome(dl) is False:
+                status = "retry"
+                raise RetryableDeliveryError(dl["error"])
             await message.answer(f"❌ فشل تحميل الفيديو:\n{dl['error']}")
-            if "tmp_path" in locals() and os.path.exists(tmp_path):
-                os.remove(tmp_path)
             return
+        perf["nbytes"] = dl["file_size"]
 
-        if dl["file_size"] > 50 * 1024 * 1024:
+        if dl["file_size"] > MAX_UPLOAD_BYTES:
             error_msg = "file_too_large"
             await message.answer("❌ حجم الفيديو أكبر من 50MB، لا يمكن إرساله.")
-            os.remove(tmp_path)
             return
 
         await bot.send_chat_action(message.chat.id, ChatAction.UPLOAD_VIDEO)
 
-        video_file = FSInputFile(tmp_path)
-        await message.answer_video(
-            video=video_file,
-            caption=caption,
-            duration=duration or None,
-            supports_streaming=True,
-        )
+        video_file = FSInputFile(dl["file_path"])
+        upload_started = time.perf_counter()
+        with span("upload", mode="file", bytes=dl["file_size"]):
+            await message.answer_video(
+                video=video_file,
+                caption=caption,
+                duration=duration or None,
+                supports_streaming=True,
+                request_timeout=STAGE_DEADLINES["upload"],
+            )
 
-        print("✅ تم تحميل الفيديو مؤقتاً وإرساله.")
+        log.info("✅ تم تحميل الفيديو مؤقتاً وإرساله.")
         status = "success"
+        perf["upload_ms"] = upload_ms = (time.perf_counter() - upload_started) * 1000
+
+        # زمن الطريقة الناجحة = التحميل + الرفع
+        if dl.get("strategy") and dl.get("attempts"):
+            record_safely(record_strategy_outcome, domain, dl["strategy"], True, dl["attempts"][-1][2] + upload_ms)
 
+    except RetryableDeliveryError:
+        raise
     except Exception as e:
-        print(f"send_video_with_quality error: {e}")
+        log.exception("send_video_with_quality error: %s", e)
         await message.answer(f"❌ حدث خطأ أثناء إرسال الفيديو:\n{e}")
         error_msg = str(e)
     finally:
-        for fname in os.listdir("."):
-            if fname.startswith("video_temp.") and os.path.isfile(fname):
-                try:
-                    os.remove(fname)
-                    print(f"🧹 تم حذف الملف المؤقت: {fname}")
-                except Exception as ee:
-                    print(f"خطأ أثناء حذف الملف المؤقت {fname}: {ee}")
+        remove_workspace(workspace)
 
-        log_request_db(
-            user_id=user_db_id,
-            url=url,
-            domain=domain,
-            action_type="video",
-            quality=quality_str,
-            status=status,
-            error=error_msg,
+        # المحاولة المعادة تُسجَّل مرة واحدة عند انتهائها فعلًا
+        if status != "retry":
+            record_safely(
+                log_request_db,
+                user_id=user_db_id,
+                url=url,
+                domain=domain,
+                action_type="video",
+                quality=quality_str,
+                status=status,
+                error=error_msg,
+                extract_ms=video_info.get("extract_ms"),
+                **perf,
+            )
+        record_safely(
+            log_trace_summary, "request_done", action="video", domain=domain, quality=quality_str, status=status
         )
 
 
@@ -1093,29 +4865,37 @@ async def send_audio_from_url(
     video_info: dict,
     platform_name: str,
     user_db_id: int,
+    prefetched: dict | None = None,
+    retry_allowed: bool = False,
 ):
-    tmp_path = "audio_temp.mp3"
-    domain = (urlparse(url).hostname or "").lower()
+    domain = canonical_domain(url)
     status = "fail"
     error_msg = None
+    perf: dict = {}
+    workspace = prefetched["workspace"] if prefetched else new_workspace()
 
     try:
         title = video_info.get("title") or "فيديو"
         webpage_url = video_info.get("webpage_url", url)
-        log_video_usage(title=title, url=webpage_url, domain=domain)
+        record_safely(log_video_usage, title=title, url=webpage_url, domain=domain)
 
-        dl = download_audio_with_ytdlp(url, tmp_path)
+        if prefetched:
+            dl = prefetched
+        else:
+            dl = await deliver_download(domain, download_audio_job, url, video_info, workspace)
+        perf.update(download_ms=dl.get("download_ms"), strategy=dl.get("strategy"))
         if not dl["success"]:
             error_msg = dl["error"]
+            if retry_allowed and breaker_outcome(dl) is False:
+                status = "retry"
+                raise RetryableDeliveryError(dl["error"])
             await message.answer(f"❌ فشل تحميل الصوت:\n{dl['error']}")
-            if os.path.exists(tmp_path):
-                os.remove(tmp_path)
             return
+        perf["nbytes"] = dl["file_size"]
 
-        if dl["file_size"] > 50 * 1024 * 1024:
+        if dl["file_size"] > MAX_UPLOAD_BYTES:
             error_msg = "file_too_large"
             await message.answer("❌ حجم ملف الصوت أكبر من 50MB، لا يمكن إرساله.")
-            os.remove(tmp_path)
             return
 
         await bot.send_chat_action(message.chat.id, ChatAction.UPLOAD_VOICE)
@@ -1124,49 +4904,293 @@ async def send_audio_from_url(
         if title:
             caption += f" | {title[:30]}"
 
-        audio_file = FSInputFile(tmp_path)
-        await message.answer_audio(
-            audio=audio_file,
-            caption=caption,
-        )
+        audio_file = FSInputFile(dl["file_path"])
+        upload_started = time.perf_counter()
+        with span("upload", mode="file", bytes=dl["file_size"]):
+            await message.answer_audio(
+                audio=audio_file,
+                caption=caption,
+                request_timeout=STAGE_DEADLINES["upload"],
+            )
 
-        print("✅ تم تحميل الصوت مؤقتاً وإرساله.")
+        log.info("✅ تم تحميل الصوت مؤقتاً وإرساله.")
         status = "success"
+        perf["upload_ms"] = (time.perf_counter() - upload_started) * 1000
 
+    except RetryableDeliveryError:
+        raise
     except Exception as e:
-        print(f"send_audio_from_url error: {e}")
+        log.exception("send_audio_from_url error: %s", e)
         await message.answer(f"❌ حدث خطأ أثناء إرسال الصوت:\n{e}")
         error_msg = str(e)
     finally:
-        if os.path.exists(tmp_path):
-            try:
-                os.remove(tmp_path)
-                print("🧹 تم حذف ملف الصوت المؤقت.")
-            except Exception as ee:
-                print(f"خطأ أثناء حذف ملف الصوت المؤقت: {ee}")
+        remove_workspace(workspace)
 
-        log_request_db(
-            user_id=user_db_id,
-            url=url,
-            domain=domain,
-            action_type="audio",
-            quality="audio",
-            status=status,
-            error=error_msg,
+        # المحاولة المعادة تُسجَّل مرة واحدة عند انتهائها فعلًا
+        if status != "retry":
+            record_safely(
+                log_request_db,
+                user_id=user_db_id,
+                url=url,
+                domain=domain,
+                action_type="audio",
+                quality="audio",
+                status=status,
+                error=error_msg,
+                extract_ms=video_info.get("extract_ms"),
+                **perf,
+            )
+        record_safely(log_trace_summary, "request_done", action="audio", domain=domain, status=status)
+
+
+# ================== العمّال (worker processes) ==================
+
+# عدد عمليات العمّال؛ 0 = تنفيذ المهام داخل عملية البوت نفسها
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", "2"))
+# عدد المهام المتزامنة داخل كل عامل
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", "2"))
+JOB_POLL_INTERVAL = 0.5
+JOB_RECOVERY_INTERVAL = 30
+WORKER_SUPERVISE_INTERVAL = 2
+
+
+def submit_delivery(
+    kind: str,
+    message: Message,
+    url: str,
+    video_info: dict,
+    platform_name: str,
+    height: int | None,
+    user_db_id: int,
+    prefetched: dict | None = None,
+) -> int:
+    """
+    يحوّل طلب الإرسال (فيديو / صوت) إلى مهمة في الطابور الدائم بدل تنفيذه في عملية الواجهة
+    """
+    payload = {
+        "message": message.model_dump(mode="json", exclude_none=True, by_alias=True),
+        "url": url,
+        "video_info": video_info,
+        "platform_name": platform_name,
+        "height": height,
+        "user_db_id": user_db_id,
+        "prefetched": prefetched,
+        "trace_id": TRACE_ID.get(),
+    }
+    job_id = enqueue_job(kind, payload)
+    log.info("job_enqueued", extra={"fields": {"job_id": job_id, "kind": kind}})
+    return job_id
+
+
+async def execute_job(job: dict):
+    p = job["payload"]
+    bind_trace(p.get("trace_id"))
+    message = Message.model_validate(p["message"]).as_(bot)
+
+    # بعد إعادة المحاولة قد يكون ملف التحميل المسبق قد حُذف
+    prefetched = p.get("prefetched")
+    if prefetched and not os.path.exists(prefetched.get("file_path", "")):
+        prefetched = None
+
+    # في المحاولة الأخيرة يُبلَّغ المستخدم بالفشل بدل إعادتها للطابور
+    retry_allowed = job["attempts"] < job["max_attempts"]
+
+    if job["kind"] == "audio":
+        await send_audio_from_url(
+            message,
+            p["url"],
+            p["video_info"],
+            p["platform_name"],
+            p["user_db_id"],
+            prefetched=prefetched,
+            retry_allowed=retry_allowed,
+        )
+    elif job["kind"] == "video":
+        await send_video_with_quality(
+            message,
+            p["url"],
+            p["video_info"],
+            p["platform_name"],
+            p["height"],
+            p["user_db_id"],
+            prefetched=prefetched,
+            retry_allowed=retry_allowed,
+        )
+    else:
+        raise ValueError(f"unknown job kind: {job['kind']}")
+
+
+async def _heartbeat_loop(job_id: int, owner: str):
+    while True:
+        await asyncio.sleep(JOB_HEARTBEAT_SECONDS)
+        if not await asyncio.to_thread(heartbeat_job, job_id, owner):
+            log.warning("job_lease_lost", extra={"fields": {"job_id": job_id}})
+            return
+
+
+async def _wait_or_stop(stop: asyncio.Event, seconds: float):
+    try:
+        await asyncio.wait_for(stop.wait(), seconds)
+    except asyncio.TimeoutError:
+        pass
+
+
+async def job_worker_loop(owner: str, stop: asyncio.Event):
+    last_recovery = 0.0
+    while not stop.is_set():
+        if time.monotonic() - last_recovery > JOB_RECOVERY_INTERVAL:
+            last_recovery = time.monotonic()
+            recovered = await asyncio.to_thread(recover_orphaned_jobs)
+            if recovered:
+                log.warning("jobs_recovered", extra={"fields": {"count": recovered}})
+
+        job = await asyncio.to_thread(claim_job, owner)
+        if job is None:
+            await _wait_or_stop(stop, JOB_POLL_INTERVAL)
+            continue
+
+        log.info(
+            "job_claimed",
+            extra={"fields": {"job_id": job["id"], "kind": job["kind"], "attempt": job["attempts"]}},
+        )
+        heartbeat = asyncio.create_task(_heartbeat_loop(job["id"], owner))
+        try:
+            await execute_job(job)
+        except RetryableDeliveryError as e:
+            log.warning("job_retry: %s", e, extra={"fields": {"job_id": job["id"], "attempt": job["attempts"]}})
+            await asyncio.to_thread(fail_job, job["id"], owner, str(e))
+        except Exception as e:
+            log.exception("job_failed: %s", e, extra={"fields": {"job_id": job["id"]}})
+            await asyncio.to_thread(fail_job, job["id"], owner, str(e))
+        else:
+            await asyncio.to_thread(complete_job, job["id"], owner)
+        finally:
+            heartbeat.cancel()
+
+
+async def run_job_workers(name: str, concurrency: int, stop: asyncio.Event):
+    await asyncio.gather(
+        *(
+            job_worker_loop(f"{name}@{socket.gethostname()}:{os.getpid()}:{i}", stop)
+            for i in range(concurrency)
         )
+    )
+
+
+async def _worker_main(index: int):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    log.info("👷 worker started", extra={"fields": {"worker": index, "concurrency": JOB_CONCURRENCY}})
+    profiler_watch = asyncio.create_task(profile_request_loop(f"worker-{index}", stop))
+    try:
+        await run_job_workers(f"worker-{index}", JOB_CONCURRENCY, stop)
+    finally:
+        stop.set()
+        await profiler_watch
+        await bot.session.close()
+
+
+def worker_process_main(index: int):
+    setup_logging()
+    OUTBOUND.set_share(WORKER_COUNT, frontend=False)
+    ORIGIN_LIMITER.set_share(WORKER_COUNT + 1)
+    start_warm_up()
+    MEDIA_CACHE.reindex()
+    asyncio.run(_worker_main(index))
+
+
+def spawn_worker(index: int) -> multiprocessing.Process:
+    # spawn بدل fork: الأب فيه خيوط (السجلات) وحلقة أحداث تعمل
+    ctx = multiprocessing.get_context("spawn")
+    proc = ctx.Process(target=worker_process_main, args=(index,), name=f"worker-{index}", daemon=True)
+    proc.start()
+    return proc
+
+
+async def supervise_workers(count: int, stop: asyncio.Event):
+    """
+    يشغّل count عملية عامل ويعيد تشغيل أي عامل يتوقف؛ مهامه تُستعاد عبر انتهاء العقد
+    """
+    procs = {i: spawn_worker(i) for i in range(count)}
+    try:
+        while not stop.is_set():
+            await _wait_or_stop(stop, WORKER_SUPERVISE_INTERVAL)
+            for i, proc in list(procs.items()):
+                if not proc.is_alive() and not stop.is_set():
+                    log.warning("worker_died", extra={"fields": {"worker": i, "exitcode": proc.exitcode}})
+                    procs[i] = spawn_worker(i)
+    finally:
+        for proc in procs.values():
+            proc.terminate()
+        for proc in procs.values():
+            await asyncio.to_thread(proc.join, 10)
 
 
 # ================== run ==================
 
 
+async def on_polling_started():
+    STARTUP_TIMINGS["ready"] = round((time.perf_counter() - _BOOT_STARTED) * 1000, 1)
+    log.info("startup_timings", extra={"fields": {"timings_ms": STARTUP_TIMINGS}})
+
+
+dp.startup.register(on_polling_started)
+
+
 async def main():
-    print("📂 تهيئة قاعدة البيانات...")
-    init_db()
-    load_banned_users()
-    load_blocked_domains()
-    print("🚀 Bot is running...")
-    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    setup_logging()
+    log.info("📂 تهيئة قاعدة البيانات...")
+    started = time.perf_counter()
+    created = init_db()
+    mark_startup("init_db" if created else "schema_check", started)
+
+    started = time.perf_counter()
+    MODERATION.load()
+    recovered = recover_orphaned_jobs()
+    mark_startup("load_state", started)
+    if recovered:
+        log.warning("jobs_recovered", extra={"fields": {"count": recovered}})
+
+    resume_broadcasts()
+
+    # الأعمال الثقيلة في الخلفية حتى يبدأ الاستقبال فورًا
+    start_warm_up()
+    reindex = asyncio.create_task(asyncio.to_thread(MEDIA_CACHE.reindex))
+
+    stop = asyncio.Event()
+    user_flusher = asyncio.create_task(user_flush_loop(stop))
+    session_purger = asyncio.create_task(link_session_purge_loop(stop))
+    moderation_watcher = asyncio.create_task(moderation_watch_loop(stop))
+    if WORKER_COUNT > 0:
+        OUTBOUND.set_share(WORKER_COUNT, frontend=True)
+        ORIGIN_LIMITER.set_share(WORKER_COUNT + 1)
+        background = asyncio.create_task(supervise_workers(WORKER_COUNT, stop))
+    else:
+        background = asyncio.create_task(run_job_workers("inline", JOB_CONCURRENCY, stop))
+    fit_broadcast_rate()
+
+    log.info("🚀 Bot is running...", extra={"fields": {"workers": WORKER_COUNT}})
+    try:
+        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    finally:
+        stop.set()
+        await background
+        await reindex
+        await user_flusher
+        await session_purger
+        await moderation_watcher
+        await asyncio.to_thread(USER_REGISTRY.flush)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if sys.argv[1:2] == ["worker"]:
+        # عامل مستقل: python main.py worker [index]
+        worker_process_main(int(sys.argv[2]) if len(sys.argv) > 2 else 0)
+    elif sys.argv[1:2] == ["record-fixtures"]:
+        setup_logging()
+        record_fixtures_cli(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else "fixtures/extract")
+    else:
+        asyncio.run(main())